@@ -0,0 +1,69 @@
+import os
+import json
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file, load_file
+
+# multistep history of the flow schedulers, missing attributes are skipped so all of them share this list
+SCHEDULER_STATE_ATTRS = ["_step_index", "_begin_index", "lower_order_nums", "this_order", "model_outputs", "timestep_list", "last_sample"]
+
+def pack_state(obj, tensors, prefix="state"):
+    """Flattens nested state into JSON, tensors are moved to the tensors dict and referenced by key."""
+    if isinstance(obj, torch.Tensor):
+        tensors[prefix] = obj.detach().to("cpu", copy=True).contiguous()
+        return {"__tensor__": prefix, "device": str(obj.device)}
+    if isinstance(obj, dict): # keys can be ints or tuples, so kept as pairs
+        return {"__dict__": [[pack_state(k, tensors, f"{prefix}.k{i}"), pack_state(v, tensors, f"{prefix}.{i}")] for i, (k, v) in enumerate(obj.items())]}
+    if isinstance(obj, tuple):
+        return {"__tuple__": [pack_state(v, tensors, f"{prefix}.{i}") for i, v in enumerate(obj)]}
+    if isinstance(obj, list):
+        return [pack_state(v, tensors, f"{prefix}.{i}") for i, v in enumerate(obj)]
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    raise TypeError(f"Can't checkpoint {type(obj)} at {prefix}")
+
+def unpack_state(obj, tensors):
+    if isinstance(obj, dict):
+        if "__tensor__" in obj:
+            return tensors[obj["__tensor__"]].to(obj["device"])
+        if "__dict__" in obj:
+            return {unpack_state(k, tensors): unpack_state(v, tensors) for k, v in obj["__dict__"]}
+        if "__tuple__" in obj:
+            return tuple(unpack_state(v, tensors) for v in obj["__tuple__"])
+    if isinstance(obj, list):
+        return [unpack_state(v, tensors) for v in obj]
+    return obj
+
+def get_scheduler_state(scheduler):
+    return {attr: getattr(scheduler, attr) for attr in SCHEDULER_STATE_ATTRS if hasattr(scheduler, attr)}
+
+def set_scheduler_state(scheduler, state):
+    for attr, value in state.items():
+        setattr(scheduler, attr, value)
+
+def save_checkpoint(path, state, signature):
+    """Writes the state and the run signature to a safetensors file, replacing the previous one only once fully written."""
+    tensors = {}
+    metadata = {
+        "state": json.dumps(pack_state(state, tensors)),
+        "signature": json.dumps(signature),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_file(tensors, path + ".tmp", metadata=metadata)
+    os.replace(path + ".tmp", path)
+
+def load_checkpoint(path, signature):
+    """Returns the saved state, or None if there's no checkpoint. Raises if it was saved by a different run."""
+    if not os.path.exists(path):
+        return None
+    with safe_open(path, framework="pt") as f:
+        metadata = f.metadata()
+    saved_signature = json.loads(metadata["signature"])
+    if saved_signature != json.loads(json.dumps(signature)):
+        raise ValueError(f"Checkpoint {path} is from a different run: {saved_signature}, expected {signature}")
+    return unpack_state(json.loads(metadata["state"]), load_file(path))
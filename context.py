@@ -1,5 +1,7 @@
 import numpy as np
-from typing import Callable, Optional, List
+from collections import deque
+from functools import lru_cache
+from typing import Callable, Optional, List, NamedTuple
 
 
 def ordered_halving(val):
@@ -9,40 +11,26 @@ def ordered_halving(val):
 
     return as_int / (1 << 64)
 
-def does_window_roll_over(window: list[int], num_frames: int) -> tuple[bool, int]:
-    prev_val = -1
-    for i, val in enumerate(window):
-        val = val % num_frames
-        if val < prev_val:
-            return True, i
-        prev_val = val
+def does_window_roll_over(window: np.ndarray, num_frames: int) -> tuple[bool, int]:
+    rolls = np.flatnonzero(np.diff(np.asarray(window) % num_frames) < 0)
+    if len(rolls) > 0:
+        return True, int(rolls[0]) + 1
     return False, -1
 
-def shift_window_to_start(window: list[int], num_frames: int):
-    start_val = window[0]
-    for i in range(len(window)):
-        # 1) subtract each element by start_val to move vals relative to the start of all frames
-        # 2) add num_frames and take modulus to get adjusted vals
-        window[i] = ((window[i] - start_val) + num_frames) % num_frames
-
-def shift_window_to_end(window: list[int], num_frames: int):
-    # 1) shift window to start
-    shift_window_to_start(window, num_frames)
-    end_val = window[-1]
-    end_delta = num_frames - end_val - 1
-    for i in range(len(window)):
-        # 2) add end_delta to each val to slide windows to end
-        window[i] = window[i] + end_delta
-
-def get_missing_indexes(windows: list[list[int]], num_frames: int) -> list[int]:
-    all_indexes = list(range(num_frames))
-    for w in windows:
-        for val in w:
-            try:
-                all_indexes.remove(val)
-            except ValueError:
-                pass
-    return all_indexes
+def shift_window_to_start(window: np.ndarray, num_frames: int) -> np.ndarray:
+    # subtract each element by the start value and wrap to move vals relative to the start of all frames
+    window = np.asarray(window)
+    return (window - window[0] + num_frames) % num_frames
+
+def shift_window_to_end(window: np.ndarray, num_frames: int) -> np.ndarray:
+    # shift window to start, then slide it so that it ends on the last frame
+    window = shift_window_to_start(window, num_frames)
+    return window + (num_frames - window[-1] - 1)
+
+def get_missing_indexes(windows: List[np.ndarray], num_frames: int) -> List[int]:
+    if len(windows) == 0:
+        return list(range(num_frames))
+    return np.setdiff1d(np.arange(num_frames), np.concatenate(windows)).tolist()
 
 def uniform_looped(
     step: int = ...,
@@ -80,44 +68,43 @@ def uniform_standard(
 ):
     windows = []
     if num_frames <= context_size:
-        windows.append(list(range(num_frames)))
+        windows.append(np.arange(num_frames))
         return windows
 
     context_stride = min(context_stride, int(np.ceil(np.log2(num_frames / context_size))) + 1)
 
     for context_step in 1 << np.arange(context_stride):
         pad = int(round(num_frames * ordered_halving(step)))
-        for j in range(
+        starts = np.arange(
             int(ordered_halving(step) * context_step) + pad,
             num_frames + pad + (0 if closed_loop else -context_overlap),
             (context_size * context_step - context_overlap),
-        ):
-            windows.append([e % num_frames for e in range(j, j + context_size * context_step, context_step)])
+        )
+        windows.extend((starts[:, None] + np.arange(context_size) * context_step) % num_frames)
 
-    # now that windows are created, shift any windows that loop, and delete duplicate windows
-    delete_idxs = []
-    win_i = 0
-    while win_i < len(windows):
+    # now that windows are created, shift any windows that loop, and drop duplicate windows
+    rolled = (np.diff(np.stack(windows), axis=1) < 0).any(axis=1).tolist() if windows else []
+    queue = deque(zip(windows, rolled))
+    windows = []
+    seen = set()
+    while queue:
+        window, is_roll = queue.popleft()
         # if window is rolls over itself, need to shift it
-        is_roll, roll_idx = does_window_roll_over(windows[win_i], num_frames)
         if is_roll:
-            roll_val = windows[win_i][roll_idx]  # roll_val might not be 0 for windows of higher strides
-            shift_window_to_end(windows[win_i], num_frames=num_frames)
+            _, roll_idx = does_window_roll_over(window, num_frames)
+            roll_val = int(window[roll_idx])  # roll_val might not be 0 for windows of higher strides
+            window = shift_window_to_end(window, num_frames=num_frames)
             # check if next window (cyclical) is missing roll_val
-            if roll_val not in windows[(win_i+1) % len(windows)]:
-                # need to insert new window here - just insert window starting at roll_val
-                windows.insert(win_i+1, list(range(roll_val, roll_val + context_size)))
-        # delete window if it's not unique
-        for pre_i in range(0, win_i):
-            if windows[win_i] == windows[pre_i]:
-                delete_idxs.append(win_i)
-                break
-        win_i += 1
-
-    # reverse delete_idxs so that they will be deleted in an order that doesn't break idx correlation
-    delete_idxs.reverse()
-    for i in delete_idxs:
-        windows.pop(i)
+            next_window = queue[0][0] if queue else (windows[0] if windows else window)
+            if roll_val not in next_window:
+                # need to process a new window here - just a window starting at roll_val
+                new_window = np.arange(roll_val, roll_val + context_size)
+                queue.appendleft((new_window, does_window_roll_over(new_window, num_frames)[0]))
+        # drop window if it's not unique
+        key = window.tobytes()
+        if key not in seen:
+            seen.add(key)
+            windows.append(window)
     return windows
 
 def static_standard(
@@ -157,6 +144,54 @@ def get_context_scheduler(name: str) -> Callable:
         raise ValueError(f"Unknown context_overlap policy {name}")
 
 
+class ContextSchedule(NamedTuple):
+    windows: tuple  # frame index arrays, one per window
+    weights: tuple  # per frame blend weights, one per window
+    counter: np.ndarray  # per frame sum of the blend weights for normalization
+
+
+def get_window_weights(windows: List[np.ndarray], num_frames: int, context_overlap: int, looped: bool = False) -> List[np.ndarray]:
+    """Per frame blend weights for each window, ramping in and out over the overlap."""
+    weights = []
+    # windows from a scheduler share their length, so the ramps are applied to all of them at once
+    for size in dict.fromkeys(len(w) for w in windows):
+        idxs = [i for i, w in enumerate(windows) if len(w) == size]
+        stacked = np.stack([windows[i] for i in idxs])
+        mins, maxs = stacked.min(axis=1), stacked.max(axis=1)
+        size_weights = np.ones(stacked.shape, dtype=np.float32)
+        # left-side blending for all except first window (or always in loop mode)
+        left = (mins > 0) | (looped & (maxs == num_frames - 1))
+        size_weights[left, :context_overlap] = np.linspace(0, 1, context_overlap)
+        # right-side blending for all except last window (or always in loop mode)
+        right = (maxs < num_frames - 1) | (looped & (mins == 0))
+        size_weights[right, -context_overlap:] = np.linspace(1, 0, context_overlap)
+        weights.extend(zip(idxs, size_weights))
+    return [w for _, w in sorted(weights, key=lambda x: x[0])]
+
+
+@lru_cache(maxsize=4096)
+def get_context_schedule(
+    name: str,
+    step: int,
+    num_steps: Optional[int],
+    num_frames: int,
+    context_size: int,
+    context_stride: int,
+    context_overlap: int,
+    looped: bool = False,
+) -> ContextSchedule:
+    """Memoized context windows for a step, with their blend weights and normalization counter."""
+    scheduler = get_context_scheduler(name)
+    windows = tuple(np.asarray(w, dtype=np.int64) for w in scheduler(step, num_steps, num_frames, context_size, context_stride, context_overlap))
+    weights = tuple(get_window_weights(windows, num_frames, context_overlap, looped))
+    counter = np.zeros(num_frames, dtype=np.float32)
+    for window, weight in zip(windows, weights):
+        counter[window] += weight
+    for array in weights + (counter,):
+        array.setflags(write=False)
+    return ContextSchedule(windows, weights, counter)
+
+
 def get_total_steps(
     scheduler,
     timesteps: List[int],
@@ -182,3 +217,13 @@ def get_total_steps(
         )
         for i in range(len(timesteps))
     )
+
+def get_window_batches(windows: List[np.ndarray], batch_size: int = 1) -> List[List[int]]:
+    """Group consecutive windows of equal length into batches of at most batch_size, as lists of window indices."""
+    batches = []
+    for i, window in enumerate(windows):
+        if batches and len(batches[-1]) < batch_size and len(windows[batches[-1][-1]]) == len(window):
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
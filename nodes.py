@@ -2,33 +2,29 @@ import os
 import torch
 import torch.nn.functional as F
 import gc
-from .utils import log, print_memory, apply_lora, clip_encode_image_tiled
+from .utils import log, apply_lora, clip_encode_image_tiled
 import numpy as np
 import math
 from tqdm import tqdm
 
 from .wanvideo.modules.clip import CLIPModel
-from .wanvideo.modules.model import WanModel, rope_params
+from .wanvideo.modules.model import WanModel, WanSelfAttention, WanAttentionBlock
+from .wanvideo.modules.attention import ATTENTION_BACKENDS
 from .wanvideo.modules.t5 import T5EncoderModel
-from .wanvideo.utils.fm_solvers import (FlowDPMSolverMultistepScheduler,
-                               get_sampling_sigmas, retrieve_timesteps)
-from .wanvideo.utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
-from diffusers.schedulers import FlowMatchEulerDiscreteScheduler
-
-from .enhance_a_video.globals import enable_enhance, disable_enhance, set_enhance_weight, set_num_frames
 from .taehv import TAEHV
+from .sampling import SamplingEngine
+from .teacache_calibration import model_hash, load_teacache_profile, profile_path
 
 from accelerate import init_empty_weights
 from accelerate.utils import set_module_tensor_to_device
 
 import folder_paths
 import comfy.model_management as mm
-from comfy.utils import load_torch_file, ProgressBar, common_upscale
+from comfy.utils import load_torch_file, common_upscale
 import comfy.model_base
 import comfy.latent_formats
 from comfy.clip_vision import clip_preprocess, ClipVisionModel
 from comfy.sd import load_lora_for_models
-from comfy.cli_args import args, LatentPreviewMethod
 
 script_directory = os.path.dirname(os.path.abspath(__file__))
 
@@ -39,19 +35,6 @@ def add_noise_to_reference_video(image, ratio=None):
     image = image + image_noise
     return image
 
-def optimized_scale(positive_flat, negative_flat):
-
-    # Calculate dot production
-    dot_product = torch.sum(positive_flat * negative_flat, dim=1, keepdim=True)
-
-    # Squared norm of uncondition
-    squared_norm = torch.sum(negative_flat ** 2, dim=1, keepdim=True) + 1e-8
-
-    # st_star = v_cond^T * v_uncond / ||v_uncond||^2
-    st_star = dot_product / squared_norm
-    
-    return st_star
-
 class WanVideoBlockSwap:
     @classmethod
     def INPUT_TYPES(s):
@@ -106,6 +89,9 @@ class WanVideoTeaCache:
             },
             "optional": {
                 "mode": (["e", "e0"], {"default": "e", "tooltip": "Choice between using e (time embeds, default) or e0 (modulated time embeds)"}),
+                "memory_budget_mb": ("INT", {"default": 0, "min": 0, "max": 1048576, "step": 64, "tooltip": "Memory limit for the cached residuals in MB, least recently used predictions are dropped and recomputed when exceeded. 0 for no limit"}),
+                "residual_dtype": (["fp32", "bf16", "fp16", "int8"], {"default": "fp32", "tooltip": "Storage precision of the cached residuals, int8 uses a scale per token. Lower precision saves memory at the cost of some reconstruction error, which is logged at the end of the run"}),
+                "pin_memory": ("BOOLEAN", {"default": False, "tooltip": "Use pinned memory for the residuals when caching on the offload device, faster transfers but uses page-locked RAM"}),
             },
         }
     RETURN_TYPES = ("TEACACHEARGS",)
@@ -136,7 +122,7 @@ Official recommended values https://github.com/ali-vilab/TeaCache/tree/main/TeaC
 """
     EXPERIMENTAL = True
 
-    def process(self, rel_l1_thresh, start_step, end_step, cache_device, use_coefficients, mode="e"):
+    def process(self, rel_l1_thresh, start_step, end_step, cache_device, use_coefficients, mode="e", memory_budget_mb=0, residual_dtype="fp32", pin_memory=False):
         if cache_device == "main_device":
             teacache_device = mm.get_torch_device()
         else:
@@ -148,7 +134,108 @@ Official recommended values https://github.com/ali-vilab/TeaCache/tree/main/TeaC
             "cache_device": teacache_device,
             "use_coefficients": use_coefficients,
             "mode": mode,
+            "memory_budget": memory_budget_mb * 1024**2,
+            "residual_dtype": {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16, "int8": torch.int8}[residual_dtype],
+            "pin_memory": pin_memory,
+        }
+        return (teacache_args,)
+
+class WanVideoBlockCache:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "rel_l1_thresh": ("FLOAT", {"default": 0.08, "min": 0.0, "max": 1.0, "step": 0.001,
+                                            "tooltip": "Relative change of the first blocks' residual below which the cached residuals of the remaining blocks are used"}),
+                "first_blocks": ("INT", {"default": 1, "min": 1, "max": 40, "step": 1, "tooltip": "Number of blocks that always run and decide whether to use the cache"}),
+                "refresh_groups": ("INT", {"default": 0, "min": 0, "max": 40, "step": 1, "tooltip": "Splits the remaining blocks into this many groups, on cached steps one group in turn is still computed. 0 to cache all remaining blocks together"}),
+                "start_step": ("INT", {"default": 1, "min": 0, "max": 9999, "step": 1, "tooltip": "Start step to apply the block cache"}),
+                "end_step": ("INT", {"default": -1, "min": -1, "max": 9999, "step": 1, "tooltip": "End step to apply the block cache"}),
+                "cache_device": (["main_device", "offload_device"], {"default": "offload_device", "tooltip": "Device to cache to"}),
+            },
+            "optional": {
+                "memory_budget_mb": ("INT", {"default": 0, "min": 0, "max": 1048576, "step": 64, "tooltip": "Memory limit for the cached residuals in MB, least recently used predictions are dropped and recomputed when exceeded. 0 for no limit"}),
+                "residual_dtype": (["fp32", "bf16", "fp16", "int8"], {"default": "fp32", "tooltip": "Storage precision of the cached residuals, int8 uses a scale per token"}),
+                "pin_memory": ("BOOLEAN", {"default": False, "tooltip": "Use pinned memory for the residuals when caching on the offload device"}),
+            },
+        }
+    RETURN_TYPES = ("TEACACHEARGS",)
+    RETURN_NAMES = ("teacache_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = """
+Block level alternative to TeaCache. The first blocks run every step and their output  
+residual is compared with the one of the last computed step. When it barely changed  
+the cached residual of the remaining blocks is used instead of running them.  
+With refresh_groups the remaining blocks are cached in groups and one group  
+is recomputed on every cached step, slower but closer to the uncached result.  
+Uses the teacache_args input of the sampler.
+"""
+    EXPERIMENTAL = True
+
+    def process(self, rel_l1_thresh, first_blocks, refresh_groups, start_step, end_step, cache_device, memory_budget_mb=0, residual_dtype="fp32", pin_memory=False):
+        teacache_args = WanVideoTeaCache().process(rel_l1_thresh, start_step, end_step, cache_device, use_coefficients=False,
+                                                   memory_budget_mb=memory_budget_mb, residual_dtype=residual_dtype, pin_memory=pin_memory)[0]
+        teacache_args["block_cache_first_blocks"] = first_blocks
+        teacache_args["block_cache_refresh_groups"] = refresh_groups
+        return (teacache_args,)
+
+class WanVideoTokenCache:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "ratio": ("FLOAT", {"default": 0.3, "min": 0.01, "max": 1.0, "step": 0.01, "tooltip": "Fraction of tokens recomputed on cached steps, the ones whose input changed the most"}),
+                "refresh_every": ("INT", {"default": 3, "min": 1, "max": 100, "step": 1, "tooltip": "Compute all tokens every this many steps"}),
+                "start_step": ("INT", {"default": 1, "min": 0, "max": 9999, "step": 1, "tooltip": "Start step to apply the token cache"}),
+                "end_step": ("INT", {"default": -1, "min": -1, "max": 9999, "step": 1, "tooltip": "End step to apply the token cache"}),
+            },
         }
+    RETURN_TYPES = ("TEACACHEARGS",)
+    RETURN_NAMES = ("teacache_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = """
+Token level cache for mostly static videos. Every refresh_every steps all tokens are  
+computed, in between only the given ratio of tokens whose input changed the most  
+since they were last computed go through attention and the FFN, the rest reuse  
+their cached block outputs. Keys and values still cover all tokens.  
+Caches one bf16 tensor per block and prediction on the main device, so it needs a lot of VRAM.  
+Uses the teacache_args input of the sampler.
+"""
+    EXPERIMENTAL = True
+
+    def process(self, ratio, refresh_every, start_step, end_step):
+        teacache_args = WanVideoTeaCache().process(rel_l1_thresh=0.0, start_step=start_step, end_step=end_step, cache_device="main_device", use_coefficients=False)[0]
+        teacache_args["token_cache_ratio"] = ratio
+        teacache_args["token_cache_refresh_every"] = refresh_every
+        return (teacache_args,)
+
+class WanVideoTeaCacheCalibration:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "cache_device": (["main_device", "offload_device"], {"default": "offload_device", "tooltip": "Device to cache to"}),
+            },
+        }
+    RETURN_TYPES = ("TEACACHEARGS",)
+    RETURN_NAMES = ("teacache_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = """
+Calibrates TeaCache coefficients for the loaded model. Every step is computed while  
+the change of the time embeddings and of the block output between steps is recorded,  
+at the end of the run a polynomial is fitted and saved as a profile in  
+the wanvideo/teacache_profiles folder of the ComfyUI user directory, identified by the model hash. The model loader uses the profile  
+instead of the built in coefficients from then on. Samples add up over runs,  
+a few runs with different prompts and step counts give the best fit.
+"""
+    EXPERIMENTAL = True
+
+    def process(self, cache_device):
+        teacache_args = WanVideoTeaCache().process(rel_l1_thresh=0.0, start_step=0, end_step=-1, cache_device=cache_device, use_coefficients=False)[0]
+        teacache_args["calibrate"] = True
         return (teacache_args,)
 
 
@@ -465,19 +552,14 @@ class WanVideoModelLoader:
             "load_device": (["main_device", "offload_device"], {"default": "main_device", "tooltip": "Initial device to load the model to, NOT recommended with the larger models unless you have 48GB+ VRAM"}),
             },
             "optional": {
-                "attention_mode": ([
-                    "sdpa",
-                    "flash_attn_2",
-                    "flash_attn_3",
-                    "sageattn",
-                    #"spargeattn", needs tuning
-                    #"spargeattn_tune",
-                    ], {"default": "sdpa"}),
+                "attention_mode": ([*ATTENTION_BACKENDS, "auto"], {"default": "sdpa", "tooltip": "auto benchmarks the available backends the first time each attention shape bucket (lengths rounded up to powers of two) is used and remembers the fastest"}),
                 "compile_args": ("WANCOMPILEARGS", ),
                 "block_swap_args": ("BLOCKSWAPARGS", ),
                 "lora": ("WANVIDLORA", {"default": None}),
                 "vram_management_args": ("VRAM_MANAGEMENTARGS", {"default": None, "tooltip": "Alternative offloading method from DiffSynth-Studio, more aggressive in reducing memory use than block swapping, but can be slower"}),
                 "vace_model": ("VACEPATH", {"default": None, "tooltip": "VACE model to use when not using model that has it included"}),
+                "attention_chunk_size": ("INT", {"default": 1024, "min": 64, "max": 65536, "step": 64, "tooltip": "Query and key chunk size of the sdpa_chunked attention mode, smaller uses less memory but is slower"}),
+                "ffn_chunk_size": ("INT", {"default": 0, "min": 0, "max": 262144, "step": 256, "tooltip": "Runs the cross attention and feed forward of each block on this many tokens at a time, which caps their activation memory with the same result. 0 runs the whole sequence at once"}),
             }
         }
 
@@ -487,7 +569,7 @@ class WanVideoModelLoader:
     CATEGORY = "WanVideoWrapper"
 
     def loadmodel(self, model, base_precision, load_device,  quantization,
-                  compile_args=None, attention_mode="sdpa", block_swap_args=None, lora=None, vram_management_args=None, vace_model=None):
+                  compile_args=None, attention_mode="sdpa", block_swap_args=None, lora=None, vram_management_args=None, vace_model=None, attention_chunk_size=1024, ffn_chunk_size=0):
         assert not (vram_management_args is not None and block_swap_args is not None), "Can't use both block_swap_args and vram_management_args at the same time"
         lora_low_mem_load = False
         if lora is not None:
@@ -499,11 +581,8 @@ class WanVideoModelLoader:
         mm.cleanup_models()
         mm.soft_empty_cache()
         manual_offloading = True
-        if "sage" in attention_mode:
-            try:
-                from sageattention import sageattn
-            except Exception as e:
-                raise ValueError(f"Can't import SageAttention: {str(e)}")
+        if attention_mode != "auto" and not ATTENTION_BACKENDS[attention_mode].available:
+            raise ValueError(f"Can't use {attention_mode}: {ATTENTION_BACKENDS[attention_mode].error}")
 
         device = mm.get_torch_device()
         offload_device = mm.unet_offload_device()
@@ -593,6 +672,13 @@ class WanVideoModelLoader:
         if dim == 1536:
             model_variant = "1_3B"
         log.info(f"Model variant detected: {model_variant}")
+
+        teacache_coefficients = teacache_coefficients_map[model_variant]
+        teacache_model_hash = model_hash(sd)
+        teacache_profile = load_teacache_profile(teacache_model_hash)
+        if teacache_profile is not None and teacache_profile["coefficients"]:
+            log.info(f"Using calibrated TeaCache coefficients from {profile_path(teacache_model_hash)}")
+            teacache_coefficients = {**teacache_coefficients, **teacache_profile["coefficients"]}
         
         TRANSFORMER_CONFIG= {
             "dim": dim,
@@ -608,7 +694,7 @@ class WanVideoModelLoader:
             "attention_mode": attention_mode,
             "main_device": device,
             "offload_device": offload_device,
-            "teacache_coefficients": teacache_coefficients_map[model_variant],
+            "teacache_coefficients": teacache_coefficients,
             "vace_layers": vace_layers,
             "vace_in_dim": vace_in_dim
         }
@@ -616,6 +702,15 @@ class WanVideoModelLoader:
         with init_empty_weights():
             transformer = WanModel(**TRANSFORMER_CONFIG)
         transformer.eval()
+        transformer.model_hash = teacache_model_hash
+        if attention_mode in ("sdpa_chunked", "auto"):
+            for module in transformer.modules():
+                if isinstance(module, WanSelfAttention):
+                    module.attention_chunk_size = attention_chunk_size
+        if ffn_chunk_size > 0:
+            for module in transformer.modules():
+                if isinstance(module, WanAttentionBlock):
+                    module.ffn_chunk_size = ffn_chunk_size
 
         comfy_model = WanVideoModel(
             WanVideoModelConfig(base_dtype),
@@ -2039,6 +2134,7 @@ class WanVideoContextOptions:
                 "image_cond_start_step": ("INT", {"default": 6, "min": 0, "max": 10000, "step": 1, "tooltip": "!EXPERIMENTAL! Start step of using previous window results as input instead of the init image"}),
                 "image_cond_window_count": ("INT", {"default": 2, "min": 1, "max": 10000, "step": 1, "tooltip": "!EXPERIMENTAL! Number of image 'prompt windows'"}),
                 "vae": ("WANVAE",),
+                "window_batch_size": ("INT", {"default": 1, "min": 1, "max": 64, "step": 1, "tooltip": "Number of equal length context windows to run through the model in one batch, uses more VRAM. Only used for text to video without VACE"}),
             }
         }
 
@@ -2048,7 +2144,7 @@ class WanVideoContextOptions:
     CATEGORY = "WanVideoWrapper"
     DESCRIPTION = "Context options for WanVideo, allows splitting the video into context windows and attemps blending them for longer generations than the model and memory otherwise would allow."
 
-    def process(self, context_schedule, context_frames, context_stride, context_overlap, freenoise, verbose, image_cond_start_step=6, image_cond_window_count=2, vae=None):
+    def process(self, context_schedule, context_frames, context_stride, context_overlap, freenoise, verbose, image_cond_start_step=6, image_cond_window_count=2, vae=None, window_batch_size=1):
         context_options = {
             "context_schedule":context_schedule,
             "context_frames":context_frames,
@@ -2059,6 +2155,7 @@ class WanVideoContextOptions:
             "image_cond_start_step": image_cond_start_step,
             "image_cond_window_count": image_cond_window_count,
             "vae": vae,
+            "window_batch_size": window_batch_size,
         }
 
         return (context_options,)
@@ -2107,6 +2204,133 @@ class WanVideoLoopArgs:
     def process(self, **kwargs):
         return (kwargs,)
 
+class WanVideoBatchArgs:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+                "batch_count": ("INT", {"default": 1, "min": 1, "max": 1024, "tooltip": "Number of videos to sample together, seeded with seed, seed+1, ... unless seeds are given"}),
+                "seeds": ("STRING", {"default": "", "tooltip": "Comma separated seeds, one per video, overrides the sampler seed and batch_count"}),
+                "prompt_per_video": ("BOOLEAN", {"default": False, "tooltip": "Use each prompt of the text embeds for its own video instead of one prompt for all"}),
+                "micro_batch_size": ("INT", {"default": 0, "min": 0, "max": 1024, "tooltip": "Number of videos per model forward to fit in memory, 0 runs all of them at once"}),
+            },
+        }
+
+    RETURN_TYPES = ("BATCHARGS", )
+    RETURN_NAMES = ("batch_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = "Sample several seeds and/or prompts for the same conditioning in one sampler run, text to video only"
+
+    def process(self, **kwargs):
+        return (kwargs,)
+
+class WanVideoCheckpointArgs:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+                "checkpoint_dir": ("STRING", {"default": "wanvideo_checkpoints", "tooltip": "Directory for the sampling checkpoint, relative paths are inside the ComfyUI output directory. Use a separate directory per job"}),
+                "save_every": ("INT", {"default": 5, "min": 1, "max": 10000, "tooltip": "Save the sampling state every N steps"}),
+                "resume": ("BOOLEAN", {"default": True, "tooltip": "Continue from the checkpoint in the directory if there is one, the result is the same as an uninterrupted run"}),
+            },
+        }
+
+    RETURN_TYPES = ("CHECKPOINTARGS", )
+    RETURN_NAMES = ("checkpoint_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = "Periodically saves the latent, scheduler and cache state during sampling so a crashed or interrupted run can be resumed"
+
+    def process(self, checkpoint_dir, save_every, resume):
+        if not os.path.isabs(checkpoint_dir):
+            checkpoint_dir = os.path.join(folder_paths.get_output_directory(), checkpoint_dir)
+        return ({"checkpoint_dir": checkpoint_dir, "save_every": save_every, "resume": resume},)
+
+class WanVideoCFGCacheArgs:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+                "interval": ("INT", {"default": 2, "min": 1, "max": 100, "step": 1, "tooltip": "Compute the uncond prediction at least every N steps, in between it's estimated from the cond prediction. 1 disables the cache"}),
+                "drift_threshold": ("FLOAT", {"default": 0.1, "min": 0.0, "max": 10.0, "step": 0.001, "tooltip": "Compute uncond early when the cond prediction changed more than this (relative L1) since uncond was last computed. 0 to only use the interval"}),
+                "start_step": ("INT", {"default": 2, "min": 0, "max": 9999, "step": 1, "tooltip": "First step where uncond can be reused"}),
+                "end_step": ("INT", {"default": -1, "min": -1, "max": 9999, "step": 1, "tooltip": "Last step where uncond can be reused, -1 for the last step"}),
+            },
+        }
+
+    RETURN_TYPES = ("CFGCACHEARGS", )
+    RETURN_NAMES = ("cfg_cache_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = "Skips the unconditional pass on some steps by reusing the last uncond prediction, shifted by the change of the cond prediction. Works with cfg schedules, batched cfg and SLG"
+
+    def process(self, **kwargs):
+        return (kwargs,)
+
+class WanVideoAdaptiveGuidanceArgs:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+                "metric": (["cosine", "rel_l1"], {"default": "cosine", "tooltip": "How the cond and uncond predictions are compared, cosine similarity or relative L1 distance"}),
+                "threshold": ("FLOAT", {"default": 0.99, "min": 0.0, "max": 10.0, "step": 0.0001, "tooltip": "Predictions count as converged when the cosine similarity is at least this, or the relative L1 at most this"}),
+                "consecutive_steps": ("INT", {"default": 3, "min": 1, "max": 100, "step": 1, "tooltip": "Converged steps in a row needed before switching to cond only"}),
+                "start_step": ("INT", {"default": 0, "min": 0, "max": 9999, "step": 1, "tooltip": "First step that counts towards convergence"}),
+            },
+        }
+
+    RETURN_TYPES = ("ADAPTIVEGUIDANCEARGS", )
+    RETURN_NAMES = ("adaptive_guidance_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = "Switches to cond only for the rest of the run once the cond and uncond predictions converge, per context window. Decisions are logged every step"
+
+    def process(self, **kwargs):
+        return (kwargs,)
+
+class WanVideoLocalAttentionArgs:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+                "temporal_radius": ("INT", {"default": 2, "min": 0, "max": 100, "step": 1, "tooltip": "Latent frames before and after each token it attends to"}),
+                "tile_height": ("INT", {"default": 16, "min": 1, "max": 256, "step": 1, "tooltip": "Height of the query tiles in latent tokens (patches), each tile attends to its tile grown by half a tile on every side"}),
+                "tile_width": ("INT", {"default": 16, "min": 1, "max": 256, "step": 1, "tooltip": "Width of the query tiles in latent tokens (patches)"}),
+                "start_block": ("INT", {"default": 0, "min": 0, "max": 100, "step": 1, "tooltip": "First block using local attention"}),
+                "end_block": ("INT", {"default": -1, "min": -1, "max": 100, "step": 1, "tooltip": "Last block using local attention, -1 for the last block"}),
+                "start_step": ("INT", {"default": 10, "min": 0, "max": 9999, "step": 1, "tooltip": "First step using local attention, the steps before use full attention"}),
+                "end_step": ("INT", {"default": -1, "min": -1, "max": 9999, "step": 1, "tooltip": "Last step using local attention, -1 for the last step"}),
+            },
+        }
+
+    RETURN_TYPES = ("LOCALATTENTIONARGS", )
+    RETURN_NAMES = ("local_attention_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = "Self attention over a local spatio-temporal neighbourhood of each token instead of the whole video, in the chosen blocks and steps. The cost grows linearly with the video length and resolution instead of quadratically"
+    EXPERIMENTAL = True
+
+    def process(self, **kwargs):
+        return (kwargs,)
+
+class WanVideoTokenMergeArgs:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+                "ratio": ("FLOAT", {"default": 0.3, "min": 0.0, "max": 0.75, "step": 0.01, "tooltip": "Share of the tokens merged into a similar token of the same 2x2 patch in the same or an adjacent frame, up to 0.75"}),
+                "start_block": ("INT", {"default": 5, "min": 0, "max": 100, "step": 1, "tooltip": "First block merging tokens"}),
+                "end_block": ("INT", {"default": 24, "min": -1, "max": 100, "step": 1, "tooltip": "Last block merging tokens, -1 for the last block"}),
+                "start_step": ("INT", {"default": 0, "min": 0, "max": 9999, "step": 1, "tooltip": "First step merging tokens"}),
+                "end_step": ("INT", {"default": -1, "min": -1, "max": 9999, "step": 1, "tooltip": "Last step merging tokens, -1 for the last step"}),
+            },
+        }
+
+    RETURN_TYPES = ("TOKENMERGEARGS", )
+    RETURN_NAMES = ("token_merge_args",)
+    FUNCTION = "process"
+    CATEGORY = "WanVideoWrapper"
+    DESCRIPTION = "ToMe style token merging: similar tokens are averaged before self attention and the FFN of the chosen blocks and get the same update back afterwards. Merged tokens keep the RoPE position of the token they merged into"
+    EXPERIMENTAL = True
+
+    def process(self, **kwargs):
+        return (kwargs,)
+
 class WanVideoExperimentalArgs:
     @classmethod
     def INPUT_TYPES(s):
@@ -2116,6 +2340,12 @@ class WanVideoExperimentalArgs:
                 "use_zero_init": ("BOOLEAN", {"default": True}),
                 "zero_star_steps": ("INT", {"default": 0, "min": 0, "tooltip": "Steps to split self attention when using multiple prompts"}),
             },
+            "optional": {
+                "cross_attn_kv_cache": ("BOOLEAN", {"default": False, "tooltip": "Compute the text/clip embeddings and cross-attention keys/values once per prompt and reuse them on every step, faster but keeps them in VRAM for the whole run"}),
+                "cond_embedding_cache": ("BOOLEAN", {"default": False, "tooltip": "Patch embed the constant image/control conditioning once per context window instead of every step, faster but keeps the embedding in VRAM for the whole run"}),
+                "trim_text_context": ("BOOLEAN", {"default": False, "tooltip": "Attend only over the actual prompt tokens instead of the prompt zero padded to 512 tokens, faster cross-attention but slightly changes the results"}),
+                "residual_precision": (["fp32", "bf16", "fp16"], {"default": "fp32", "tooltip": "Precision of the residual stream between and inside the transformer blocks. bf16/fp16 skip the float32 upcasts at every block for less memory traffic, but round the residual additions. fp16 can overflow"}),
+            },
         }
 
     RETURN_TYPES = ("EXPERIMENTALARGS", )
@@ -2162,6 +2392,12 @@ class WanVideoSampler:
                 "rope_function": (["default", "comfy"], {"default": "comfy", "tooltip": "Comfy's RoPE implementation doesn't use complex numbers and can thus be compiled, that should be a lot faster when using torch.compile"}),
                 "loop_args": ("LOOPARGS", ),
                 "experimental_args": ("EXPERIMENTALARGS", ),
+                "batch_args": ("BATCHARGS", ),
+                "checkpoint_args": ("CHECKPOINTARGS", ),
+                "cfg_cache_args": ("CFGCACHEARGS", ),
+                "adaptive_guidance_args": ("ADAPTIVEGUIDANCEARGS", ),
+                "local_attention_args": ("LOCALATTENTIONARGS", ),
+                "token_merge_args": ("TOKENMERGEARGS", ),
             }
         }
 
@@ -2172,842 +2408,12 @@ class WanVideoSampler:
 
     def process(self, model, text_embeds, image_embeds, shift, steps, cfg, seed, scheduler, riflex_freq_index, 
         force_offload=True, samples=None, feta_args=None, denoise_strength=1.0, context_options=None, 
-        teacache_args=None, flowedit_args=None, batched_cfg=False, slg_args=None, rope_function="default", loop_args=None, experimental_args=None):
-        #assert not (context_options and teacache_args), "Context options cannot currently be used together with teacache."
-        patcher = model
-        model = model.model
-        transformer = model.diffusion_model
-
-        control_lora = model["control_lora"]
-
-        device = mm.get_torch_device()
-        offload_device = mm.unet_offload_device()
-        
-        steps = int(steps/denoise_strength)
-
-        scheduler_args = {
-            "num_train_timesteps": 1000,
-            "shift": shift,
-            "use_dynamic_shifting": False,
-        }
-
-        timesteps = None
-        if scheduler == 'unipc':
-            sample_scheduler = FlowUniPCMultistepScheduler(**scheduler_args)
-            sample_scheduler.set_timesteps(steps, device=device, shift=shift)
-        elif scheduler in ['euler/beta', 'euler']:
-            sample_scheduler = FlowMatchEulerDiscreteScheduler(**scheduler_args, use_beta_sigmas=(scheduler == 'euler/beta'))
-            if flowedit_args: #seems to work better
-                timesteps, _ = retrieve_timesteps(sample_scheduler, device=device, sigmas=get_sampling_sigmas(steps, shift))
-            else:
-                sample_scheduler.set_timesteps(steps, device=device, mu=1)  
-        elif 'dpm++' in scheduler:
-            if scheduler == 'dpm++_sde':
-                algorithm_type = "sde-dpmsolver++"
-            else:
-                algorithm_type = "dpmsolver++"
-            sample_scheduler = FlowDPMSolverMultistepScheduler(**scheduler_args, algorithm_type= algorithm_type)
-            sample_scheduler.set_timesteps(steps, device=device, mu=1)
-        
-        if timesteps is None:
-            timesteps = sample_scheduler.timesteps
-        
-        if denoise_strength < 1.0:
-            steps = int(steps * denoise_strength)
-            timesteps = timesteps[-(steps + 1):] 
-        
-        seed_g = torch.Generator(device=torch.device("cpu"))
-        seed_g.manual_seed(seed)
-       
-        control_latents, clip_fea, clip_fea_neg, end_image = None, None, None, None
-        vace_data, vace_context, vace_scale = None, None, None
-        fun_model, has_ref, drop_last = False, False, False
-
-        image_cond = image_embeds.get("image_embeds", None)
-       
-        if image_cond is not None:
-            end_image = image_embeds.get("end_image", None)
-            lat_h = image_embeds.get("lat_h", None)
-            lat_w = image_embeds.get("lat_w", None)
-            if lat_h is None or lat_w is None:
-                raise ValueError("Clip encoded image embeds must be provided for I2V (Image to Video) model")
-            fun_model = image_embeds.get("fun_model", False)
-            noise = torch.randn(
-                16,
-                (image_embeds["num_frames"] - 1) // 4 + (2 if end_image is not None and not fun_model else 1),
-                lat_h,
-                lat_w,
-                dtype=torch.float32,
-                generator=seed_g,
-                device=torch.device("cpu"))
-            seq_len = image_embeds["max_seq_len"]
-            image_cond = image_embeds.get("image_embeds", None)
-            print("image_cond", image_cond.shape)
-            clip_fea = image_embeds.get("clip_context", None)
-            clip_fea_neg = image_embeds.get("negative_clip_context", None)
-
-            control_embeds = image_embeds.get("control_embeds", None)
-            if control_embeds is not None:
-                if transformer.in_dim != 48:
-                    raise ValueError("Control signal only works with Fun-Control model")
-                control_latents = control_embeds["control_images"].to(device)
-                control_start_percent = control_embeds.get("start_percent", 0.0)
-                control_end_percent = control_embeds.get("end_percent", 1.0)
-            drop_last = image_embeds.get("drop_last", False)
-            has_ref = image_embeds.get("has_ref", False)
-        else: #t2v
-            target_shape = image_embeds.get("target_shape", None)
-            if target_shape is None:
-                raise ValueError("Empty image embeds must be provided for T2V (Text to Video")
-            
-            has_ref = image_embeds.get("has_ref", False)
-            vace_context = image_embeds.get("vace_context", None)
-            vace_scale = image_embeds.get("vace_scale", None)
-            vace_start_percent = image_embeds.get("vace_start_percent", 0.0)
-            vace_end_percent = image_embeds.get("vace_end_percent", 1.0)
-            vace_seqlen = image_embeds.get("vace_seq_len", None)
-
-            vace_additional_embeds = image_embeds.get("additional_vace_inputs", [])
-            if vace_context is not None:
-                vace_data = [
-                    {"context": vace_context, 
-                     "scale": vace_scale, 
-                     "start": vace_start_percent, 
-                     "end": vace_end_percent,
-                     "seq_len": vace_seqlen
-                     }
-                ]
-                if len(vace_additional_embeds) > 0:
-                    for i in range(len(vace_additional_embeds)):
-                        vace_data.append({
-                            "context": vace_additional_embeds[i]["vace_context"],
-                            "scale": vace_additional_embeds[i]["vace_scale"],
-                            "start": vace_additional_embeds[i]["vace_start_percent"],
-                            "end": vace_additional_embeds[i]["vace_end_percent"],
-                            "seq_len": vace_additional_embeds[i]["vace_seq_len"]
-                        })
-
-            noise = torch.randn(
-                    target_shape[0],
-                    target_shape[1] + 1 if has_ref else target_shape[1],
-                    target_shape[2],
-                    target_shape[3],
-                    dtype=torch.float32,
-                    device=torch.device("cpu"),
-                    generator=seed_g)
-            
-            seq_len = math.ceil((noise.shape[2] * noise.shape[3]) / 4 * noise.shape[1])
-            
-            control_embeds = image_embeds.get("control_embeds", None)
-            if control_embeds is not None:
-                control_latents = control_embeds["control_images"].to(device)
-                if control_lora:
-                    image_cond = control_latents.to(device)
-                    if not patcher.model.is_patched:
-                        log.info("Re-loading control LoRA...")
-                        patcher = apply_lora(patcher, device, device, low_mem_load=False)
-                        patcher.model.is_patched = True
-                else:
-                    if transformer.in_dim != 48:
-                        raise ValueError("Control signal only works with Fun-Control model")
-                    image_cond = torch.zeros_like(control_latents).to(device) #fun control
-                    clip_fea = None
-                
-                control_start_percent = control_embeds.get("start_percent", 0.0)
-                control_end_percent = control_embeds.get("end_percent", 1.0)
-            else:
-                if transformer.in_dim == 36: #fun inp
-                    mask_latents = torch.tile(
-                        torch.zeros_like(noise[:1]), [4, 1, 1, 1]
-                    )
-                    masked_video_latents_input = torch.zeros_like(noise)
-                    image_cond = torch.cat([mask_latents, masked_video_latents_input], dim=0).to(device)
-            
-        latent_video_length = noise.shape[1]
-
-        is_looped = False
-        if context_options is not None:
-            def create_window_mask(noise_pred_context, c, latent_video_length, context_overlap, looped=False):
-                window_mask = torch.ones_like(noise_pred_context)
-                
-                # Apply left-side blending for all except first chunk (or always in loop mode)
-                if min(c) > 0 or (looped and max(c) == latent_video_length - 1):
-                    ramp_up = torch.linspace(0, 1, context_overlap, device=noise_pred_context.device)
-                    ramp_up = ramp_up.view(1, -1, 1, 1)
-                    window_mask[:, :context_overlap] = ramp_up
-                    
-                # Apply right-side blending for all except last chunk (or always in loop mode)
-                if max(c) < latent_video_length - 1 or (looped and min(c) == 0):
-                    ramp_down = torch.linspace(1, 0, context_overlap, device=noise_pred_context.device)
-                    ramp_down = ramp_down.view(1, -1, 1, 1)
-                    window_mask[:, -context_overlap:] = ramp_down
-                    
-                return window_mask
-            
-            context_schedule = context_options["context_schedule"]
-            context_frames =  (context_options["context_frames"] - 1) // 4 + 1
-            context_stride = context_options["context_stride"] // 4
-            context_overlap = context_options["context_overlap"] // 4
-            context_vae = context_options.get("vae", None)
-            if context_vae is not None:
-                context_vae.to(device)
-
-            self.window_tracker = WindowTracker(verbose=context_options["verbose"])
-
-            # Get total number of prompts
-            num_prompts = len(text_embeds["prompt_embeds"])
-            log.info(f"Number of prompts: {num_prompts}")
-            # Calculate which section this context window belongs to
-            section_size = latent_video_length / num_prompts
-            log.info(f"Section size: {section_size}")
-            is_looped = context_schedule == "uniform_looped"
-
-            seq_len = math.ceil((noise.shape[2] * noise.shape[3]) / 4 * context_frames)
-
-            if context_options["freenoise"]:
-                log.info("Applying FreeNoise")
-                # code from AnimateDiff-Evolved by Kosinkadink (https://github.com/Kosinkadink/ComfyUI-AnimateDiff-Evolved)
-                delta = context_frames - context_overlap
-                for start_idx in range(0, latent_video_length-context_frames, delta):
-                    place_idx = start_idx + context_frames
-                    if place_idx >= latent_video_length:
-                        break
-                    end_idx = place_idx - 1
-
-                    if end_idx + delta >= latent_video_length:
-                        final_delta = latent_video_length - place_idx
-                        list_idx = torch.tensor(list(range(start_idx,start_idx+final_delta)), device=torch.device("cpu"), dtype=torch.long)
-                        list_idx = list_idx[torch.randperm(final_delta, generator=seed_g)]
-                        noise[:, place_idx:place_idx + final_delta, :, :] = noise[:, list_idx, :, :]
-                        break
-                    list_idx = torch.tensor(list(range(start_idx,start_idx+delta)), device=torch.device("cpu"), dtype=torch.long)
-                    list_idx = list_idx[torch.randperm(delta, generator=seed_g)]
-                    noise[:, place_idx:place_idx + delta, :, :] = noise[:, list_idx, :, :]
-            
-            log.info(f"Context schedule enabled: {context_frames} frames, {context_stride} stride, {context_overlap} overlap")
-            from .context import get_context_scheduler
-            context = get_context_scheduler(context_schedule)
-
-        if samples is not None and denoise_strength < 1.0:
-            latent_timestep = timesteps[:1].to(noise)
-            input_samples = samples["samples"].squeeze(0).to(noise)
-            if input_samples.shape[1] != noise.shape[1]:
-                input_samples = torch.cat([input_samples[:, :1].repeat(1, noise.shape[1] - input_samples.shape[1], 1, 1), input_samples], dim=1)
-            noise = noise * latent_timestep / 1000 + (1 - latent_timestep / 1000) * input_samples
-
-        if samples is not None:
-            original_image = samples["samples"].clone().squeeze(0).to(device)
-            mask = samples.get("mask", None)
-
-        latent = noise.to(device)
-
-        freqs = None
-        transformer.rope_embedder.k = None
-        transformer.rope_embedder.num_frames = None
-        if rope_function=="comfy":
-            transformer.rope_embedder.k = riflex_freq_index
-            transformer.rope_embedder.num_frames = latent_video_length
-        else:
-            d = transformer.dim // transformer.num_heads
-            freqs = torch.cat([
-                rope_params(1024, d - 4 * (d // 6), L_test=latent_video_length, k=riflex_freq_index),
-                rope_params(1024, 2 * (d // 6)),
-                rope_params(1024, 2 * (d // 6))
-            ],
-            dim=1)
-
-        if not isinstance(cfg, list):
-            cfg = [cfg] * (steps +1)
-
-        print("Seq len:", seq_len)
-           
-        pbar = ProgressBar(steps)
-
-        if args.preview_method in [LatentPreviewMethod.Auto, LatentPreviewMethod.Latent2RGB]: #default for latent2rgb
-            from latent_preview import prepare_callback
-        else:
-            from .latent_preview import prepare_callback #custom for tiny VAE previews
-        callback = prepare_callback(patcher, steps)
-
-        #blockswap init        
-        transformer_options = patcher.model_options.get("transformer_options", None)
-        if transformer_options is not None:
-            block_swap_args = transformer_options.get("block_swap_args", None)
-
-        if block_swap_args is not None:
-            transformer.use_non_blocking = block_swap_args.get("use_non_blocking", True)
-            for name, param in transformer.named_parameters():
-                if "block" not in name:
-                    param.data = param.data.to(device)
-                elif block_swap_args["offload_txt_emb"] and "txt_emb" in name:
-                    param.data = param.data.to(offload_device, non_blocking=transformer.use_non_blocking)
-                elif block_swap_args["offload_img_emb"] and "img_emb" in name:
-                    param.data = param.data.to(offload_device, non_blocking=transformer.use_non_blocking)
-
-            transformer.block_swap(
-                block_swap_args["blocks_to_swap"] - 1 ,
-                block_swap_args["offload_txt_emb"],
-                block_swap_args["offload_img_emb"],
-                vace_blocks_to_swap = block_swap_args.get("vace_blocks_to_swap", None),
-            )
-
-        elif model["auto_cpu_offload"]:
-            for module in transformer.modules():
-                if hasattr(module, "offload"):
-                    module.offload()
-                if hasattr(module, "onload"):
-                    module.onload()
-        elif model["manual_offloading"]:
-            transformer.to(device)
-        #feta
-        if feta_args is not None and latent_video_length > 1:
-            set_enhance_weight(feta_args["weight"])
-            feta_start_percent = feta_args["start_percent"]
-            feta_end_percent = feta_args["end_percent"]
-            if context_options is not None:
-                set_num_frames(context_frames)
-            else:
-                set_num_frames(latent_video_length)
-            enable_enhance()
-        else:
-            feta_args = None
-            disable_enhance()
-
-        # Initialize TeaCache if enabled
-        if teacache_args is not None:
-            transformer.enable_teacache = True
-            transformer.rel_l1_thresh = teacache_args["rel_l1_thresh"]
-            transformer.teacache_start_step = teacache_args["start_step"]
-            transformer.teacache_cache_device = teacache_args["cache_device"]
-            transformer.teacache_end_step = len(timesteps)-1 if teacache_args["end_step"] == -1 else teacache_args["end_step"]
-            transformer.teacache_use_coefficients = teacache_args["use_coefficients"]
-            transformer.teacache_mode = teacache_args["mode"]
-            transformer.teacache_state.clear_all()
-        else:
-            transformer.enable_teacache = False
-
-        if slg_args is not None:
-            assert batched_cfg is not None, "Batched cfg is not supported with SLG"
-            transformer.slg_blocks = slg_args["blocks"]
-            transformer.slg_start_percent = slg_args["start_percent"]
-            transformer.slg_end_percent = slg_args["end_percent"]
-        else:
-            transformer.slg_blocks = None
-
-        self.teacache_state = [None, None]
-        self.teacache_state_source = [None, None]
-        self.teacache_states_context = []
-
-        if flowedit_args is not None:
-            source_embeds = flowedit_args["source_embeds"]
-            source_image_embeds = flowedit_args.get("source_image_embeds", image_embeds)
-            source_image_cond = source_image_embeds.get("image_embeds", None)
-            source_clip_fea = source_image_embeds.get("clip_fea", clip_fea)
-            skip_steps = flowedit_args["skip_steps"]
-            drift_steps = flowedit_args["drift_steps"]
-            source_cfg = flowedit_args["source_cfg"]
-            if not isinstance(source_cfg, list):
-                source_cfg = [source_cfg] * (steps +1)
-            drift_cfg = flowedit_args["drift_cfg"]
-            if not isinstance(drift_cfg, list):
-                drift_cfg = [drift_cfg] * (steps +1)
-
-            x_init = samples["samples"].clone().squeeze(0).to(device)
-            x_tgt = samples["samples"].squeeze(0).to(device)
-
-            sample_scheduler = FlowMatchEulerDiscreteScheduler(
-                num_train_timesteps=1000,
-                shift=flowedit_args["drift_flow_shift"],
-                use_dynamic_shifting=False)
-
-            sampling_sigmas = get_sampling_sigmas(steps, flowedit_args["drift_flow_shift"])
-           
-            drift_timesteps, _ = retrieve_timesteps(
-                sample_scheduler,
-                device=device,
-                sigmas=sampling_sigmas)
-
-            if drift_steps > 0:
-                drift_timesteps = torch.cat([drift_timesteps, torch.tensor([0]).to(drift_timesteps.device)]).to(drift_timesteps.device)
-                timesteps[-drift_steps:] = drift_timesteps[-drift_steps:]
-
-        use_cfg_zero_star = False
-        if experimental_args is not None:
-            video_attention_split_steps = experimental_args.get("video_attention_split_steps", [])
-            if video_attention_split_steps:
-                transformer.video_attention_split_steps = [int(x.strip()) for x in video_attention_split_steps.split(",")]
-            else:
-                transformer.video_attention_split_steps = []
-            use_zero_init = experimental_args.get("use_zero_init", True)
-            use_cfg_zero_star = experimental_args.get("cfg_zero_star", False)
-            zero_star_steps = experimental_args.get("zero_star_steps", 0)
-
-        #region model pred
-        def predict_with_cfg(z, cfg_scale, positive_embeds, negative_embeds, timestep, idx, image_cond=None, clip_fea=None, control_latents=None, vace_data=None, teacache_state=None):
-            with torch.autocast(device_type=mm.get_autocast_device(device), dtype=model["dtype"], enabled=True):
-
-                if use_cfg_zero_star and (idx <= zero_star_steps) and use_zero_init:
-                    return latent_model_input*0, None
-
-                nonlocal patcher
-                current_step_percentage = idx / len(timesteps)
-                control_lora_enabled = False
-                image_cond_input = None
-                if control_latents is not None:
-                    if control_lora:
-                        control_lora_enabled = True
-                    else:
-                        if (control_start_percent <= current_step_percentage <= control_end_percent) or \
-                            (control_end_percent > 0 and idx == 0 and current_step_percentage >= control_start_percent):
-                            image_cond_input = torch.cat([control_latents, image_cond])
-                        else:
-                            image_cond_input = torch.cat([torch.zeros_like(image_cond), image_cond])
-
-                    if control_lora:
-                        if not control_start_percent <= current_step_percentage <= control_end_percent:
-                            control_lora_enabled = False
-                            if patcher.model.is_patched:
-                                log.info("Unloading LoRA...")
-                                patcher.unpatch_model(device)
-                                patcher.model.is_patched = False
-                        else:
-                            image_cond_input = control_latents.to(device)
-                            if not patcher.model.is_patched:
-                                log.info("Loading LoRA...")
-                                patcher = apply_lora(patcher, device, device, low_mem_load=False)
-                                patcher.model.is_patched = True
-                else:
-                    image_cond_input = image_cond
-    
-                base_params = {
-                    'seq_len': seq_len,
-                    'device': device,
-                    'freqs': freqs,
-                    't': timestep,
-                    'current_step': idx,
-                    'y': [image_cond_input] if image_cond_input is not None else None,
-                    'control_lora_enabled': control_lora_enabled,
-                    'vace_data': vace_data if vace_data is not None else None,
-                }
-
-                batch_size = 1
-
-                if not math.isclose(cfg_scale, 1.0) and len(positive_embeds) > 1:
-                    negative_embeds = negative_embeds * len(positive_embeds)
-
-                if not batched_cfg:
-                    #cond
-                    noise_pred_cond, teacache_state_cond = transformer(
-                        [z], context=positive_embeds, clip_fea=clip_fea, is_uncond=False, current_step_percentage=current_step_percentage,
-                        pred_id=teacache_state[0] if teacache_state else None,
-                        **base_params
-                    )
-                    noise_pred_cond = noise_pred_cond[0].to(intermediate_device)
-                    if math.isclose(cfg_scale, 1.0):
-                        return noise_pred_cond, [teacache_state_cond]
-                    #uncond
-                    noise_pred_uncond, teacache_state_uncond = transformer(
-                        [z], context=negative_embeds, clip_fea=clip_fea_neg if clip_fea_neg is not None else clip_fea, 
-                        is_uncond=True, current_step_percentage=current_step_percentage,
-                        pred_id=teacache_state[1] if teacache_state else None,
-                        **base_params
-                    )
-                    noise_pred_uncond = noise_pred_uncond[0].to(intermediate_device)
-                #batched
-                else:
-                    teacache_state_uncond = None
-                    [noise_pred_cond, noise_pred_uncond], teacache_state_cond = transformer(
-                        [z] + [z], context=positive_embeds + negative_embeds, clip_fea=clip_fea, is_uncond=False, current_step_percentage=current_step_percentage,
-                        pred_id=teacache_state[0] if teacache_state else None,
-                        **base_params
-                    )
-                #cfg
-
-                #https://github.com/WeichenFan/CFG-Zero-star/
-                if use_cfg_zero_star:
-                    alpha = optimized_scale(
-                        noise_pred_cond.view(batch_size, -1),
-                        noise_pred_uncond.view(batch_size, -1)
-                    ).view(batch_size, 1, 1, 1)
-                    noise_pred = noise_pred_uncond * alpha + cfg_scale * (noise_pred_cond - noise_pred_uncond * alpha)
-                else:
-                    noise_pred = noise_pred_uncond + cfg_scale * (noise_pred_cond - noise_pred_uncond)
-
-                return noise_pred, [teacache_state_cond, teacache_state_uncond]
-
-        log.info(f"Sampling {(latent_video_length-1) * 4 + 1} frames at {latent.shape[3]*8}x{latent.shape[2]*8} with {steps} steps")
-
-        intermediate_device = device
-
-        # diff diff prep
-        masks = None
-        if samples is not None and mask is not None:
-            mask = 1 - mask
-            thresholds = torch.arange(len(timesteps), dtype=original_image.dtype) / len(timesteps)
-            thresholds = thresholds.unsqueeze(1).unsqueeze(1).unsqueeze(1).unsqueeze(1).to(device)
-            masks = mask.repeat(len(timesteps), 1, 1, 1, 1).to(device) 
-            masks = masks > thresholds
-
-        latent_shift_loop = False
-        if loop_args is not None:
-            latent_shift_loop = True
-            is_looped = True
-            latent_skip = loop_args["shift_skip"]
-            latent_shift_start_percent = loop_args["start_percent"]
-            latent_shift_end_percent = loop_args["end_percent"]
-            shift_idx = 0
-
-        #clear memory before sampling
-        mm.unload_all_models()
-        mm.soft_empty_cache()
-        gc.collect()
-        try:
-            torch.cuda.reset_peak_memory_stats(device)
-        except:
-            pass
-
-        #region main loop start
-        for idx, t in enumerate(tqdm(timesteps)):    
-            if flowedit_args is not None:
-                if idx < skip_steps:
-                    continue
-
-            # diff diff
-            if masks is not None:
-                if idx < len(timesteps) - 1:
-                    noise_timestep = timesteps[idx+1]
-                    image_latent = sample_scheduler.scale_noise(
-                        original_image, torch.tensor([noise_timestep]), noise.to(device)
-                    )
-                    mask = masks[idx]
-                    mask = mask.to(latent)
-                    latent = image_latent * mask + latent * (1-mask)
-                    # end diff diff
-
-            latent_model_input = latent.to(device)
-
-            timestep = torch.tensor([t]).to(device)
-            current_step_percentage = idx / len(timesteps)
-
-            ### latent shift
-            if latent_shift_loop:
-                if latent_shift_start_percent <= current_step_percentage <= latent_shift_end_percent:
-                    latent_model_input = torch.cat([latent_model_input[:, shift_idx:]] + [latent_model_input[:, :shift_idx]], dim=1)
-
-            #enhance-a-video
-            if feta_args is not None:
-                if feta_start_percent <= current_step_percentage <= feta_end_percent:
-                    enable_enhance()
-                else:
-                    disable_enhance()
-            #flow-edit
-            if flowedit_args is not None:
-                sigma = t / 1000.0
-                sigma_prev = (timesteps[idx + 1] if idx < len(timesteps) - 1 else timesteps[-1]) / 1000.0
-                noise = torch.randn(x_init.shape, generator=seed_g, device=torch.device("cpu"))
-                if idx < len(timesteps) - drift_steps:
-                    cfg = drift_cfg
-                
-                zt_src = (1-sigma) * x_init + sigma * noise.to(t)
-                zt_tgt = x_tgt + zt_src - x_init
-
-                #source
-                if idx < len(timesteps) - drift_steps:
-                    if context_options is not None:
-                        counter = torch.zeros_like(zt_src, device=intermediate_device)
-                        vt_src = torch.zeros_like(zt_src, device=intermediate_device)
-                        context_queue = list(context(idx, steps, latent_video_length, context_frames, context_stride, context_overlap))
-                        for c in context_queue:
-                            window_id = self.window_tracker.get_window_id(c)
-
-                            if teacache_args is not None:
-                                current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
-                            else:
-                                current_teacache = None
-
-                            prompt_index = min(int(max(c) / section_size), num_prompts - 1)
-                            if context_options["verbose"]:
-                                log.info(f"Prompt index: {prompt_index}")
-
-                            if len(source_embeds["prompt_embeds"]) > 1:
-                                positive = source_embeds["prompt_embeds"][prompt_index]
-                            else:
-                                positive = source_embeds["prompt_embeds"]
-
-                            partial_img_emb = None
-                            if source_image_cond is not None:
-                                partial_img_emb = source_image_cond[:, c, :, :]
-                                partial_img_emb[:, 0, :, :] = source_image_cond[:, 0, :, :].to(intermediate_device)
-
-                            partial_zt_src = zt_src[:, c, :, :]
-                            vt_src_context, new_teacache = predict_with_cfg(
-                                partial_zt_src, cfg[idx], 
-                                positive, source_embeds["negative_prompt_embeds"],
-                                timestep, idx, partial_img_emb, control_latents,
-                                source_clip_fea, current_teacache)
-                            
-                            if teacache_args is not None:
-                                self.window_tracker.teacache_states[window_id] = new_teacache
-
-                            window_mask = create_window_mask(vt_src_context, c, latent_video_length, context_overlap)
-                            vt_src[:, c, :, :] += vt_src_context * window_mask
-                            counter[:, c, :, :] += window_mask
-                        vt_src /= counter
-                    else:
-                        vt_src, self.teacache_state_source = predict_with_cfg(
-                            zt_src, cfg[idx], 
-                            source_embeds["prompt_embeds"], 
-                            source_embeds["negative_prompt_embeds"],
-                            timestep, idx, source_image_cond, 
-                            source_clip_fea, control_latents,
-                            teacache_state=self.teacache_state_source)
-                else:
-                    if idx == len(timesteps) - drift_steps:
-                        x_tgt = zt_tgt
-                    zt_tgt = x_tgt
-                    vt_src = 0
-                #target
-                if context_options is not None:
-                    counter = torch.zeros_like(zt_tgt, device=intermediate_device)
-                    vt_tgt = torch.zeros_like(zt_tgt, device=intermediate_device)
-                    context_queue = list(context(idx, steps, latent_video_length, context_frames, context_stride, context_overlap))
-                    for c in context_queue:
-                        window_id = self.window_tracker.get_window_id(c)
-
-                        if teacache_args is not None:
-                            current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
-                        else:
-                            current_teacache = None
-
-                        prompt_index = min(int(max(c) / section_size), num_prompts - 1)
-                        if context_options["verbose"]:
-                            log.info(f"Prompt index: {prompt_index}")
-                     
-                        if len(text_embeds["prompt_embeds"]) > 1:
-                            positive = text_embeds["prompt_embeds"][prompt_index]
-                        else:
-                            positive = text_embeds["prompt_embeds"]
-                        
-                        partial_img_emb = None
-                        partial_control_latents = None
-                        if image_cond is not None:
-                            partial_img_emb = image_cond[:, c, :, :]
-                            partial_img_emb[:, 0, :, :] = image_cond[:, 0, :, :].to(intermediate_device)
-                        if control_latents is not None:
-                            partial_control_latents = control_latents[:, c, :, :]
-
-                        partial_zt_tgt = zt_tgt[:, c, :, :]
-                        vt_tgt_context, new_teacache = predict_with_cfg(
-                            partial_zt_tgt, cfg[idx], 
-                            positive, text_embeds["negative_prompt_embeds"],
-                            timestep, idx, partial_img_emb, partial_control_latents,
-                            clip_fea, current_teacache)
-                        
-                        if teacache_args is not None:
-                            self.window_tracker.teacache_states[window_id] = new_teacache
-                        
-                        window_mask = create_window_mask(vt_tgt_context, c, latent_video_length, context_overlap)
-                        vt_tgt[:, c, :, :] += vt_tgt_context * window_mask
-                        counter[:, c, :, :] += window_mask
-                    vt_tgt /= counter
-                else:
-                    vt_tgt, self.teacache_state = predict_with_cfg(
-                        zt_tgt, cfg[idx], 
-                        text_embeds["prompt_embeds"], 
-                        text_embeds["negative_prompt_embeds"], 
-                        timestep, idx, image_cond, clip_fea, control_latents,
-                        teacache_state=self.teacache_state)
-                v_delta = vt_tgt - vt_src
-                x_tgt = x_tgt.to(torch.float32)
-                v_delta = v_delta.to(torch.float32)
-                x_tgt = x_tgt + (sigma_prev - sigma) * v_delta
-                x0 = x_tgt
-            #context windowing
-            elif context_options is not None:
-                counter = torch.zeros_like(latent_model_input, device=intermediate_device)
-                noise_pred = torch.zeros_like(latent_model_input, device=intermediate_device)
-                context_queue = list(context(idx, steps, latent_video_length, context_frames, context_stride, context_overlap))
-                
-                for c in context_queue:
-                    window_id = self.window_tracker.get_window_id(c)
-                    
-                    if teacache_args is not None:
-                        current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
-                    else:
-                        current_teacache = None
-
-                    prompt_index = min(int(max(c) / section_size), num_prompts - 1)
-                    if context_options["verbose"]:
-                        log.info(f"Prompt index: {prompt_index}")
-                    
-                    # Use the appropriate prompt for this section
-                    if len(text_embeds["prompt_embeds"]) > 1:
-                        positive = text_embeds["prompt_embeds"][prompt_index]
-                    else:
-                        positive = text_embeds["prompt_embeds"]
-
-                    partial_img_emb = None
-                    partial_control_latents = None
-                    if image_cond is not None:
-                        log.info(f"Image cond shape: {image_cond.shape}")
-                        num_windows= context_options["image_cond_window_count"]
-                        section_size = latent_video_length / num_windows
-                        image_index = min(int(max(c) / section_size), num_windows - 1)
-                        partial_img_emb = image_cond[:, c, :, :]
-                        if control_latents is not None:
-                            partial_control_latents = control_latents[:, c, :, :]
-                        partial_image_cond = image_cond[:, 0, :, :].to(intermediate_device)
-                        log.info(f"image_index: {image_index}")
-                        if hasattr(self, "previous_noise_pred_context") and image_index > 0: #wip
-                            if idx >= context_options["image_cond_start_step"]:
-                                #strength = 0.5
-                                #partial_image_cond *= strength
-                                mask = torch.ones(4, partial_img_emb.shape[2], partial_img_emb.shape[3], device=partial_img_emb.device, dtype=partial_img_emb.dtype) #torch.Size([20, 10, 104, 60])
-                                if context_vae is not None:
-                                    to_decode = self.previous_noise_pred_context[:,-1,:, :].unsqueeze(1).unsqueeze(0).to(context_vae.dtype)
-                                    #to_decode = to_decode.permute(0, 1, 3, 2)
-                                    #print("to_decode.shape", to_decode.shape)
-                                    if isinstance(context_vae, TAEHV):
-                                        image = context_vae.decode_video(to_decode.permute(0, 2, 1, 3, 4), parallel=False)
-                                        image = context_vae.encode_video(image.repeat(1, 5, 1, 1, 1), parallel=False).permute(0, 2, 1, 3, 4)
-                                    else:
-                                        image = context_vae.decode(to_decode, device=device, tiled=False)[0]
-                                        image = context_vae.encode(image.unsqueeze(0).to(context_vae.dtype), device=device, tiled=False)
-                                    #print("decoded image.shape", image.shape) #torch.Size([3, 37, 832, 480])
-                                    #print("encoded image.shape", image.shape)
-                                    #partial_img_emb[:, 0, :, :] = image[0][:,0,:,:]                                        
-                                    #print("partial_img_emb.shape", partial_img_emb.shape)
-                                    #print("mask.shape", mask.shape)
-                                    #print("self.previous_noise_pred_context.shape", self.previous_noise_pred_context.shape) #torch.Size([16, 10, 104, 60])
-                                    partial_img_emb[:, 0, :, :] =  torch.cat([image[0][:,0,:,:], mask], dim=0)
-                            else:
-                                partial_img_emb[:, 0, :, :] =  partial_image_cond
-                    
-                    partial_vace_context = None
-                    if vace_data is not None:
-                        partial_vace_context = vace_data[0]["context"][0][:, c, :, :]
-                        if has_ref:
-                            partial_vace_context[:, 0, :, :] = vace_data[0]["context"][0][:, 0, :, :]
-                        partial_vace_context = [partial_vace_context]
-                    partial_latent_model_input = latent_model_input[:, c, :, :]
-
-                    noise_pred_context, new_teacache = predict_with_cfg(
-                        partial_latent_model_input, 
-                        cfg[idx], positive, 
-                        text_embeds["negative_prompt_embeds"], 
-                        timestep, idx, partial_img_emb, clip_fea, partial_control_latents, partial_vace_context,
-                        current_teacache)
-
-                    # if callback is not None:
-                    #     callback_latent = (noise_pred.to(t.device) * t / 1000).detach().permute(1,0,2,3)
-                    #     callback(idx, callback_latent, None, steps)
-
-                    if teacache_args is not None:
-                        self.window_tracker.teacache_states[window_id] = new_teacache
-                    if image_cond is not None and image_index > 0:
-                        self.previous_noise_pred_context = noise_pred_context
-
-                    window_mask = create_window_mask(noise_pred_context, c, latent_video_length, context_overlap, looped=is_looped)                    
-                    noise_pred[:, c, :, :] += noise_pred_context * window_mask
-                    counter[:, c, :, :] += window_mask
-                noise_pred /= counter
-            #normal inference
-            else:
-                noise_pred, self.teacache_state = predict_with_cfg(
-                    latent_model_input, 
-                    cfg[idx], 
-                    text_embeds["prompt_embeds"], 
-                    text_embeds["negative_prompt_embeds"], 
-                    timestep, idx, image_cond, clip_fea, control_latents, vace_data,
-                    teacache_state=self.teacache_state)
-
-            if latent_shift_loop:
-                #reverse latent shift
-                if latent_shift_start_percent <= current_step_percentage <= latent_shift_end_percent:
-                    noise_pred = torch.cat([noise_pred[:, latent_video_length - shift_idx:]] + [noise_pred[:, :latent_video_length - shift_idx]], dim=1)
-                    shift_idx = (shift_idx + latent_skip) % latent_video_length
-                
-            
-            if flowedit_args is None:
-                latent = latent.to(intermediate_device)
-                
-                temp_x0 = sample_scheduler.step(
-                    noise_pred.unsqueeze(0),
-                    t,
-                    latent.unsqueeze(0),
-                    return_dict=False,
-                    generator=seed_g)[0]
-                latent = temp_x0.squeeze(0)
-
-                x0 = latent.to(device)
-                if callback is not None:
-                    callback_latent = (latent_model_input - noise_pred.to(t.device) * t / 1000).detach().permute(1,0,2,3)
-                    callback(idx, callback_latent, None, steps)
-                else:
-                    pbar.update(1)
-                del latent_model_input, timestep
-            else:
-                if callback is not None:
-                    callback_latent = (zt_tgt - vt_tgt.to(t.device) * t / 1000).detach().permute(1,0,2,3)
-                    callback(idx, callback_latent, None, steps)
-                else:
-                    pbar.update(1)
-                
-        if teacache_args is not None:
-            states = transformer.teacache_state.states
-            state_names = {
-                0: "conditional",
-                1: "unconditional"
-            }
-            for pred_id, state in states.items():
-                name = state_names.get(pred_id, f"prediction_{pred_id}")
-                if 'skipped_steps' in state:
-                    log.info(f"TeaCache skipped: {len(state['skipped_steps'])} {name} steps: {state['skipped_steps']}")
-            transformer.teacache_state.clear_all()
-
-        # if transformer.attention_mode == "spargeattn_tune":
-        #     saved_state_dict = extract_sparse_attention_state_dict(transformer)
-        #     torch.save(saved_state_dict, "sparge_wan.pt")
-        #     save_torch_file(saved_state_dict, "sparge_wan.safetensors")
-
-        if force_offload:
-            if model["manual_offloading"]:
-                transformer.to(offload_device)
-                mm.soft_empty_cache()
-                gc.collect()
-
-        try:
-            print_memory(device)
-            torch.cuda.reset_peak_memory_stats(device)
-        except:
-            pass
-
-        return ({
-            "samples": x0.unsqueeze(0).cpu(), "looped": is_looped, "end_image": end_image if not fun_model else None, "has_ref": has_ref, "drop_last": drop_last,
-            }, )
-    
-class WindowTracker:
-    def __init__(self, verbose=False):
-        self.window_map = {}  # Maps frame sequence to persistent ID
-        self.next_id = 0
-        self.teacache_states = {}  # Maps persistent ID to teacache state
-        self.verbose = verbose
-    
-    def get_window_id(self, frames):
-        key = tuple(sorted(frames))  # Order-independent frame sequence
-        if key not in self.window_map:
-            self.window_map[key] = self.next_id
-            if self.verbose:
-                log.info(f"New window pattern {key} -> ID {self.next_id}")
-            self.next_id += 1
-        return self.window_map[key]
-    
-    def get_teacache(self, window_id, base_state):
-        if window_id not in self.teacache_states:
-            if self.verbose:
-                log.info(f"Initializing persistent teacache for window {window_id}")
-            self.teacache_states[window_id] = base_state.copy()
-        return self.teacache_states[window_id]
+        teacache_args=None, flowedit_args=None, batched_cfg=False, slg_args=None, rope_function="default", loop_args=None, experimental_args=None, batch_args=None, checkpoint_args=None, cfg_cache_args=None, adaptive_guidance_args=None, local_attention_args=None, token_merge_args=None):
+        engine = SamplingEngine(model, text_embeds, image_embeds, shift, steps, cfg, seed, scheduler, riflex_freq_index,
+            force_offload=force_offload, samples=samples, feta_args=feta_args, denoise_strength=denoise_strength, context_options=context_options,
+            teacache_args=teacache_args, flowedit_args=flowedit_args, batched_cfg=batched_cfg, slg_args=slg_args, rope_function=rope_function,
+            loop_args=loop_args, experimental_args=experimental_args, batch_args=batch_args, checkpoint_args=checkpoint_args, cfg_cache_args=cfg_cache_args, adaptive_guidance_args=adaptive_guidance_args, local_attention_args=local_attention_args, token_merge_args=token_merge_args)
+        return (engine.sample(),)
 
 #region VideoDecode
 class WanVideoDecode:
@@ -3061,7 +2467,19 @@ class WanVideoDecode:
 
         mm.soft_empty_cache()
 
-        
+        # batched sampling gives [N, C, F, H, W], every video is decoded on its own and their frames concatenated
+        images = torch.cat([
+            self.decode_video(vae, latent, device, end_image, has_ref, drop_last, is_looped, enable_vae_tiling, tile_x, tile_y, tile_stride_x, tile_stride_y)
+            for latent in latents.split(1)
+        ])
+
+        vae.model.clear_cache()
+        vae.to(offload_device)
+        mm.soft_empty_cache()
+
+        return (images,)
+
+    def decode_video(self, vae, latents, device, end_image, has_ref, drop_last, is_looped, enable_vae_tiling, tile_x, tile_y, tile_stride_x, tile_stride_y):
         if has_ref:
             latents = latents[:, :, 1:]
         if drop_last:
@@ -3094,14 +2512,9 @@ class WanVideoDecode:
             #image[:, -1] = end_image[:, 0].to(image) #not sure about this
             images = images[:, 0:-1]
 
-        vae.model.clear_cache()
-        vae.to(offload_device)
-        mm.soft_empty_cache()
-
         images = torch.clamp(images, 0.0, 1.0)
         images = images.permute(1, 2, 3, 0).cpu().float()
-
-        return (images,)
+        return images
 
 #region VideoEncode
 class WanVideoEncode:
@@ -3201,6 +2614,9 @@ NODE_CLASS_MAPPINGS = {
     "WanVideoEnhanceAVideo": WanVideoEnhanceAVideo,
     "WanVideoContextOptions": WanVideoContextOptions,
     "WanVideoTeaCache": WanVideoTeaCache,
+    "WanVideoTeaCacheCalibration": WanVideoTeaCacheCalibration,
+    "WanVideoBlockCache": WanVideoBlockCache,
+    "WanVideoTokenCache": WanVideoTokenCache,
     "WanVideoVRAMManagement": WanVideoVRAMManagement,
     "WanVideoTextEmbedBridge": WanVideoTextEmbedBridge,
     "WanVideoFlowEdit": WanVideoFlowEdit,
@@ -3208,6 +2624,12 @@ NODE_CLASS_MAPPINGS = {
     "WanVideoSLG": WanVideoSLG,
     "WanVideoTinyVAELoader": WanVideoTinyVAELoader,
     "WanVideoLoopArgs": WanVideoLoopArgs,
+    "WanVideoBatchArgs": WanVideoBatchArgs,
+    "WanVideoCheckpointArgs": WanVideoCheckpointArgs,
+    "WanVideoCFGCacheArgs": WanVideoCFGCacheArgs,
+    "WanVideoAdaptiveGuidanceArgs": WanVideoAdaptiveGuidanceArgs,
+    "WanVideoLocalAttentionArgs": WanVideoLocalAttentionArgs,
+    "WanVideoTokenMergeArgs": WanVideoTokenMergeArgs,
     "WanVideoImageResizeToClosest": WanVideoImageResizeToClosest,
     "WanVideoSetBlockSwap": WanVideoSetBlockSwap,
     "WanVideoExperimentalArgs": WanVideoExperimentalArgs,
@@ -3236,6 +2658,9 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "WanVideoEnhanceAVideo": "WanVideo Enhance-A-Video",
     "WanVideoContextOptions": "WanVideo Context Options",
     "WanVideoTeaCache": "WanVideo TeaCache",
+    "WanVideoTeaCacheCalibration": "WanVideo TeaCache Calibration",
+    "WanVideoBlockCache": "WanVideo Block Cache",
+    "WanVideoTokenCache": "WanVideo Token Cache",
     "WanVideoVRAMManagement": "WanVideo VRAM Management",
     "WanVideoTextEmbedBridge": "WanVideo TextEmbed Bridge",
     "WanVideoFlowEdit": "WanVideo FlowEdit",
@@ -3243,6 +2668,12 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "WanVideoSLG": "WanVideo SLG",
     "WanVideoTinyVAELoader": "WanVideo Tiny VAE Loader",
     "WanVideoLoopArgs": "WanVideo Loop Args",
+    "WanVideoBatchArgs": "WanVideo Batch Args",
+    "WanVideoCheckpointArgs": "WanVideo Checkpoint Args",
+    "WanVideoCFGCacheArgs": "WanVideo CFG Cache Args",
+    "WanVideoAdaptiveGuidanceArgs": "WanVideo Adaptive Guidance Args",
+    "WanVideoLocalAttentionArgs": "WanVideo Local Attention Args",
+    "WanVideoTokenMergeArgs": "WanVideo Token Merge Args",
     "WanVideoImageResizeToClosest": "WanVideo Image Resize To Closest",
     "WanVideoSetBlockSwap": "WanVideo Set BlockSwap",
     "WanVideoExperimentalArgs": "WanVideo Experimental Args",
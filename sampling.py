@@ -0,0 +1,1454 @@
+import os
+import torch
+import gc
+import math
+import numpy as np
+from tqdm import tqdm
+from .utils import log, print_memory, apply_lora
+from .context import get_context_schedule, get_window_batches
+from .checkpoint import get_scheduler_state, set_scheduler_state, save_checkpoint, load_checkpoint
+from .teacache_calibration import TeaCacheCalibration
+
+from .wanvideo.modules.model import rope_params
+from .wanvideo.utils.fm_solvers import (FlowDPMSolverMultistepScheduler,
+                               get_sampling_sigmas, retrieve_timesteps)
+from .wanvideo.utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from diffusers.schedulers import FlowMatchEulerDiscreteScheduler
+
+from .enhance_a_video.globals import enable_enhance, disable_enhance, set_enhance_weight, set_num_frames
+from .taehv import TAEHV
+
+import comfy.model_management as mm
+from comfy.utils import ProgressBar
+from comfy.cli_args import args, LatentPreviewMethod
+
+def optimized_scale(positive_flat, negative_flat):
+
+    # Calculate dot production
+    dot_product = torch.sum(positive_flat * negative_flat, dim=1, keepdim=True)
+
+    # Squared norm of uncondition
+    squared_norm = torch.sum(negative_flat ** 2, dim=1, keepdim=True) + 1e-8
+
+    # st_star = v_cond^T * v_uncond / ||v_uncond||^2
+    st_star = dot_product / squared_norm
+    
+    return st_star
+
+class SamplingEngine:
+    """
+    One WanVideo sampling run. prepare() sets up the model, conditioning, scheduler and caches,
+    step() runs a single denoising step and finalize() clears the run state and returns the LATENT.
+    """
+    def __init__(self, model, text_embeds, image_embeds, shift, steps, cfg, seed, scheduler, riflex_freq_index, 
+        force_offload=True, samples=None, feta_args=None, denoise_strength=1.0, context_options=None, 
+        teacache_args=None, flowedit_args=None, batched_cfg=False, slg_args=None, rope_function="default", loop_args=None, experimental_args=None, batch_args=None, checkpoint_args=None, cfg_cache_args=None, adaptive_guidance_args=None, local_attention_args=None, token_merge_args=None):
+        self.model = model
+        self.text_embeds = text_embeds
+        self.image_embeds = image_embeds
+        self.shift = shift
+        self.steps = steps
+        self.cfg = cfg
+        self.seed = seed
+        self.scheduler = scheduler
+        self.riflex_freq_index = riflex_freq_index
+        self.force_offload = force_offload
+        self.samples = samples
+        self.feta_args = feta_args
+        self.denoise_strength = denoise_strength
+        self.context_options = context_options
+        self.teacache_args = teacache_args
+        self.flowedit_args = flowedit_args
+        self.batched_cfg = batched_cfg
+        self.slg_args = slg_args
+        self.rope_function = rope_function
+        self.loop_args = loop_args
+        self.experimental_args = experimental_args
+        self.batch_args = batch_args
+        self.checkpoint_args = checkpoint_args
+        self.cfg_cache_args = cfg_cache_args
+        self.adaptive_guidance_args = adaptive_guidance_args
+        self.local_attention_args = local_attention_args
+        self.token_merge_args = token_merge_args
+
+    def prepare(self):
+        """Model setup, conditioning and scheduler, call once before the first step()."""
+        #assert not (context_options and teacache_args), "Context options cannot currently be used together with teacache."
+        self.patcher = self.model
+        self.model = self.model.model
+        self.transformer = self.model.diffusion_model
+
+        self.control_lora = self.model["control_lora"]
+
+        self.device = mm.get_torch_device()
+        self.offload_device = mm.unet_offload_device()
+
+        self.steps = int(self.steps/self.denoise_strength)
+
+        scheduler_args = {
+            "num_train_timesteps": 1000,
+            "shift": self.shift,
+            "use_dynamic_shifting": False,
+        }
+
+        self.timesteps = None
+        if self.scheduler == 'unipc':
+            self.sample_scheduler = FlowUniPCMultistepScheduler(**scheduler_args)
+            self.sample_scheduler.set_timesteps(self.steps, device=self.device, shift=self.shift)
+        elif self.scheduler in ['euler/beta', 'euler']:
+            self.sample_scheduler = FlowMatchEulerDiscreteScheduler(**scheduler_args, use_beta_sigmas=(self.scheduler == 'euler/beta'))
+            if self.flowedit_args: #seems to work better
+                self.timesteps, _ = retrieve_timesteps(self.sample_scheduler, device=self.device, sigmas=get_sampling_sigmas(self.steps, self.shift))
+            else:
+                self.sample_scheduler.set_timesteps(self.steps, device=self.device, mu=1)  
+        elif 'dpm++' in self.scheduler:
+            if self.scheduler == 'dpm++_sde':
+                algorithm_type = "sde-dpmsolver++"
+            else:
+                algorithm_type = "dpmsolver++"
+            self.sample_scheduler = FlowDPMSolverMultistepScheduler(**scheduler_args, algorithm_type= algorithm_type)
+            self.sample_scheduler.set_timesteps(self.steps, device=self.device, mu=1)
+
+        if self.timesteps is None:
+            self.timesteps = self.sample_scheduler.timesteps
+
+        if self.denoise_strength < 1.0:
+            self.steps = int(self.steps * self.denoise_strength)
+            self.timesteps = self.timesteps[-(self.steps + 1):] 
+
+        self.seed_g = torch.Generator(device=torch.device("cpu"))
+        self.seed_g.manual_seed(self.seed)
+
+        self.control_latents, self.clip_fea, self.clip_fea_neg, self.end_image = None, None, None, None
+        self.vace_data, vace_context, vace_scale = None, None, None
+        self.fun_model, self.has_ref, self.drop_last = False, False, False
+
+        self.image_cond = self.image_embeds.get("image_embeds", None)
+
+        if self.image_cond is not None:
+            self.end_image = self.image_embeds.get("end_image", None)
+            lat_h = self.image_embeds.get("lat_h", None)
+            lat_w = self.image_embeds.get("lat_w", None)
+            if lat_h is None or lat_w is None:
+                raise ValueError("Clip encoded image embeds must be provided for I2V (Image to Video) model")
+            self.fun_model = self.image_embeds.get("fun_model", False)
+            self.noise = torch.randn(
+                16,
+                (self.image_embeds["num_frames"] - 1) // 4 + (2 if self.end_image is not None and not self.fun_model else 1),
+                lat_h,
+                lat_w,
+                dtype=torch.float32,
+                generator=self.seed_g,
+                device=torch.device("cpu"))
+            self.seq_len = self.image_embeds["max_seq_len"]
+            self.image_cond = self.image_embeds.get("image_embeds", None)
+            print("image_cond", self.image_cond.shape)
+            self.clip_fea = self.image_embeds.get("clip_context", None)
+            self.clip_fea_neg = self.image_embeds.get("negative_clip_context", None)
+
+            control_embeds = self.image_embeds.get("control_embeds", None)
+            if control_embeds is not None:
+                if self.transformer.in_dim != 48:
+                    raise ValueError("Control signal only works with Fun-Control model")
+                self.control_latents = control_embeds["control_images"].to(self.device)
+                self.control_start_percent = control_embeds.get("start_percent", 0.0)
+                self.control_end_percent = control_embeds.get("end_percent", 1.0)
+            self.drop_last = self.image_embeds.get("drop_last", False)
+            self.has_ref = self.image_embeds.get("has_ref", False)
+        else: #t2v
+            target_shape = self.image_embeds.get("target_shape", None)
+            if target_shape is None:
+                raise ValueError("Empty image embeds must be provided for T2V (Text to Video")
+
+            self.has_ref = self.image_embeds.get("has_ref", False)
+            vace_context = self.image_embeds.get("vace_context", None)
+            vace_scale = self.image_embeds.get("vace_scale", None)
+            vace_start_percent = self.image_embeds.get("vace_start_percent", 0.0)
+            vace_end_percent = self.image_embeds.get("vace_end_percent", 1.0)
+            vace_seqlen = self.image_embeds.get("vace_seq_len", None)
+
+            vace_additional_embeds = self.image_embeds.get("additional_vace_inputs", [])
+            if vace_context is not None:
+                self.vace_data = [
+                    {"context": vace_context, 
+                     "scale": vace_scale, 
+                     "start": vace_start_percent, 
+                     "end": vace_end_percent,
+                     "seq_len": vace_seqlen
+                     }
+                ]
+                if len(vace_additional_embeds) > 0:
+                    for i in range(len(vace_additional_embeds)):
+                        self.vace_data.append({
+                            "context": vace_additional_embeds[i]["vace_context"],
+                            "scale": vace_additional_embeds[i]["vace_scale"],
+                            "start": vace_additional_embeds[i]["vace_start_percent"],
+                            "end": vace_additional_embeds[i]["vace_end_percent"],
+                            "seq_len": vace_additional_embeds[i]["vace_seq_len"]
+                        })
+
+            self.noise = torch.randn(
+                    target_shape[0],
+                    target_shape[1] + 1 if self.has_ref else target_shape[1],
+                    target_shape[2],
+                    target_shape[3],
+                    dtype=torch.float32,
+                    device=torch.device("cpu"),
+                    generator=self.seed_g)
+
+            self.seq_len = math.ceil((self.noise.shape[2] * self.noise.shape[3]) / 4 * self.noise.shape[1])
+
+            control_embeds = self.image_embeds.get("control_embeds", None)
+            if control_embeds is not None:
+                self.control_latents = control_embeds["control_images"].to(self.device)
+                if self.control_lora:
+                    self.image_cond = self.control_latents.to(self.device)
+                    if not self.patcher.model.is_patched:
+                        log.info("Re-loading control LoRA...")
+                        self.patcher = apply_lora(self.patcher, self.device, self.device, low_mem_load=False)
+                        self.patcher.model.is_patched = True
+                else:
+                    if self.transformer.in_dim != 48:
+                        raise ValueError("Control signal only works with Fun-Control model")
+                    self.image_cond = torch.zeros_like(self.control_latents).to(self.device) #fun control
+                    self.clip_fea = None
+
+                self.control_start_percent = control_embeds.get("start_percent", 0.0)
+                self.control_end_percent = control_embeds.get("end_percent", 1.0)
+            else:
+                if self.transformer.in_dim == 36: #fun inp
+                    mask_latents = torch.tile(
+                        torch.zeros_like(self.noise[:1]), [4, 1, 1, 1]
+                    )
+                    masked_video_latents_input = torch.zeros_like(self.noise)
+                    self.image_cond = torch.cat([mask_latents, masked_video_latents_input], dim=0).to(self.device)
+
+        self.latent_video_length = self.noise.shape[1]
+
+        # several seeds/prompts sampled together, the latent gets a leading batch dimension
+        if self.batch_args is not None:
+            if self.image_cond is not None or self.vace_data is not None or self.context_options is not None or self.flowedit_args is not None or self.samples is not None or self.loop_args is not None:
+                raise ValueError("Batched sampling only supports text to video without VACE, context windows, FlowEdit, loop args or input samples")
+            num_batch_prompts = len(self.text_embeds["prompt_embeds"]) if self.batch_args["prompt_per_video"] else 1
+            if self.batch_args["seeds"].strip():
+                batch_seeds = [int(x.strip()) for x in self.batch_args["seeds"].split(",")]
+            else:
+                batch_seeds = [self.seed + i for i in range(max(self.batch_args["batch_count"], num_batch_prompts))]
+            self.num_videos = max(len(batch_seeds), num_batch_prompts)
+            if len(batch_seeds) not in (1, self.num_videos) or num_batch_prompts not in (1, self.num_videos):
+                raise ValueError(f"Got {len(batch_seeds)} seeds for {num_batch_prompts} prompts, the counts must match or one of them must be 1")
+            batch_seeds = batch_seeds * (self.num_videos // len(batch_seeds))
+            self.batch_prompt_keys = [("prompt", i if num_batch_prompts > 1 else 0) for i in range(self.num_videos)]
+            self.batch_prompts = [self.text_embeds["prompt_embeds"][i] for _, i in self.batch_prompt_keys]
+            self.micro_batch_size = self.batch_args["micro_batch_size"] if self.batch_args["micro_batch_size"] > 0 else self.num_videos
+            # each video gets the same initial and step noise as a single run with its seed, so it has its own generator
+            self.batch_generators = [torch.Generator(device=torch.device("cpu")).manual_seed(s) for s in batch_seeds]
+            self.noise = torch.stack([
+                torch.randn(self.noise.shape, dtype=torch.float32, device=torch.device("cpu"), generator=g)
+                for g in self.batch_generators])
+            log.info(f"Sampling {self.num_videos} videos with seeds {batch_seeds} in micro batches of {self.micro_batch_size}")
+
+        self.is_looped = False
+        if self.context_options is not None:
+
+            context_schedule = self.context_options["context_schedule"]
+            context_frames =  (self.context_options["context_frames"] - 1) // 4 + 1
+            context_stride = self.context_options["context_stride"] // 4
+            context_overlap = self.context_options["context_overlap"] // 4
+            self.context_vae = self.context_options.get("vae", None)
+            if self.context_vae is not None:
+                self.context_vae.to(self.device)
+
+            self.window_tracker = WindowTracker(verbose=self.context_options["verbose"])
+
+            # Get total number of prompts
+            self.num_prompts = len(self.text_embeds["prompt_embeds"])
+            log.info(f"Number of prompts: {self.num_prompts}")
+            # Calculate which section this context window belongs to
+            self.section_size = self.latent_video_length / self.num_prompts
+            log.info(f"Section size: {self.section_size}")
+            self.is_looped = context_schedule == "uniform_looped"
+
+            self.seq_len = math.ceil((self.noise.shape[2] * self.noise.shape[3]) / 4 * context_frames)
+
+            if self.context_options["freenoise"]:
+                log.info("Applying FreeNoise")
+                # code from AnimateDiff-Evolved by Kosinkadink (https://github.com/Kosinkadink/ComfyUI-AnimateDiff-Evolved)
+                delta = context_frames - context_overlap
+                for start_idx in range(0, self.latent_video_length-context_frames, delta):
+                    place_idx = start_idx + context_frames
+                    if place_idx >= self.latent_video_length:
+                        break
+                    end_idx = place_idx - 1
+
+                    if end_idx + delta >= self.latent_video_length:
+                        final_delta = self.latent_video_length - place_idx
+                        list_idx = torch.tensor(list(range(start_idx,start_idx+final_delta)), device=torch.device("cpu"), dtype=torch.long)
+                        list_idx = list_idx[torch.randperm(final_delta, generator=self.seed_g)]
+                        self.noise[:, place_idx:place_idx + final_delta, :, :] = self.noise[:, list_idx, :, :]
+                        break
+                    list_idx = torch.tensor(list(range(start_idx,start_idx+delta)), device=torch.device("cpu"), dtype=torch.long)
+                    list_idx = list_idx[torch.randperm(delta, generator=self.seed_g)]
+                    self.noise[:, place_idx:place_idx + delta, :, :] = self.noise[:, list_idx, :, :]
+
+            log.info(f"Context schedule enabled: {context_frames} frames, {context_stride} stride, {context_overlap} overlap")
+            self.window_blender = WindowBlender(
+                lambda step, looped: get_context_schedule(context_schedule, step, self.steps, self.latent_video_length, context_frames, context_stride, context_overlap, looped),
+                device=self.device)
+            self.window_batch_size = self.context_options.get("window_batch_size", 1)
+            if self.window_batch_size > 1 and (self.image_cond is not None or self.vace_data is not None or self.flowedit_args is not None):
+                log.info("Batched context windows are only supported for text to video without VACE or FlowEdit, running windows one at a time")
+                self.window_batch_size = 1
+
+        if self.samples is not None and self.denoise_strength < 1.0:
+            latent_timestep = self.timesteps[:1].to(self.noise)
+            input_samples = self.samples["samples"].squeeze(0).to(self.noise)
+            if input_samples.shape[1] != self.noise.shape[1]:
+                input_samples = torch.cat([input_samples[:, :1].repeat(1, self.noise.shape[1] - input_samples.shape[1], 1, 1), input_samples], dim=1)
+            self.noise = self.noise * latent_timestep / 1000 + (1 - latent_timestep / 1000) * input_samples
+
+        if self.samples is not None:
+            self.original_image = self.samples["samples"].clone().squeeze(0).to(self.device)
+            mask = self.samples.get("mask", None)
+
+        self.latent = self.noise.to(self.device)
+
+        self.freqs = None
+        self.transformer.rope_cache.clear()
+        self.transformer.rope_embedder.k = self.riflex_freq_index
+        self.transformer.rope_embedder.num_frames = self.latent_video_length
+        if self.rope_function!="comfy":
+            d = self.transformer.dim // self.transformer.num_heads
+            self.freqs = torch.cat([
+                rope_params(1024, d - 4 * (d // 6), L_test=self.latent_video_length, k=self.riflex_freq_index),
+                rope_params(1024, 2 * (d // 6)),
+                rope_params(1024, 2 * (d // 6))
+            ],
+            dim=1)
+
+        if not isinstance(self.cfg, list):
+            self.cfg = [self.cfg] * (self.steps +1)
+
+        print("Seq len:", self.seq_len)
+
+        self.pbar = ProgressBar(self.steps)
+
+        if args.preview_method in [LatentPreviewMethod.Auto, LatentPreviewMethod.Latent2RGB]: #default for latent2rgb
+            from latent_preview import prepare_callback
+        else:
+            from .latent_preview import prepare_callback #custom for tiny VAE previews
+        self.callback = prepare_callback(self.patcher, self.steps)
+
+        #blockswap init        
+        transformer_options = self.patcher.model_options.get("transformer_options", None)
+        if transformer_options is not None:
+            block_swap_args = transformer_options.get("block_swap_args", None)
+
+        if block_swap_args is not None:
+            self.transformer.use_non_blocking = block_swap_args.get("use_non_blocking", True)
+            for name, param in self.transformer.named_parameters():
+                if "block" not in name:
+                    param.data = param.data.to(self.device)
+                elif block_swap_args["offload_txt_emb"] and "txt_emb" in name:
+                    param.data = param.data.to(self.offload_device, non_blocking=self.transformer.use_non_blocking)
+                elif block_swap_args["offload_img_emb"] and "img_emb" in name:
+                    param.data = param.data.to(self.offload_device, non_blocking=self.transformer.use_non_blocking)
+
+            self.transformer.block_swap(
+                block_swap_args["blocks_to_swap"] - 1 ,
+                block_swap_args["offload_txt_emb"],
+                block_swap_args["offload_img_emb"],
+                vace_blocks_to_swap = block_swap_args.get("vace_blocks_to_swap", None),
+            )
+
+        elif self.model["auto_cpu_offload"]:
+            for module in self.transformer.modules():
+                if hasattr(module, "offload"):
+                    module.offload()
+                if hasattr(module, "onload"):
+                    module.onload()
+        elif self.model["manual_offloading"]:
+            self.transformer.to(self.device)
+        #feta
+        if self.feta_args is not None and self.latent_video_length > 1:
+            set_enhance_weight(self.feta_args["weight"])
+            self.feta_start_percent = self.feta_args["start_percent"]
+            self.feta_end_percent = self.feta_args["end_percent"]
+            if self.context_options is not None:
+                set_num_frames(context_frames)
+            else:
+                set_num_frames(self.latent_video_length)
+            enable_enhance()
+        else:
+            self.feta_args = None
+            disable_enhance()
+
+        # Initialize TeaCache if enabled
+        if self.teacache_args is not None:
+            self.transformer.enable_teacache = True
+            self.transformer.rel_l1_thresh = self.teacache_args["rel_l1_thresh"]
+            self.transformer.teacache_start_step = self.teacache_args["start_step"]
+            self.transformer.teacache_cache_device = self.teacache_args["cache_device"]
+            self.transformer.teacache_end_step = len(self.timesteps)-1 if self.teacache_args["end_step"] == -1 else self.teacache_args["end_step"]
+            self.transformer.teacache_use_coefficients = self.teacache_args["use_coefficients"]
+            self.transformer.teacache_mode = self.teacache_args["mode"]
+            self.transformer.teacache_state.clear_all()
+            self.transformer.teacache_state.memory_budget = self.teacache_args.get("memory_budget", 0)
+            self.transformer.teacache_state.storage_dtype = self.teacache_args.get("residual_dtype", torch.float32)
+            self.transformer.teacache_state.pin_memory = self.teacache_args.get("pin_memory", False)
+            self.transformer.block_cache_first_blocks = self.teacache_args.get("block_cache_first_blocks", 0)
+            self.transformer.block_cache_refresh_groups = self.teacache_args.get("block_cache_refresh_groups", 0)
+            self.transformer.token_cache_ratio = self.teacache_args.get("token_cache_ratio", 0.0)
+            self.transformer.token_cache_refresh_every = self.teacache_args.get("token_cache_refresh_every", 3)
+            self.transformer.teacache_calibration = TeaCacheCalibration(self.transformer.model_hash) if self.teacache_args.get("calibrate", False) else None
+        else:
+            self.transformer.enable_teacache = False
+
+        if self.slg_args is not None:
+            assert self.batched_cfg is not None, "Batched cfg is not supported with SLG"
+            self.transformer.slg_blocks = self.slg_args["blocks"]
+            self.transformer.slg_start_percent = self.slg_args["start_percent"]
+            self.transformer.slg_end_percent = self.slg_args["end_percent"]
+        else:
+            self.transformer.slg_blocks = None
+
+        if self.local_attention_args is not None:
+            local_args = self.local_attention_args
+            end_block = local_args["end_block"] if local_args["end_block"] != -1 else len(self.transformer.blocks) - 1
+            self.transformer.local_attn_window = (local_args["temporal_radius"], local_args["tile_height"], local_args["tile_width"])
+            self.transformer.local_attn_blocks = range(local_args["start_block"], end_block + 1)
+            self.transformer.local_attn_start_step = local_args["start_step"]
+            self.transformer.local_attn_end_step = local_args["end_step"]
+        else:
+            self.transformer.local_attn_window = None
+
+        if self.token_merge_args is not None:
+            merge_args = self.token_merge_args
+            end_block = merge_args["end_block"] if merge_args["end_block"] != -1 else len(self.transformer.blocks) - 1
+            self.transformer.token_merge_ratio = merge_args["ratio"]
+            self.transformer.token_merge_blocks = range(merge_args["start_block"], end_block + 1)
+            self.transformer.token_merge_start_step = merge_args["start_step"]
+            self.transformer.token_merge_end_step = merge_args["end_step"]
+        else:
+            self.transformer.token_merge_ratio = 0.0
+
+        self.cfg_cache = None
+        if self.cfg_cache_args is not None:
+            self.cfg_cache = CFGCache(self.cfg_cache_args["interval"], self.cfg_cache_args["drift_threshold"],
+                                      self.cfg_cache_args["start_step"], self.cfg_cache_args["end_step"])
+        self.adaptive_guidance = None
+        if self.adaptive_guidance_args is not None:
+            self.adaptive_guidance = AdaptiveGuidance(self.adaptive_guidance_args["metric"], self.adaptive_guidance_args["threshold"],
+                                                      self.adaptive_guidance_args["consecutive_steps"], self.adaptive_guidance_args["start_step"])
+
+        self.teacache_state = [None, None]
+        self.teacache_state_source = [None, None]
+        self.teacache_states_context = []
+        self.teacache_states_batch = [None] * self.num_videos if self.batch_args is not None else []
+
+        if self.flowedit_args is not None:
+            self.source_embeds = self.flowedit_args["source_embeds"]
+            source_image_embeds = self.flowedit_args.get("source_image_embeds", self.image_embeds)
+            self.source_image_cond = source_image_embeds.get("image_embeds", None)
+            self.source_clip_fea = source_image_embeds.get("clip_fea", self.clip_fea)
+            self.skip_steps = self.flowedit_args["skip_steps"]
+            self.drift_steps = self.flowedit_args["drift_steps"]
+            source_cfg = self.flowedit_args["source_cfg"]
+            if not isinstance(source_cfg, list):
+                source_cfg = [source_cfg] * (self.steps +1)
+            self.drift_cfg = self.flowedit_args["drift_cfg"]
+            if not isinstance(self.drift_cfg, list):
+                self.drift_cfg = [self.drift_cfg] * (self.steps +1)
+
+            self.x_init = self.samples["samples"].clone().squeeze(0).to(self.device)
+            self.x_tgt = self.samples["samples"].squeeze(0).to(self.device)
+
+            self.sample_scheduler = FlowMatchEulerDiscreteScheduler(
+                num_train_timesteps=1000,
+                shift=self.flowedit_args["drift_flow_shift"],
+                use_dynamic_shifting=False)
+
+            sampling_sigmas = get_sampling_sigmas(self.steps, self.flowedit_args["drift_flow_shift"])
+
+            drift_timesteps, _ = retrieve_timesteps(
+                self.sample_scheduler,
+                device=self.device,
+                sigmas=sampling_sigmas)
+
+            if self.drift_steps > 0:
+                drift_timesteps = torch.cat([drift_timesteps, torch.tensor([0]).to(drift_timesteps.device)]).to(drift_timesteps.device)
+                self.timesteps[-self.drift_steps:] = drift_timesteps[-self.drift_steps:]
+
+        self.use_cfg_zero_star = False
+        if self.experimental_args is not None:
+            video_attention_split_steps = self.experimental_args.get("video_attention_split_steps", [])
+            if video_attention_split_steps:
+                self.transformer.video_attention_split_steps = [int(x.strip()) for x in video_attention_split_steps.split(",")]
+            else:
+                self.transformer.video_attention_split_steps = []
+            self.use_zero_init = self.experimental_args.get("use_zero_init", True)
+            self.use_cfg_zero_star = self.experimental_args.get("cfg_zero_star", False)
+            self.zero_star_steps = self.experimental_args.get("zero_star_steps", 0)
+            self.transformer.enable_cross_attn_cache = self.experimental_args.get("cross_attn_kv_cache", False)
+            self.transformer.trim_text_context = self.experimental_args.get("trim_text_context", False)
+            self.transformer.enable_cond_embedding_cache = self.experimental_args.get("cond_embedding_cache", False)
+            self.transformer.residual_stream_dtype = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[self.experimental_args.get("residual_precision", "fp32")]
+        else:
+            self.transformer.enable_cross_attn_cache = False
+            self.transformer.trim_text_context = False
+            self.transformer.enable_cond_embedding_cache = False
+            self.transformer.residual_stream_dtype = torch.float32
+        self.transformer.clear_cross_attn_cache()
+        self.transformer.cond_embedding_cache.clear()
+
+        if self.transformer.trim_text_context:
+            prompt_lens = [u.shape[0] for u in self.text_embeds["prompt_embeds"]]
+            if not math.isclose(self.cfg[0], 1.0):
+                prompt_lens += [u.shape[0] for u in self.text_embeds["negative_prompt_embeds"]]
+            def cross_attn_gflops(text_len): # attention scores + values, and the k/v projections, over all blocks
+                return self.transformer.num_layers * (4 * self.seq_len * text_len * self.transformer.dim + 4 * text_len * self.transformer.dim ** 2) / 1e9
+            full_gflops = sum(cross_attn_gflops(self.transformer.text_len) for _ in prompt_lens)
+            trimmed_gflops = sum(cross_attn_gflops(l) for l in prompt_lens)
+            log.info(f"Text context trimmed to {prompt_lens} tokens instead of {self.transformer.text_len}: "
+                     f"cross-attention {full_gflops:.1f} -> {trimmed_gflops:.1f} GFLOPs per step ({(1 - trimmed_gflops / full_gflops) * 100:.1f}% less)")
+
+
+        log.info(f"Sampling {(self.latent_video_length-1) * 4 + 1} frames at {self.latent.shape[-1]*8}x{self.latent.shape[-2]*8} with {self.steps} steps")
+
+        self.intermediate_device = self.device
+
+        # diff diff prep
+        self.masks = None
+        if self.samples is not None and mask is not None:
+            mask = 1 - mask
+            thresholds = torch.arange(len(self.timesteps), dtype=self.original_image.dtype) / len(self.timesteps)
+            thresholds = thresholds.unsqueeze(1).unsqueeze(1).unsqueeze(1).unsqueeze(1).to(self.device)
+            self.masks = mask.repeat(len(self.timesteps), 1, 1, 1, 1).to(self.device) 
+            self.masks = self.masks > thresholds
+
+        self.latent_shift_loop = False
+        if self.loop_args is not None:
+            self.latent_shift_loop = True
+            self.is_looped = True
+            self.latent_skip = self.loop_args["shift_skip"]
+            self.latent_shift_start_percent = self.loop_args["start_percent"]
+            self.latent_shift_end_percent = self.loop_args["end_percent"]
+            self.shift_idx = 0
+
+        #clear memory before sampling
+        mm.unload_all_models()
+        mm.soft_empty_cache()
+        gc.collect()
+        try:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        except:
+            pass
+
+        # timesteps are final at this point, embed the whole schedule at once
+        self.transformer.precompute_time_embeddings(self.timesteps)
+
+        if self.checkpoint_args is not None:
+            self.checkpoint_path = os.path.join(self.checkpoint_args["checkpoint_dir"], "wanvideo_sampling_checkpoint.safetensors")
+            # a checkpoint only resumes the exact same run
+            self.checkpoint_signature = {
+                "seed": self.seed, "scheduler": self.scheduler, "shift": self.shift, "shape": list(self.latent.shape),
+                "timesteps": [float(t) for t in self.timesteps], "cfg": [float(c) for c in self.cfg],
+            }
+
+    #region model pred
+    def predict_with_cfg(self, z, cfg_scale, positive_embeds, negative_embeds, timestep, idx, image_cond=None, clip_fea=None, control_latents=None, vace_data=None, teacache_state=None, cond_cache_key=None, cfg_key=None, prompt_key=None):
+        with torch.autocast(device_type=mm.get_autocast_device(self.device), dtype=self.model["dtype"], enabled=True):
+
+            if self.use_cfg_zero_star and (idx <= self.zero_star_steps) and self.use_zero_init:
+                return z*0, None
+
+            current_step_percentage = idx / len(self.timesteps)
+            control_lora_enabled = False
+            cond_phase = None # which conditioning goes into y, the tensor itself is only built when needed
+            if control_latents is not None:
+                if self.control_lora:
+                    control_lora_enabled = True
+                else:
+                    if (self.control_start_percent <= current_step_percentage <= self.control_end_percent) or \
+                        (self.control_end_percent > 0 and idx == 0 and current_step_percentage >= self.control_start_percent):
+                        cond_phase = "control"
+                    else:
+                        cond_phase = "no_control"
+
+                if self.control_lora:
+                    if not self.control_start_percent <= current_step_percentage <= self.control_end_percent:
+                        control_lora_enabled = False
+                        if self.patcher.model.is_patched:
+                            log.info("Unloading LoRA...")
+                            self.patcher.unpatch_model(self.device)
+                            self.patcher.model.is_patched = False
+                            self.transformer.clear_cross_attn_cache()
+                            self.transformer.cond_embedding_cache.clear()
+                    else:
+                        cond_phase = "control_lora"
+                        if not self.patcher.model.is_patched:
+                            log.info("Loading LoRA...")
+                            self.patcher = apply_lora(self.patcher, self.device, self.device, low_mem_load=False)
+                            self.patcher.model.is_patched = True
+                            self.transformer.clear_cross_attn_cache()
+                            self.transformer.cond_embedding_cache.clear()
+            elif image_cond is not None:
+                cond_phase = "image"
+
+            y_cache_key = None
+            if self.transformer.enable_cond_embedding_cache and cond_cache_key is not None and cond_phase is not None:
+                y_cache_key = (cond_cache_key, cond_phase)
+
+            image_cond_input = None
+            if y_cache_key is None or y_cache_key not in self.transformer.cond_embedding_cache:
+                if cond_phase == "control":
+                    image_cond_input = torch.cat([control_latents, image_cond])
+                elif cond_phase == "no_control":
+                    image_cond_input = torch.cat([torch.zeros_like(image_cond), image_cond])
+                elif cond_phase == "control_lora":
+                    image_cond_input = control_latents.to(self.device)
+                elif cond_phase == "image":
+                    image_cond_input = image_cond
+
+            base_params = {
+                'seq_len': self.seq_len,
+                'device': self.device,
+                'freqs': self.freqs,
+                't': timestep,
+                'current_step': idx,
+                'y': [image_cond_input] if image_cond_input is not None else None,
+                'control_lora_enabled': control_lora_enabled,
+                'vace_data': vace_data if vace_data is not None else None,
+                'y_cache_key': y_cache_key,
+            }
+
+            batch_size = 1
+
+            # explicit keys of the conditioning each pass runs with, for the cross attention cache
+            clip_source = "clip" if clip_fea is not None else None
+            cond_context_key = uncond_context_key = cfg_pair_context_key = None
+            if prompt_key is not None:
+                cond_context_key = (prompt_key, "cond", clip_source)
+                uncond_context_key = (prompt_key, "uncond", "clip_neg" if self.clip_fea_neg is not None else clip_source)
+                cfg_pair_context_key = (prompt_key, "cfg_pair", clip_source)
+
+            truncated = self.adaptive_guidance is not None and self.adaptive_guidance.is_truncated(cfg_key)
+            if truncated:
+                cfg_scale = 1.0
+
+            if not math.isclose(cfg_scale, 1.0) and len(positive_embeds) > 1:
+                negative_embeds = negative_embeds * len(positive_embeds)
+
+            cfg_cache_key = None if self.cfg_cache is None or math.isclose(cfg_scale, 1.0) else cfg_key
+            slg_active = self.slg_args is not None and self.transformer.slg_start_percent <= current_step_percentage <= self.transformer.slg_end_percent
+            reuse_uncond = cfg_cache_key is not None and self.cfg_cache.ready(cfg_cache_key, idx, slg_active)
+
+            if not self.batched_cfg or reuse_uncond or truncated:
+                # with batched cfg the separate cond and uncond passes keep their own TeaCache states
+                if self.batched_cfg and truncated:
+                    pred_ids = self.adaptive_guidance.pred_ids.setdefault(cfg_key, [None, None])
+                elif self.batched_cfg:
+                    pred_ids = self.cfg_cache.pred_ids.setdefault(cfg_cache_key, [None, None])
+                else:
+                    pred_ids = [teacache_state[0] if teacache_state else None, teacache_state[1] if teacache_state and len(teacache_state) > 1 else None]
+                #cond
+                noise_pred_cond, pred_ids[0] = self.transformer(
+                    [z], context=positive_embeds, clip_fea=clip_fea, is_uncond=False, current_step_percentage=current_step_percentage,
+                    pred_id=pred_ids[0], context_cache_key=cond_context_key,
+                    **base_params
+                )
+                noise_pred_cond = noise_pred_cond[0].to(self.intermediate_device)
+                if math.isclose(cfg_scale, 1.0):
+                    if self.batched_cfg:
+                        return noise_pred_cond, [teacache_state[0] if teacache_state else None]
+                    return noise_pred_cond, [pred_ids[0]]
+                reuse_uncond = reuse_uncond and self.cfg_cache.within_drift(cfg_cache_key, noise_pred_cond)
+                if reuse_uncond:
+                    noise_pred_uncond = self.cfg_cache.uncond(cfg_cache_key, noise_pred_cond)
+                else:
+                    #uncond
+                    noise_pred_uncond, pred_ids[1] = self.transformer(
+                        [z], context=negative_embeds, clip_fea=self.clip_fea_neg if self.clip_fea_neg is not None else clip_fea, 
+                        is_uncond=True, current_step_percentage=current_step_percentage,
+                        pred_id=pred_ids[1], context_cache_key=uncond_context_key,
+                        **base_params
+                    )
+                    noise_pred_uncond = noise_pred_uncond[0].to(self.intermediate_device)
+                teacache_state_cond, teacache_state_uncond = (teacache_state[0] if teacache_state else None, None) if self.batched_cfg else pred_ids
+            #batched
+            else:
+                teacache_state_uncond = None
+                [noise_pred_cond, noise_pred_uncond], teacache_state_cond = self.transformer(
+                    [z] + [z], context=positive_embeds + negative_embeds, clip_fea=clip_fea, is_uncond=False, current_step_percentage=current_step_percentage,
+                    pred_id=teacache_state[0] if teacache_state else None, context_cache_key=cfg_pair_context_key,
+                    **base_params
+                )
+            #cfg
+
+            #https://github.com/WeichenFan/CFG-Zero-star/
+            if self.use_cfg_zero_star:
+                alpha = optimized_scale(
+                    noise_pred_cond.view(batch_size, -1),
+                    noise_pred_uncond.view(batch_size, -1)
+                ).view(batch_size, 1, 1, 1)
+                scaled_uncond = noise_pred_uncond * alpha
+                noise_pred = scaled_uncond + cfg_scale * (noise_pred_cond - scaled_uncond)
+            else:
+                scaled_uncond = noise_pred_uncond
+                noise_pred = noise_pred_uncond + cfg_scale * (noise_pred_cond - noise_pred_uncond)
+
+            if cfg_cache_key is not None and not reuse_uncond:
+                self.cfg_cache.update(cfg_cache_key, idx, noise_pred_cond, noise_pred_uncond, slg_active)
+            # only steps with a computed uncond count towards truncation
+            if self.adaptive_guidance is not None and not reuse_uncond:
+                self.adaptive_guidance.observe(cfg_key, idx, noise_pred_cond, scaled_uncond)
+
+            return noise_pred, [teacache_state_cond, teacache_state_uncond]
+
+    def predict_batch_with_cfg(self, zs, cfg_scale, positive_embeds, negative_embeds, timestep, idx, teacache_states=None, cfg_keys=None, prompt_keys=None, negative_key=None):
+        # text to video only, runs several latents (context windows or whole videos) in one forward, each keeps its own prompt and TeaCache states
+        with torch.autocast(device_type=mm.get_autocast_device(self.device), dtype=self.model["dtype"], enabled=True):
+            num_windows = len(zs)
+            if self.use_cfg_zero_star and (idx <= self.zero_star_steps) and self.use_zero_init:
+                return [z*0 for z in zs], [None] * num_windows
+
+            current_step_percentage = idx / len(self.timesteps)
+            base_params = {
+                'seq_len': self.seq_len,
+                'device': self.device,
+                'freqs': self.freqs,
+                't': timestep,
+                'current_step': idx,
+                'y': None,
+                'control_lora_enabled': False,
+                'vace_data': None,
+            }
+
+            if teacache_states is None:
+                teacache_states = [None] * num_windows
+            cond_ids = [state[0] if state else None for state in teacache_states]
+            uncond_ids = [state[1] if state and len(state) > 1 else None for state in teacache_states]
+
+            # windows whose guidance was truncated by adaptive guidance only run the cond pass
+            truncated = [False] * num_windows
+            if self.adaptive_guidance is not None and cfg_keys is not None:
+                truncated = [self.adaptive_guidance.is_truncated(key) for key in cfg_keys]
+                if all(truncated):
+                    cfg_scale = 1.0
+            active = [i for i in range(num_windows) if not truncated[i]]
+
+            # explicit keys of the conditioning each pass runs with, for the cross attention cache
+            cond_context_key = uncond_context_key = cfg_pair_context_key = None
+            if prompt_keys is not None:
+                cond_context_key = (tuple(prompt_keys), "cond", None)
+            if prompt_keys is not None and negative_key is not None:
+                uncond_context_key = ((negative_key,) * len(active), "uncond", None)
+                cfg_pair_context_key = ((*prompt_keys, *(negative_key,) * num_windows), "cfg_pair", None)
+
+            cfg_cache_keys = None if self.cfg_cache is None or math.isclose(cfg_scale, 1.0) else cfg_keys
+            slg_active = self.slg_args is not None and self.transformer.slg_start_percent <= current_step_percentage <= self.transformer.slg_end_percent
+            # the uncond pass is shared, so it's only skipped when every latent in the batch can reuse its uncond
+            reuse_uncond = cfg_cache_keys is not None and all(self.cfg_cache.ready(cfg_cache_keys[i], idx, slg_active) for i in active)
+
+            if not self.batched_cfg or reuse_uncond or len(active) < num_windows:
+                if self.batched_cfg and cfg_cache_keys is not None:
+                    # separate cond and uncond passes keep their own TeaCache states
+                    batched_ids = cond_ids, uncond_ids
+                    single_ids = [self.cfg_cache.pred_ids.setdefault(key, [None, None]) for key in cfg_cache_keys]
+                    cond_ids, uncond_ids = [ids[0] for ids in single_ids], [ids[1] for ids in single_ids]
+                #cond
+                noise_pred_cond, cond_ids = self.transformer(
+                    zs, context=positive_embeds, clip_fea=None, is_uncond=False, current_step_percentage=current_step_percentage,
+                    pred_id=cond_ids, context_cache_key=cond_context_key,
+                    **base_params
+                )
+                noise_pred_cond = [u.to(self.intermediate_device) for u in noise_pred_cond]
+                if math.isclose(cfg_scale, 1.0):
+                    return noise_pred_cond, [[cond_id] for cond_id in cond_ids]
+                reuse_uncond = reuse_uncond and all(self.cfg_cache.within_drift(cfg_cache_keys[i], noise_pred_cond[i]) for i in active)
+                noise_pred_uncond = list(noise_pred_cond)
+                if reuse_uncond:
+                    for i in active:
+                        noise_pred_uncond[i] = self.cfg_cache.uncond(cfg_cache_keys[i], noise_pred_cond[i])
+                else:
+                    #uncond
+                    active_uncond, active_ids = self.transformer(
+                        [zs[i] for i in active], context=negative_embeds * len(active), clip_fea=None, is_uncond=True, current_step_percentage=current_step_percentage,
+                        pred_id=[uncond_ids[i] for i in active], context_cache_key=uncond_context_key,
+                        **base_params
+                    )
+                    uncond_ids = list(uncond_ids)
+                    for i, uncond, uncond_id in zip(active, active_uncond, active_ids):
+                        noise_pred_uncond[i], uncond_ids[i] = uncond.to(self.intermediate_device), uncond_id
+                if self.batched_cfg and cfg_cache_keys is not None:
+                    for ids, cond_id, uncond_id in zip(single_ids, cond_ids, uncond_ids):
+                        ids[:] = [cond_id, uncond_id]
+                    cond_ids, uncond_ids = batched_ids
+            #batched
+            else:
+                noise_pred, pred_ids = self.transformer(
+                    zs + zs, context=positive_embeds + negative_embeds * num_windows, clip_fea=None, is_uncond=False, current_step_percentage=current_step_percentage,
+                    pred_id=cond_ids + uncond_ids, context_cache_key=cfg_pair_context_key,
+                    **base_params
+                )
+                noise_pred_cond, noise_pred_uncond = noise_pred[:num_windows], noise_pred[num_windows:]
+                cond_ids, uncond_ids = pred_ids[:num_windows], pred_ids[num_windows:]
+            #cfg
+            noise_preds = list(noise_pred_cond)
+            for i in active:
+                cond, uncond = noise_pred_cond[i], noise_pred_uncond[i]
+                if self.use_cfg_zero_star:
+                    alpha = optimized_scale(cond.view(1, -1), uncond.view(1, -1)).view(1, 1, 1, 1)
+                    scaled_uncond = uncond * alpha
+                    noise_preds[i] = scaled_uncond + cfg_scale * (cond - scaled_uncond)
+                else:
+                    scaled_uncond = uncond
+                    noise_preds[i] = uncond + cfg_scale * (cond - uncond)
+                if cfg_cache_keys is not None and not reuse_uncond:
+                    self.cfg_cache.update(cfg_cache_keys[i], idx, cond, uncond, slg_active)
+                if self.adaptive_guidance is not None and not reuse_uncond:
+                    self.adaptive_guidance.observe(cfg_keys[i], idx, cond, scaled_uncond)
+
+            return noise_preds, [[cond_id, uncond_id] for cond_id, uncond_id in zip(cond_ids, uncond_ids)]
+
+    #region main loop
+    def step(self, idx):
+        """Runs denoising step idx of self.timesteps."""
+        t = self.timesteps[idx]
+        if self.flowedit_args is not None:
+            if idx < self.skip_steps:
+                return
+
+        # diff diff
+        if self.masks is not None:
+            if idx < len(self.timesteps) - 1:
+                noise_timestep = self.timesteps[idx+1]
+                image_latent = self.sample_scheduler.scale_noise(
+                    self.original_image, torch.tensor([noise_timestep]), self.noise.to(self.device)
+                )
+                mask = self.masks[idx]
+                mask = mask.to(self.latent)
+                self.latent = image_latent * mask + self.latent * (1-mask)
+                # end diff diff
+
+        latent_model_input = self.latent.to(self.device)
+
+        timestep = torch.tensor([t]).to(self.device)
+        current_step_percentage = idx / len(self.timesteps)
+
+        ### latent shift
+        if self.latent_shift_loop:
+            if self.latent_shift_start_percent <= current_step_percentage <= self.latent_shift_end_percent:
+                latent_model_input = torch.cat([latent_model_input[:, self.shift_idx:]] + [latent_model_input[:, :self.shift_idx]], dim=1)
+
+        #enhance-a-video
+        if self.feta_args is not None:
+            if self.feta_start_percent <= current_step_percentage <= self.feta_end_percent:
+                enable_enhance()
+            else:
+                disable_enhance()
+        #flow-edit
+        if self.flowedit_args is not None:
+            sigma = t / 1000.0
+            sigma_prev = (self.timesteps[idx + 1] if idx < len(self.timesteps) - 1 else self.timesteps[-1]) / 1000.0
+            self.noise = torch.randn(self.x_init.shape, generator=self.seed_g, device=torch.device("cpu"))
+            if idx < len(self.timesteps) - self.drift_steps:
+                self.cfg = self.drift_cfg
+
+            zt_src = (1-sigma) * self.x_init + sigma * self.noise.to(t)
+            zt_tgt = self.x_tgt + zt_src - self.x_init
+
+            #source
+            if idx < len(self.timesteps) - self.drift_steps:
+                if self.context_options is not None:
+                    context_queue = self.window_blender.start(idx, zt_src)
+                    for window_idx, c in enumerate(context_queue):
+                        window_id = self.window_tracker.get_window_id(c)
+
+                        if self.teacache_args is not None:
+                            current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
+                        else:
+                            current_teacache = None
+
+                        prompt_index = min(int(max(c) / self.section_size), self.num_prompts - 1)
+                        if self.context_options["verbose"]:
+                            log.info(f"Prompt index: {prompt_index}")
+
+                        if len(self.source_embeds["prompt_embeds"]) > 1:
+                            positive = self.source_embeds["prompt_embeds"][prompt_index]
+                            prompt_key = ("source", prompt_index)
+                        else:
+                            positive = self.source_embeds["prompt_embeds"]
+                            prompt_key = ("source", "all")
+
+                        partial_img_emb = None
+                        if self.source_image_cond is not None:
+                            partial_img_emb = self.source_image_cond[:, c, :, :]
+                            partial_img_emb[:, 0, :, :] = self.source_image_cond[:, 0, :, :].to(self.intermediate_device)
+
+                        partial_zt_src = zt_src[:, c, :, :]
+                        vt_src_context, new_teacache = self.predict_with_cfg(
+                            partial_zt_src, self.cfg[idx], 
+                            positive, self.source_embeds["negative_prompt_embeds"],
+                            timestep, idx, partial_img_emb, self.control_latents,
+                            self.source_clip_fea, current_teacache, cond_cache_key=("source", tuple(c)), cfg_key=("source", tuple(c)), prompt_key=prompt_key)
+
+                        if self.teacache_args is not None:
+                            self.window_tracker.teacache_states[window_id] = new_teacache
+
+                        self.window_blender.add(window_idx, vt_src_context)
+                    vt_src = self.window_blender.finish()
+                else:
+                    vt_src, self.teacache_state_source = self.predict_with_cfg(
+                        zt_src, self.cfg[idx], 
+                        self.source_embeds["prompt_embeds"], 
+                        self.source_embeds["negative_prompt_embeds"],
+                        timestep, idx, self.source_image_cond, 
+                        self.source_clip_fea, self.control_latents,
+                        teacache_state=self.teacache_state_source, cond_cache_key=("source",), cfg_key=("source",), prompt_key=("source", "all"))
+            else:
+                if idx == len(self.timesteps) - self.drift_steps:
+                    self.x_tgt = zt_tgt
+                zt_tgt = self.x_tgt
+                vt_src = 0
+            #target
+            if self.context_options is not None:
+                context_queue = self.window_blender.start(idx, zt_tgt)
+                for window_idx, c in enumerate(context_queue):
+                    window_id = self.window_tracker.get_window_id(c)
+
+                    if self.teacache_args is not None:
+                        current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
+                    else:
+                        current_teacache = None
+
+                    prompt_index = min(int(max(c) / self.section_size), self.num_prompts - 1)
+                    if self.context_options["verbose"]:
+                        log.info(f"Prompt index: {prompt_index}")
+
+                    if len(self.text_embeds["prompt_embeds"]) > 1:
+                        positive = self.text_embeds["prompt_embeds"][prompt_index]
+                        prompt_key = ("target", prompt_index)
+                    else:
+                        positive = self.text_embeds["prompt_embeds"]
+                        prompt_key = ("target", "all")
+
+                    partial_img_emb = None
+                    partial_control_latents = None
+                    if self.image_cond is not None:
+                        partial_img_emb = self.image_cond[:, c, :, :]
+                        partial_img_emb[:, 0, :, :] = self.image_cond[:, 0, :, :].to(self.intermediate_device)
+                    if self.control_latents is not None:
+                        partial_control_latents = self.control_latents[:, c, :, :]
+
+                    partial_zt_tgt = zt_tgt[:, c, :, :]
+                    vt_tgt_context, new_teacache = self.predict_with_cfg(
+                        partial_zt_tgt, self.cfg[idx], 
+                        positive, self.text_embeds["negative_prompt_embeds"],
+                        timestep, idx, partial_img_emb, partial_control_latents,
+                        self.clip_fea, current_teacache, cond_cache_key=("target", tuple(c)), cfg_key=("target", tuple(c)), prompt_key=prompt_key)
+
+                    if self.teacache_args is not None:
+                        self.window_tracker.teacache_states[window_id] = new_teacache
+
+                    self.window_blender.add(window_idx, vt_tgt_context)
+                vt_tgt = self.window_blender.finish()
+            else:
+                vt_tgt, self.teacache_state = self.predict_with_cfg(
+                    zt_tgt, self.cfg[idx], 
+                    self.text_embeds["prompt_embeds"], 
+                    self.text_embeds["negative_prompt_embeds"], 
+                    timestep, idx, self.image_cond, self.clip_fea, self.control_latents,
+                    teacache_state=self.teacache_state, cond_cache_key=("target",), cfg_key=("target",), prompt_key=("target", "all"))
+            v_delta = vt_tgt - vt_src
+            self.x_tgt = self.x_tgt.to(torch.float32)
+            v_delta = v_delta.to(torch.float32)
+            self.x_tgt = self.x_tgt + (sigma_prev - sigma) * v_delta
+            self.x0 = self.x_tgt
+        #batched context windowing
+        elif self.context_options is not None and self.window_batch_size > 1:
+            context_queue = self.window_blender.start(idx, latent_model_input, looped=self.is_looped)
+
+            for batch_idxs in get_window_batches(context_queue, self.window_batch_size):
+                window_batch = [context_queue[i] for i in batch_idxs]
+                window_ids = [self.window_tracker.get_window_id(c) for c in window_batch]
+
+                if self.teacache_args is not None:
+                    current_teacaches = [self.window_tracker.get_teacache(window_id, self.teacache_state) for window_id in window_ids]
+                else:
+                    current_teacaches = None
+
+                positives, prompt_keys = [], []
+                for c in window_batch:
+                    prompt_index = min(int(max(c) / self.section_size), self.num_prompts - 1)
+                    if self.context_options["verbose"]:
+                        log.info(f"Prompt index: {prompt_index}")
+                    positives.append(self.text_embeds["prompt_embeds"][prompt_index])
+                    prompt_keys.append(("prompt", prompt_index))
+
+                noise_pred_contexts, new_teacaches = self.predict_batch_with_cfg(
+                    [latent_model_input[:, c, :, :] for c in window_batch],
+                    self.cfg[idx], positives,
+                    self.text_embeds["negative_prompt_embeds"],
+                    timestep, idx, current_teacaches, cfg_keys=[("window", tuple(c)) for c in window_batch], prompt_keys=prompt_keys,
+                    negative_key=("prompt", "negative"))
+
+                for i, window_id, noise_pred_context, new_teacache in zip(batch_idxs, window_ids, noise_pred_contexts, new_teacaches):
+                    if self.teacache_args is not None:
+                        self.window_tracker.teacache_states[window_id] = new_teacache
+                    self.window_blender.add(i, noise_pred_context)
+            noise_pred = self.window_blender.finish()
+        #context windowing
+        elif self.context_options is not None:
+            context_queue = self.window_blender.start(idx, latent_model_input, looped=self.is_looped)
+
+            for window_idx, c in enumerate(context_queue):
+                window_id = self.window_tracker.get_window_id(c)
+
+                if self.teacache_args is not None:
+                    current_teacache = self.window_tracker.get_teacache(window_id, self.teacache_state)
+                else:
+                    current_teacache = None
+
+                prompt_index = min(int(max(c) / self.section_size), self.num_prompts - 1)
+                if self.context_options["verbose"]:
+                    log.info(f"Prompt index: {prompt_index}")
+
+                # Use the appropriate prompt for this section
+                if len(self.text_embeds["prompt_embeds"]) > 1:
+                    positive = self.text_embeds["prompt_embeds"][prompt_index]
+                    prompt_key = ("prompt", prompt_index)
+                else:
+                    positive = self.text_embeds["prompt_embeds"]
+                    prompt_key = ("prompt", "all")
+
+                partial_img_emb = None
+                partial_control_latents = None
+                cond_cache_key = tuple(c)
+                if self.image_cond is not None:
+                    log.info(f"Image cond shape: {self.image_cond.shape}")
+                    num_windows= self.context_options["image_cond_window_count"]
+                    self.section_size = self.latent_video_length / num_windows
+                    image_index = min(int(max(c) / self.section_size), num_windows - 1)
+                    partial_img_emb = self.image_cond[:, c, :, :]
+                    if self.control_latents is not None:
+                        partial_control_latents = self.control_latents[:, c, :, :]
+                    partial_image_cond = self.image_cond[:, 0, :, :].to(self.intermediate_device)
+                    log.info(f"image_index: {image_index}")
+                    if hasattr(self, "previous_noise_pred_context") and image_index > 0: #wip
+                        cond_cache_key = None # the window's first frame changes between steps
+                        if idx >= self.context_options["image_cond_start_step"]:
+                            #strength = 0.5
+                            #partial_image_cond *= strength
+                            mask = torch.ones(4, partial_img_emb.shape[2], partial_img_emb.shape[3], device=partial_img_emb.device, dtype=partial_img_emb.dtype) #torch.Size([20, 10, 104, 60])
+                            if self.context_vae is not None:
+                                to_decode = self.previous_noise_pred_context[:,-1,:, :].unsqueeze(1).unsqueeze(0).to(self.context_vae.dtype)
+                                #to_decode = to_decode.permute(0, 1, 3, 2)
+                                #print("to_decode.shape", to_decode.shape)
+                                if isinstance(self.context_vae, TAEHV):
+                                    image = self.context_vae.decode_video(to_decode.permute(0, 2, 1, 3, 4), parallel=False)
+                                    image = self.context_vae.encode_video(image.repeat(1, 5, 1, 1, 1), parallel=False).permute(0, 2, 1, 3, 4)
+                                else:
+                                    image = self.context_vae.decode(to_decode, device=self.device, tiled=False)[0]
+                                    image = self.context_vae.encode(image.unsqueeze(0).to(self.context_vae.dtype), device=self.device, tiled=False)
+                                #print("decoded image.shape", image.shape) #torch.Size([3, 37, 832, 480])
+                                #print("encoded image.shape", image.shape)
+                                #partial_img_emb[:, 0, :, :] = image[0][:,0,:,:]                                        
+                                #print("partial_img_emb.shape", partial_img_emb.shape)
+                                #print("mask.shape", mask.shape)
+                                #print("self.previous_noise_pred_context.shape", self.previous_noise_pred_context.shape) #torch.Size([16, 10, 104, 60])
+                                partial_img_emb[:, 0, :, :] =  torch.cat([image[0][:,0,:,:], mask], dim=0)
+                        else:
+                            partial_img_emb[:, 0, :, :] =  partial_image_cond
+
+                partial_vace_context = None
+                if self.vace_data is not None:
+                    partial_vace_context = self.vace_data[0]["context"][0][:, c, :, :]
+                    if self.has_ref:
+                        partial_vace_context[:, 0, :, :] = self.vace_data[0]["context"][0][:, 0, :, :]
+                    partial_vace_context = [partial_vace_context]
+                partial_latent_model_input = latent_model_input[:, c, :, :]
+
+                noise_pred_context, new_teacache = self.predict_with_cfg(
+                    partial_latent_model_input, 
+                    self.cfg[idx], positive, 
+                    self.text_embeds["negative_prompt_embeds"], 
+                    timestep, idx, partial_img_emb, self.clip_fea, partial_control_latents, partial_vace_context,
+                    current_teacache, cond_cache_key=cond_cache_key, cfg_key=("window", tuple(c)), prompt_key=prompt_key)
+
+                # if callback is not None:
+                #     callback_latent = (noise_pred.to(t.device) * t / 1000).detach().permute(1,0,2,3)
+                #     callback(idx, callback_latent, None, steps)
+
+                if self.teacache_args is not None:
+                    self.window_tracker.teacache_states[window_id] = new_teacache
+                if self.image_cond is not None and image_index > 0:
+                    self.previous_noise_pred_context = noise_pred_context
+
+                self.window_blender.add(window_idx, noise_pred_context)
+            noise_pred = self.window_blender.finish()
+        #batched videos
+        elif self.batch_args is not None:
+            noise_pred = []
+            for start in range(0, self.num_videos, self.micro_batch_size):
+                end = min(start + self.micro_batch_size, self.num_videos)
+                noise_pred_batch, self.teacache_states_batch[start:end] = self.predict_batch_with_cfg(
+                    list(latent_model_input[start:end]),
+                    self.cfg[idx], self.batch_prompts[start:end],
+                    self.text_embeds["negative_prompt_embeds"],
+                    timestep, idx, self.teacache_states_batch[start:end], cfg_keys=[("video", i) for i in range(start, end)],
+                    prompt_keys=self.batch_prompt_keys[start:end], negative_key=("prompt", "negative"))
+                noise_pred.extend(noise_pred_batch)
+            noise_pred = torch.stack(noise_pred)
+        #normal inference
+        else:
+            noise_pred, self.teacache_state = self.predict_with_cfg(
+                latent_model_input, 
+                self.cfg[idx], 
+                self.text_embeds["prompt_embeds"], 
+                self.text_embeds["negative_prompt_embeds"], 
+                timestep, idx, self.image_cond, self.clip_fea, self.control_latents, self.vace_data,
+                teacache_state=self.teacache_state, cond_cache_key=("full",), cfg_key=("full",), prompt_key=("prompt", "all"))
+
+        if self.latent_shift_loop:
+            #reverse latent shift
+            if self.latent_shift_start_percent <= current_step_percentage <= self.latent_shift_end_percent:
+                noise_pred = torch.cat([noise_pred[:, self.latent_video_length - self.shift_idx:]] + [noise_pred[:, :self.latent_video_length - self.shift_idx]], dim=1)
+                self.shift_idx = (self.shift_idx + self.latent_skip) % self.latent_video_length
+
+
+        if self.flowedit_args is None:
+            self.latent = self.latent.to(self.intermediate_device)
+
+            if self.batch_args is not None: # already batched, one scheduler steps all videos
+                self.latent = self.sample_scheduler.step(
+                    noise_pred,
+                    t,
+                    self.latent,
+                    return_dict=False,
+                    generator=self.batch_generators)[0]
+            else:
+                temp_x0 = self.sample_scheduler.step(
+                    noise_pred.unsqueeze(0),
+                    t,
+                    self.latent.unsqueeze(0),
+                    return_dict=False,
+                    generator=self.seed_g)[0]
+                self.latent = temp_x0.squeeze(0)
+
+            self.x0 = self.latent.to(self.device)
+            if self.callback is not None:
+                if self.batch_args is not None: # preview the first video
+                    latent_model_input, noise_pred = latent_model_input[0], noise_pred[0]
+                callback_latent = (latent_model_input - noise_pred.to(t.device) * t / 1000).detach().permute(1,0,2,3)
+                self.callback(idx, callback_latent, None, self.steps)
+            else:
+                self.pbar.update(1)
+            del latent_model_input, timestep
+        else:
+            if self.callback is not None:
+                callback_latent = (zt_tgt - vt_tgt.to(t.device) * t / 1000).detach().permute(1,0,2,3)
+                self.callback(idx, callback_latent, None, self.steps)
+            else:
+                self.pbar.update(1)
+
+    def finalize(self):
+        """Clears the per run caches, offloads the model and returns the LATENT."""
+        if self.cfg_cache is not None:
+            log.info(self.cfg_cache.report())
+        if self.adaptive_guidance is not None:
+            log.info(self.adaptive_guidance.report())
+        if self.teacache_args is not None:
+            states = self.transformer.teacache_state.states
+            state_names = {
+                0: "conditional",
+                1: "unconditional"
+            }
+            for pred_id, state in states.items():
+                name = state_names.get(pred_id, f"prediction_{pred_id}")
+                log.info(f"TeaCache skipped: {len(state.skipped_steps)} {name} steps: {state.skipped_steps}")
+                if state.skipped_blocks:
+                    log.info(f"TeaCache skipped {sum(count for _, count in state.skipped_blocks)} {name} blocks, per step: {dict(state.skipped_blocks)}")
+            log.info(self.transformer.teacache_state.storage_report())
+            if self.transformer.teacache_state.token_caches:
+                log.info(self.transformer.teacache_state.token_cache_report())
+            if self.transformer.teacache_calibration is not None:
+                self.transformer.teacache_calibration.finish()
+                self.transformer.teacache_calibration = None
+        self.clear_run_state()
+
+        # the run finished, nothing left to resume
+        if self.checkpoint_args is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        # if transformer.attention_mode == "spargeattn_tune":
+        #     saved_state_dict = extract_sparse_attention_state_dict(transformer)
+        #     torch.save(saved_state_dict, "sparge_wan.pt")
+        #     save_torch_file(saved_state_dict, "sparge_wan.safetensors")
+
+        if self.force_offload:
+            if self.model["manual_offloading"]:
+                self.transformer.to(self.offload_device)
+                mm.soft_empty_cache()
+                gc.collect()
+
+        try:
+            print_memory(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        except:
+            pass
+
+        return {
+            "samples": self.x0.cpu() if self.batch_args is not None else self.x0.unsqueeze(0).cpu(), "looped": self.is_looped, "end_image": self.end_image if not self.fun_model else None, "has_ref": self.has_ref, "drop_last": self.drop_last,
+            }
+
+    def clear_run_state(self):
+        """Clears the per run caches and tables of the transformer, so they can't leak into the next run."""
+        transformer = getattr(self, "transformer", None)
+        if transformer is None:
+            return
+        transformer.teacache_state.clear_all()
+        transformer.teacache_calibration = None
+        transformer.rope_cache.clear()
+        transformer.clear_cross_attn_cache()
+        transformer.cond_embedding_cache.clear()
+        transformer.clear_time_embeddings()
+
+    def sample(self):
+        """Runs the whole sampling, same as the WanVideoSampler node."""
+        try:
+            self.prepare()
+            start_step = 0
+            if self.checkpoint_args is not None and self.checkpoint_args["resume"]:
+                start_step = self.resume_from_checkpoint()
+            for idx in tqdm(range(start_step, len(self.timesteps)), initial=start_step, total=len(self.timesteps)):
+                self.step(idx)
+                if self.checkpoint_args is not None and (idx + 1) % self.checkpoint_args["save_every"] == 0 and idx < len(self.timesteps) - 1:
+                    self.save_checkpoint_state(idx)
+            return self.finalize()
+        finally:
+            # also after an exception, a stale time table would drive the next caller's forward
+            self.clear_run_state()
+
+    #region checkpoints
+    def save_checkpoint_state(self, idx):
+        """Saves everything the steps after idx depend on, resuming from it gives the same result as an uninterrupted run."""
+        state = {
+            "step": idx,
+            "latent": self.latent,
+            "noise": self.noise,
+            "cfg": self.cfg,
+            "seed_g": self.seed_g.get_state(),
+            "scheduler": get_scheduler_state(self.sample_scheduler),
+            "teacache": self.transformer.teacache_state.state_dict(),
+            "teacache_state": self.teacache_state,
+            "teacache_state_source": self.teacache_state_source,
+            "teacache_states_batch": self.teacache_states_batch,
+        }
+        if self.batch_args is not None:
+            state["batch_generators"] = [g.get_state() for g in self.batch_generators]
+        if self.cfg_cache is not None:
+            state["cfg_cache"] = self.cfg_cache.state_dict()
+        if self.adaptive_guidance is not None:
+            state["adaptive_guidance"] = self.adaptive_guidance.state_dict()
+        for name in ["x_tgt", "shift_idx", "section_size", "previous_noise_pred_context"]:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        if self.context_options is not None:
+            state["window_tracker"] = {
+                "window_map": self.window_tracker.window_map,
+                "next_id": self.window_tracker.next_id,
+                "teacache_states": self.window_tracker.teacache_states,
+            }
+        save_checkpoint(self.checkpoint_path, state, self.checkpoint_signature)
+        log.info(f"Saved sampling checkpoint after step {idx + 1} to {self.checkpoint_path}")
+
+    def resume_from_checkpoint(self):
+        """Restores the state saved by save_checkpoint_state, returns the step to continue from."""
+        state = load_checkpoint(self.checkpoint_path, self.checkpoint_signature)
+        if state is None:
+            log.info(f"No sampling checkpoint found at {self.checkpoint_path}, starting from the first step")
+            return 0
+        self.seed_g.set_state(state.pop("seed_g"))
+        for g, g_state in zip(getattr(self, "batch_generators", []), state.pop("batch_generators", [])):
+            g.set_state(g_state)
+        set_scheduler_state(self.sample_scheduler, state.pop("scheduler"))
+        self.transformer.teacache_state.load_state_dict(state.pop("teacache"))
+        if "cfg_cache" in state:
+            self.cfg_cache.load_state_dict(state.pop("cfg_cache"))
+        if "adaptive_guidance" in state:
+            self.adaptive_guidance.load_state_dict(state.pop("adaptive_guidance"))
+        window_tracker = state.pop("window_tracker", None)
+        if window_tracker is not None:
+            self.window_tracker.window_map = window_tracker["window_map"]
+            self.window_tracker.next_id = window_tracker["next_id"]
+            self.window_tracker.teacache_states = window_tracker["teacache_states"]
+        step = state.pop("step")
+        for name, value in state.items():
+            setattr(self, name, value)
+        log.info(f"Resuming sampling from checkpoint {self.checkpoint_path} at step {step + 2}")
+        return step + 1
+
+class CFGCache:
+    """
+    Reuses the uncond prediction between steps. On cached steps uncond is estimated as the current cond plus
+    (uncond - cond) of the last step it was computed, so only the cond pass runs. Uncond is computed again
+    after `interval` steps, when the cond prediction drifted more than `threshold` (relative L1) since
+    then, or when SLG switched on or off. Keyed per latent, so windows and batched videos each have their own.
+    """
+    def __init__(self, interval, threshold=0.0, start_step=0, end_step=-1):
+        self.interval = interval
+        self.threshold = threshold
+        self.start_step = start_step
+        self.end_step = end_step
+        self.entries = {} # key: {"step", "cond", "delta", "slg"}
+        self.pred_ids = {} # key: TeaCache pred ids of the separate cond/uncond passes with batched cfg
+        self.computed = 0
+        self.reused = 0
+
+    def ready(self, key, idx, slg_active):
+        """Whether the uncond of key may be reused at step idx, before checking the drift"""
+        entry = self.entries.get(key)
+        if entry is None or idx < self.start_step or (self.end_step != -1 and idx > self.end_step):
+            return False
+        return idx - entry["step"] < self.interval and entry["slg"] == slg_active
+
+    def within_drift(self, key, cond):
+        entry = self.entries[key]
+        if entry["cond"].shape != cond.shape:
+            return False
+        if self.threshold <= 0:
+            return True
+        drift = (cond - entry["cond"]).abs().mean() / entry["cond"].abs().mean()
+        return drift.item() <= self.threshold
+
+    def uncond(self, key, cond):
+        self.reused += 1
+        return cond + self.entries[key]["delta"]
+
+    def update(self, key, idx, cond, uncond, slg_active):
+        self.computed += 1
+        self.entries[key] = {"step": idx, "cond": cond.clone(), "delta": uncond - cond, "slg": slg_active}
+
+    def state_dict(self):
+        return {"entries": self.entries, "pred_ids": self.pred_ids, "computed": self.computed, "reused": self.reused}
+
+    def load_state_dict(self, state):
+        self.entries, self.pred_ids = state["entries"], state["pred_ids"]
+        self.computed, self.reused = state["computed"], state["reused"]
+
+    def report(self):
+        total = self.computed + self.reused
+        return f"CFG cache: reused uncond {self.reused} of {total} times ({self.reused / max(total, 1):.0%})"
+
+class AdaptiveGuidance:
+    """
+    Truncates CFG once the cond and uncond predictions converge. Each step with a computed uncond compares
+    them, by cosine similarity (converged at or above `threshold`) or relative L1 (converged at or below it),
+    and after `consecutive_steps` converged steps in a row that latent runs cond only for the rest of the run.
+    With CFG-Zero* uncond is compared after its optimized scale. Keyed per latent like the CFG cache, so each
+    context window decides on its own.
+    """
+    def __init__(self, metric="cosine", threshold=0.99, consecutive_steps=3, start_step=0):
+        if metric not in ("cosine", "rel_l1"):
+            raise ValueError(f"Unknown adaptive guidance metric {metric}")
+        self.metric = metric
+        self.threshold = threshold
+        self.consecutive_steps = consecutive_steps
+        self.start_step = start_step
+        self.streaks = {}
+        self.truncated_at = {} # key: step the guidance was truncated at
+        self.pred_ids = {} # key: TeaCache pred ids of the cond only pass with batched cfg
+
+    def is_truncated(self, key):
+        return key in self.truncated_at
+
+    def distance(self, cond, uncond):
+        if self.metric == "cosine":
+            return torch.nn.functional.cosine_similarity(cond.flatten().float(), uncond.flatten().float(), dim=0).item()
+        return ((cond - uncond).abs().mean() / uncond.abs().mean()).item()
+
+    def observe(self, key, idx, cond, uncond):
+        value = self.distance(cond, uncond)
+        converged = value >= self.threshold if self.metric == "cosine" else value <= self.threshold
+        self.streaks[key] = self.streaks.get(key, 0) + 1 if converged and idx >= self.start_step else 0
+        name = " ".join(str(k) for k in key) if isinstance(key, tuple) else str(key)
+        if self.streaks[key] >= self.consecutive_steps:
+            self.truncated_at[key] = idx
+            log.info(f"Adaptive guidance: step {idx} {name} {self.metric} {value:.4f}, converged for {self.streaks[key]} steps, cond only from the next step")
+        else:
+            log.info(f"Adaptive guidance: step {idx} {name} {self.metric} {value:.4f}, {'converged' if converged else 'guided'} ({self.streaks[key]}/{self.consecutive_steps})")
+
+    def state_dict(self):
+        return {"streaks": self.streaks, "truncated_at": self.truncated_at, "pred_ids": self.pred_ids}
+
+    def load_state_dict(self, state):
+        self.streaks, self.truncated_at, self.pred_ids = state["streaks"], state["truncated_at"], state["pred_ids"]
+
+    def report(self):
+        if not self.truncated_at:
+            return "Adaptive guidance: guidance was never truncated"
+        return "Adaptive guidance: truncated " + ", ".join(f"{' '.join(str(k) for k in key)} at step {step}" for key, step in self.truncated_at.items())
+
+class WindowTracker:
+    def __init__(self, verbose=False):
+        self.window_map = {}  # Maps frame sequence to persistent ID
+        self.next_id = 0
+        self.teacache_states = {}  # Maps persistent ID to teacache state
+        self.verbose = verbose
+    
+    def get_window_id(self, frames):
+        key = tuple(sorted(frames))  # Order-independent frame sequence
+        if key not in self.window_map:
+            self.window_map[key] = self.next_id
+            if self.verbose:
+                log.info(f"New window pattern {key} -> ID {self.next_id}")
+            self.next_id += 1
+        return self.window_map[key]
+    
+    def get_teacache(self, window_id, base_state):
+        if window_id not in self.teacache_states:
+            if self.verbose:
+                log.info(f"Initializing persistent teacache for window {window_id}")
+            self.teacache_states[window_id] = base_state.copy()
+        return self.teacache_states[window_id]
+
+class WindowBlender:
+    """Blends context window predictions into a reused accumulator, with the window masks and the inverse counter cached per schedule."""
+    def __init__(self, get_schedule, device):
+        self.get_schedule = get_schedule  # (step, looped) -> context.ContextSchedule
+        self.device = device
+        self.schedules = {}
+        self.accumulators = {}
+        self.current = None
+        self.accumulator = None
+
+    def start(self, step, like, looped=False):
+        key = (step, looped)
+        if key not in self.schedules:
+            schedule = self.get_schedule(step, looped)
+            # contiguous windows are written through slice views instead of advanced indexing
+            indices = [slice(int(w[0]), int(w[-1]) + 1) if np.all(np.diff(w) == 1) else w for w in schedule.windows]
+            masks = [torch.tensor(w, device=self.device).view(1, -1, 1, 1) for w in schedule.weights]
+            inv_counter = torch.tensor(schedule.counter, device=self.device).reciprocal().view(1, -1, 1, 1)
+            self.schedules[key] = (schedule.windows, indices, masks, inv_counter)
+        self.current = self.schedules[key]
+
+        buffer_key = (tuple(like.shape), like.dtype)
+        if buffer_key not in self.accumulators:
+            self.accumulators[buffer_key] = torch.zeros(like.shape, dtype=like.dtype, device=self.device)
+        else:
+            self.accumulators[buffer_key].zero_()
+        self.accumulator = self.accumulators[buffer_key]
+        return self.current[0]
+
+    def add(self, window_idx, pred):
+        _, indices, masks, _ = self.current
+        index = indices[window_idx]
+        if isinstance(index, slice):
+            self.accumulator[:, index].addcmul_(pred.to(self.accumulator), masks[window_idx])
+        else:
+            self.accumulator[:, index] += pred * masks[window_idx]
+
+    def finish(self):
+        return self.accumulator * self.current[3]
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+import torch
+try:
+    from .utils import log
+except ImportError: # loaded on its own by the tests
+    import logging
+    log = logging.getLogger(__name__)
+
+# small weights that differ between finetunes of the same architecture
+HASH_KEYS = ("patch_embedding.weight", "head.head.weight")
+
+def model_hash(sd):
+    """Hash of the state dict layout and a few small weights, identifies a model without hashing the whole file"""
+    h = hashlib.sha256()
+    for key in sorted(sd):
+        h.update(f"{key}:{tuple(sd[key].shape)}:{sd[key].dtype};".encode())
+    for key in HASH_KEYS:
+        if key in sd:
+            h.update(sd[key].detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()[:16]
+
+def profile_dir():
+    """Profiles are kept in the ComfyUI user directory, or the temp directory outside of ComfyUI"""
+    try:
+        import folder_paths
+        base_dir = folder_paths.get_user_directory()
+    except ImportError:
+        base_dir = tempfile.gettempdir()
+    return os.path.join(base_dir, "wanvideo", "teacache_profiles")
+
+def profile_path(model_hash):
+    return os.path.join(profile_dir(), f"{model_hash}.json")
+
+def load_teacache_profile(model_hash):
+    """Returns the calibration profile of the model, or None if it hasn't been calibrated"""
+    if model_hash is None or not os.path.exists(profile_path(model_hash)):
+        return None
+    with open(profile_path(model_hash)) as f:
+        return json.load(f)
+
+def relative_l1(previous, current):
+    return (current - previous).abs().mean() / previous.abs().mean()
+
+class TeaCacheCalibration:
+    """
+    Records how much the modulated inputs (e and e0) and the block residual of each prediction change between
+    consecutive computed steps. At the end of a run the samples are added to the model's profile and a
+    polynomial mapping input change to residual change is fitted for both modes, the same form as the
+    built in coefficients. Samples accumulate over runs, so a few runs with different prompts and settings
+    give a better fit.
+    """
+    def __init__(self, model_hash, degree=4):
+        if model_hash is None:
+            raise ValueError("TeaCache calibration needs a model loaded with WanVideoModelLoader")
+        self.model_hash = model_hash
+        self.degree = degree
+        self.previous = {}
+        self.records = []
+
+    def record(self, pred_id, e, e0, residual):
+        previous = self.previous.get(pred_id)
+        if previous is not None:
+            # kept on the device of e until the end of the run, the residual can be on the offload device
+            self.records.append(torch.stack([
+                relative_l1(previous[0], e).float(),
+                relative_l1(previous[1], e0).float(),
+                relative_l1(previous[2], residual.to(previous[2].device)).float().to(e.device),
+            ]))
+        self.previous[pred_id] = (e.clone(), e0.clone(), residual.clone())
+
+    def finish(self):
+        """Adds the recorded samples to the profile, refits the coefficients and writes the profile"""
+        self.previous.clear()
+        if not self.records:
+            log.warning("TeaCache calibration: nothing recorded")
+            return None
+        records = torch.stack(self.records).cpu().numpy().astype(np.float64)
+        self.records.clear()
+        records = records[np.isfinite(records).all(axis=1)]
+
+        profile = load_teacache_profile(self.model_hash) or {"model_hash": self.model_hash, "runs": 0, "samples": {"e": [], "e0": []}, "coefficients": {}}
+        profile["runs"] += 1
+        for i, mode in enumerate(["e", "e0"]):
+            profile["samples"][mode].extend(records[:, [i, 2]].tolist())
+            samples = np.array(profile["samples"][mode])
+            if len(samples) > self.degree:
+                profile["coefficients"][mode] = np.polyfit(samples[:, 0], samples[:, 1], self.degree).tolist()
+
+        os.makedirs(profile_dir(), exist_ok=True)
+        with open(profile_path(self.model_hash), "w") as f:
+            json.dump(profile, f)
+        log.info(f"TeaCache calibration: {len(records)} samples recorded, {len(profile['samples']['e'])} over {profile['runs']} runs, profile written to {profile_path(self.model_hash)}")
+        for mode, coefficients in profile["coefficients"].items():
+            log.info(f"TeaCache calibration: {mode} coefficients {coefficients}")
+        return profile
@@ -0,0 +1,58 @@
+import importlib.util
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+# attention.py is loaded on its own so the test doesn't need ComfyUI
+_spec = importlib.util.spec_from_file_location(
+    "wan_attention", os.path.join(os.path.dirname(__file__), "..", "wanvideo", "modules", "attention.py"))
+attention_module = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(attention_module)
+attention = attention_module.attention
+
+MODES = ["sdpa", "sdpa_chunked"]
+
+
+def make_inputs(b=3, lq=24, lk=20, n=2, c=16):
+    torch.manual_seed(0)
+    return torch.randn(b, lq, n, c), torch.randn(b, lk, n, c), torch.randn(b, lk, n, c)
+
+
+def unpadded(q, k, v, q_lens, k_lens, mode):
+    """Each sample on its own, cut to its real length"""
+    return [attention(q[i:i + 1, :ql], k[i:i + 1, :kl], v[i:i + 1, :kl], attention_mode=mode, chunk_size=8)[0]
+            for i, (ql, kl) in enumerate(zip(q_lens, k_lens))]
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("k_lens", [[20, 7, 13], [11, 11, 11]], ids=["mixed", "equal"])
+def test_key_padding_matches_unpadded(mode, k_lens):
+    q, k, v = make_inputs()
+    for i, l in enumerate(k_lens):
+        k[i, l:] = 0
+        v[i, l:] = 0
+    out = attention(q, k, v, k_lens=torch.tensor(k_lens), attention_mode=mode, chunk_size=8)
+    for i, expected in enumerate(unpadded(q, k, v, [q.shape[1]] * len(k_lens), k_lens, mode)):
+        torch.testing.assert_close(out[i], expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("lens", [([24, 9, 17], [20, 7, 13]), ([16, 16, 16], [12, 12, 12])], ids=["mixed", "equal"])
+def test_query_and_key_padding_matches_unpadded(mode, lens):
+    q_lens, k_lens = lens
+    q, k, v = make_inputs()
+    out = attention(q, k, v, q_lens=torch.tensor(q_lens), k_lens=torch.tensor(k_lens), attention_mode=mode, chunk_size=8)
+    for i, expected in enumerate(unpadded(q, k, v, q_lens, k_lens, mode)):
+        torch.testing.assert_close(out[i, :q_lens[i]], expected, rtol=1e-5, atol=1e-5)
+        assert (out[i, q_lens[i]:] == 0).all()
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_unpadded_lengths_match_no_lengths(mode):
+    q, k, v = make_inputs()
+    full = torch.tensor([k.shape[1]] * k.shape[0])
+    torch.testing.assert_close(
+        attention(q, k, v, k_lens=full, attention_mode=mode, chunk_size=8),
+        attention(q, k, v, attention_mode=mode, chunk_size=8))
@@ -0,0 +1,43 @@
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("numpy")
+
+# teacache_calibration.py is loaded on its own so the test doesn't need ComfyUI
+_spec = importlib.util.spec_from_file_location(
+    "wan_teacache_calibration", os.path.join(os.path.dirname(__file__), "..", "teacache_calibration.py"))
+calibration = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(calibration)
+
+# the meta device stands in for the main device when there's no GPU, a mix of devices is what matters
+MAIN_DEVICE = "cuda" if torch.cuda.is_available() else "meta"
+
+
+def test_offloaded_residual_records_on_main_device():
+    calib = calibration.TeaCacheCalibration("test")
+    for step in range(3):
+        e = torch.full((1, 6, 8), step + 1.0, device=MAIN_DEVICE)
+        residual = torch.full((1, 16, 8), step + 1.0) # the offload device
+        calib.record(0, e, e.clone(), residual)
+    assert len(calib.records) == 2
+    assert all(record.device.type == MAIN_DEVICE and record.shape == (3,) for record in calib.records)
+
+
+def test_profile_written_outside_the_package(monkeypatch, tmp_path):
+    monkeypatch.setitem(sys.modules, "folder_paths", None) # outside of ComfyUI
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    calib = calibration.TeaCacheCalibration("test", degree=1)
+    for step in range(4):
+        e = torch.full((1, 6, 8), step + 1.0)
+        calib.record(0, e, e * 2, torch.full((1, 16, 8), (step + 1.0) ** 2))
+    profile = calib.finish()
+    path = tmp_path / "wanvideo" / "teacache_profiles" / "test.json"
+    assert path.exists()
+    assert json.loads(path.read_text()) == profile
+    assert len(profile["samples"]["e"]) == 3 and set(profile["coefficients"]) == {"e", "e0"}
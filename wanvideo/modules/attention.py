@@ -1,37 +1,39 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import os
+import json
+import time
+import functools
+import importlib
+import tempfile
 import torch
-
+import warnings
 try:
-    import flash_attn_interface
-    FLASH_ATTN_3_AVAILABLE = True
-except ModuleNotFoundError:
-    FLASH_ATTN_3_AVAILABLE = False
+    from ...utils import log
+except ImportError: # run directly as the benchmark script
+    import logging
+    log = logging.getLogger(__name__)
 
-try:
-    import flash_attn
-    FLASH_ATTN_2_AVAILABLE = True
-except ModuleNotFoundError:
-    FLASH_ATTN_2_AVAILABLE = False
 
-try:
-    from sageattention import sageattn
-    @torch.compiler.disable()
-    def sageattn_func(q, k, v, attn_mask=None, dropout_p=0, is_causal=False):
-        return sageattn(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal)
-except Exception as e:
-    print(f"Warning: Could not load sageattention: {str(e)}")
-    if isinstance(e, ModuleNotFoundError):
-        print("sageattention package is not installed")
-    elif isinstance(e, ImportError) and "DLL" in str(e):
-        print("sageattention DLL loading error")
-    sageattn_func = None
-import warnings
+@functools.lru_cache(maxsize=None)
+def optional_import(name):
+    """The module, or None if it's not installed. Imported on first use so unused backends cost nothing at load time."""
+    try:
+        return importlib.import_module(name)
+    except ModuleNotFoundError:
+        return None
 
 __all__ = [
     'flash_attention',
+    'chunked_attention',
     'attention',
+    'local_attention',
+    'register_attention_backend',
+    'ATTENTION_BACKENDS',
 ]
 
+# default query/key chunk size of the sdpa_chunked mode
+SDPA_CHUNK_SIZE = 1024
+
 
 def flash_attention(
     q,
@@ -62,6 +64,8 @@ def flash_attention(
     dtype:          torch.dtype. Apply when dtype of q/k/v is not float16/bfloat16.
     """
     half_dtypes = (torch.float16, torch.bfloat16)
+    flash_attn_interface = optional_import("flash_attn_interface")
+    flash_attn = optional_import("flash_attn")
     #assert dtype in half_dtypes
     #assert q.device.type == 'cuda' and q.size(-1) <= 256
 
@@ -97,13 +101,13 @@ def flash_attention(
     if q_scale is not None:
         q = q * q_scale
 
-    if version is not None and version == 3 and not FLASH_ATTN_3_AVAILABLE:
+    if version is not None and version == 3 and flash_attn_interface is None:
         warnings.warn(
             'Flash attention 3 is not available, use flash attention 2 instead.'
         )
 
     # apply attention
-    if (version is None or version == 3) and FLASH_ATTN_3_AVAILABLE:
+    if (version is None or version == 3) and flash_attn_interface is not None:
         # Note: dropout_p, window_size are not supported in FA3 now.
         x = flash_attn_interface.flash_attn_varlen_func(
             q=q,
@@ -121,7 +125,7 @@ def flash_attention(
             causal=causal,
             deterministic=deterministic)[0].unflatten(0, (b, lq))
     else:
-        assert FLASH_ATTN_2_AVAILABLE
+        assert flash_attn is not None
         x = flash_attn.flash_attn_varlen_func(
             q=q,
             k=k,
@@ -142,6 +146,267 @@ def flash_attention(
     return x.type(out_dtype)
 
 
+def chunked_attention(q, k, v, attn_mask=None, chunk_size=SDPA_CHUNK_SIZE, softmax_scale=None):
+    """
+    Attention over chunks of queries and keys, [B, N, L, C] layout like scaled_dot_product_attention.
+    The softmax of each query chunk is merged over the key chunks online (running max and sum), so at
+    most [B, N, chunk_size, chunk_size] scores exist at a time whatever the sequence length.
+    attn_mask is an optional boolean key mask broadcastable to [B, N, Lq, Lk].
+    """
+    lq, lk = q.size(2), k.size(2)
+    scale = softmax_scale if softmax_scale is not None else q.size(-1) ** -0.5
+    out = q.new_empty(*q.shape[:3], v.size(-1))
+    for qs in range(0, lq, chunk_size):
+        q_chunk = q[:, :, qs:qs + chunk_size]
+        mask = attn_mask[..., qs:qs + chunk_size, :] if attn_mask is not None and attn_mask.size(-2) > 1 else attn_mask
+        if lk <= chunk_size:
+            out[:, :, qs:qs + chunk_size] = torch.nn.functional.scaled_dot_product_attention(q_chunk, k, v, attn_mask=mask, scale=softmax_scale)
+            continue
+        row_max = row_sum = acc = None
+        for ks in range(0, lk, chunk_size):
+            scores = torch.matmul(q_chunk, k[:, :, ks:ks + chunk_size].transpose(-1, -2)).float().mul_(scale)
+            if mask is not None:
+                scores.masked_fill_(~mask[..., ks:ks + chunk_size], float("-inf"))
+            chunk_max = scores.amax(dim=-1, keepdim=True)
+            if row_max is None:
+                new_max = chunk_max
+            else:
+                new_max = torch.maximum(row_max, chunk_max)
+            probs = scores.sub_(new_max).exp_()
+            chunk_out = torch.matmul(probs.to(v.dtype), v[:, :, ks:ks + chunk_size]).float()
+            if row_max is None:
+                row_sum, acc = probs.sum(dim=-1, keepdim=True), chunk_out
+            else:
+                correction = torch.exp(row_max - new_max)
+                row_sum = row_sum.mul_(correction).add_(probs.sum(dim=-1, keepdim=True))
+                acc = acc.mul_(correction).add_(chunk_out)
+            row_max = new_max
+        out[:, :, qs:qs + chunk_size] = acc.div_(row_sum).to(out.dtype)
+    return out
+
+
+def padding_lens(lens, length):
+    """The sequence lengths as a list, or None when no sequence in the batch is padded"""
+    if lens is None:
+        return None
+    # an empty sequence (a chunk of padding only) keeps one token so softmax stays finite
+    lens = [min(max(int(l), 1), length) for l in lens.tolist()]
+    return None if all(l == length for l in lens) else lens
+
+
+def padded_attention(attn_fn, q, k, v, q_lens=None, k_lens=None, supports_mask=False):
+    """
+    Runs attn_fn, which takes [B, N, L, C] inputs like scaled_dot_product_attention, only over the real
+    tokens of zero padded sequences. Lengths shared by the whole batch are trimmed, mixed key lengths use a
+    key padding mask if the backend supports one and run sample by sample otherwise. Outputs at padded
+    query positions are zero, like the varlen flash attention path.
+    """
+    b, lq, lk = q.size(0), q.size(1), k.size(1)
+    q_lens, k_lens = padding_lens(q_lens, lq), padding_lens(k_lens, lk)
+
+    def run(q, k, v, attn_mask=None):
+        return attn_fn(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_mask).transpose(1, 2)
+
+    if q_lens is None and k_lens is None:
+        return run(q, k, v).contiguous()
+    q_lens = q_lens or [lq] * b
+    k_lens = k_lens or [lk] * b
+    if len(set(k_lens)) == 1:
+        samples = [(slice(None), k_lens[0], None)]
+    elif supports_mask:
+        attn_mask = torch.arange(lk, device=k.device)[None] < torch.tensor(k_lens, device=k.device)[:, None]
+        samples = [(slice(None), lk, attn_mask[:, None, None, :])]
+    else:
+        samples = [(slice(i, i + 1), k_lens[i], None) for i in range(b)]
+
+    max_q = max(q_lens)
+    out = None
+    if min(q_lens) < lq or len(samples) > 1:
+        out = q.new_zeros(b, lq, q.size(2), v.size(3))
+    for i, k_len, attn_mask in samples:
+        x = run(q[i, :max_q], k[i, :k_len], v[i, :k_len], attn_mask)
+        if out is None:
+            return x.contiguous()
+        out[i, :max_q] = x
+    for i, q_len in enumerate(q_lens):
+        if q_len < max_q:
+            out[i, q_len:max_q] = 0
+    return out
+
+
+class AttentionBackend:
+    """
+    An attention implementation and what it supports. The loader imports whatever the backend needs and
+    returns its attention function, it only runs the first time the backend is used or checked.
+        dtypes:         value dtypes it runs in, None for any
+        window_size:    supports sliding window attention
+        devices:        device types it runs on, None for any
+    """
+    def __init__(self, name, loader, dtypes=None, window_size=False, devices=None):
+        self.name = name
+        self.loader = loader
+        self.dtypes = dtypes
+        self.window_size = window_size
+        self.devices = devices
+        self.fn = None
+        self.error = None
+
+    @property
+    def available(self):
+        if self.fn is None and self.error is None:
+            try:
+                self.fn = self.loader()
+            except Exception as e:
+                self.error = e
+        return self.fn is not None
+
+    def supports(self, q, v, window_size=(-1, -1)):
+        if self.devices is not None and q.device.type not in self.devices:
+            return False
+        if self.dtypes is not None and v.dtype not in self.dtypes:
+            return False
+        if tuple(window_size) != (-1, -1) and not self.window_size:
+            return False
+        return self.available
+
+    def __call__(self, q, k, v, **kwargs):
+        if not self.available:
+            raise ValueError(f"Attention backend {self.name} is not available: {self.error}")
+        return self.fn(q, k, v, **kwargs)
+
+
+ATTENTION_BACKENDS = {}
+
+def register_attention_backend(name, **capabilities):
+    """
+    Decorator registering an attention backend loader, see AttentionBackend for the capabilities. The
+    loader returns a function taking q, k, v in [B, L, N, C] layout and the keyword arguments of
+    attention(), and raises if the backend can't be used.
+    """
+    def decorator(loader):
+        ATTENTION_BACKENDS[name] = AttentionBackend(name, loader, **capabilities)
+        return loader
+    return decorator
+
+
+@register_attention_backend("sdpa")
+def load_sdpa():
+    def sdpa_attention(q, k, v, q_lens=None, k_lens=None, dropout_p=0., causal=False, **kwargs):
+        def sdpa(q, k, v, attn_mask=None):
+            return torch.nn.functional.scaled_dot_product_attention(
+                q, k, v, attn_mask=attn_mask, is_causal=causal, dropout_p=dropout_p)
+        return padded_attention(sdpa, q, k, v, q_lens, k_lens, supports_mask=not causal)
+    return sdpa_attention
+
+@register_attention_backend("sdpa_chunked")
+def load_sdpa_chunked():
+    def sdpa_chunked_attention(q, k, v, q_lens=None, k_lens=None, chunk_size=None, **kwargs):
+        def sdpa_chunked(q, k, v, attn_mask=None):
+            return chunked_attention(q, k, v, attn_mask, chunk_size=chunk_size or SDPA_CHUNK_SIZE)
+        return padded_attention(sdpa_chunked, q, k, v, q_lens, k_lens, supports_mask=True)
+    return sdpa_chunked_attention
+
+@register_attention_backend("flash_attn_2", window_size=True, devices=("cuda",))
+def load_flash_attn_2():
+    if optional_import("flash_attn") is None:
+        raise ModuleNotFoundError("flash_attn is not installed")
+    def flash_attn_2(q, k, v, chunk_size=None, **kwargs):
+        return flash_attention(q, k, v, version=2, **kwargs)
+    return flash_attn_2
+
+@register_attention_backend("flash_attn_3", devices=("cuda",))
+def load_flash_attn_3():
+    if optional_import("flash_attn_interface") is None:
+        raise ModuleNotFoundError("flash_attn_interface (flash attention 3) is not installed")
+    def flash_attn_3(q, k, v, chunk_size=None, **kwargs):
+        return flash_attention(q, k, v, version=3, **kwargs)
+    return flash_attn_3
+
+@register_attention_backend("sageattn", dtypes=(torch.float16, torch.bfloat16), devices=("cuda",))
+def load_sageattn():
+    from sageattention import sageattn
+    @torch.compiler.disable()
+    def sageattn_func(q, k, v, attn_mask=None, dropout_p=0, is_causal=False):
+        return sageattn(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal)
+
+    def sageattn_attention(q, k, v, q_lens=None, k_lens=None, dropout_p=0., causal=False, **kwargs):
+        def sage(q, k, v, attn_mask=None):
+            return sageattn_func(q, k, v, attn_mask=None, is_causal=causal, dropout_p=dropout_p)
+        return padded_attention(sage, q, k, v, q_lens, k_lens)
+    return sageattn_attention
+
+
+_auto_choices = None
+
+def auto_cache_path():
+    """The auto mode choices file, in the ComfyUI user directory or the temp directory outside of ComfyUI"""
+    folder_paths = optional_import("folder_paths")
+    base_dir = folder_paths.get_user_directory() if folder_paths is not None else tempfile.gettempdir()
+    return os.path.join(base_dir, "wanvideo", "attention_auto.json")
+
+def _auto_cache():
+    global _auto_choices
+    if _auto_choices is None:
+        _auto_choices = {}
+        if os.path.exists(auto_cache_path()):
+            with open(auto_cache_path()) as f:
+                _auto_choices = json.load(f)
+    return _auto_choices
+
+def _time_backend(backend, q, k, v, kwargs, repeats=3):
+    def sync():
+        if q.device.type == "cuda":
+            torch.cuda.synchronize(q.device)
+    backend(q, k, v, **kwargs) # warmup
+    sync()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        backend(q, k, v, **kwargs)
+    sync()
+    return (time.perf_counter() - start) / repeats
+
+def _shape_bucket(n):
+    """n rounded up to a power of two"""
+    return 1 << (int(n) - 1).bit_length()
+
+@torch.compiler.disable()
+def auto_backend(q, k, v, kwargs):
+    """
+    The fastest available backend for the shape, device and dtype of the call. Candidates are timed on the
+    actual inputs the first time a shape bucket is seen and the winner is cached in auto_cache_path(). Batch
+    and sequence lengths are rounded up to powers of two and attention over a shorter context (cross
+    attention) is keyed on the query length only, so local attention tiles, trimmed text contexts and
+    varying window lengths don't each run a benchmark.
+    """
+    candidates = [backend for backend in ATTENTION_BACKENDS.values() if backend.supports(q, v, kwargs.get("window_size", (-1, -1)))]
+    device = torch.cuda.get_device_name(q.device) if q.device.type == "cuda" else q.device.type
+    b, lq, n, c = q.shape
+    shape = f"{_shape_bucket(b)}x{_shape_bucket(lq)}x{n}x{c}"
+    k_shape = "cross" if k.shape[1] < lq else str(_shape_bucket(k.shape[1]))
+    key = "|".join([device, str(v.dtype), shape, k_shape, str(tuple(kwargs.get("window_size", (-1, -1)))),
+                    ",".join(backend.name for backend in candidates)])
+    choices = _auto_cache()
+    if key not in choices:
+        timings = {}
+        for backend in candidates:
+            try:
+                timings[backend.name] = _time_backend(backend, q, k, v, kwargs)
+            except Exception as e: # out of memory or an unsupported head dim, just not a candidate
+                log.warning(f"Attention backend {backend.name} failed for {key}: {e}")
+                # release what the failed candidate left behind before the run continues
+                if q.device.type == "cuda":
+                    torch.cuda.empty_cache()
+        if not timings:
+            raise ValueError(f"No attention backend works for {key}")
+        choices[key] = min(timings, key=timings.get)
+        log.info(f"Attention auto: {choices[key]} for {key}, " + ", ".join(f"{name} {t * 1000:.2f} ms" for name, t in timings.items()))
+        cache_path = auto_cache_path()
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(choices, f, indent=1)
+    return ATTENTION_BACKENDS[choices[key]]
+
+
 def attention(
     q,
     k,
@@ -156,52 +421,136 @@ def attention(
     deterministic=False,
     dtype=torch.bfloat16,
     attention_mode='sdpa',
+    chunk_size=None,
 ):  
-    if "flash" in attention_mode:
-        if attention_mode == 'flash_attn_2':
-            fa_version = 2
-        elif attention_mode == 'flash_attn_3':
-            fa_version = 3
-        return flash_attention(
-            q=q,
-            k=k,
-            v=v,
-            q_lens=q_lens,
-            k_lens=k_lens,
-            dropout_p=dropout_p,
-            softmax_scale=softmax_scale,
-            q_scale=q_scale,
-            causal=causal,
-            window_size=window_size,
-            deterministic=deterministic,
-            dtype=dtype,
-            version=fa_version,
-        )
-    elif attention_mode == 'sdpa':
-        # if q_lens is not None or k_lens is not None:
-        #     warnings.warn(
-        #         'Padding mask is disabled when using scaled_dot_product_attention. It can have a significant impact on performance.'
-        #     )
-        attn_mask = None
-
-        q = q.transpose(1, 2)#.to(dtype)
-        k = k.transpose(1, 2)#.to(dtype)
-        v = v.transpose(1, 2)#.to(dtype)
-
-        out = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v, attn_mask=attn_mask, is_causal=causal, dropout_p=dropout_p)
-
-        out = out.transpose(1, 2).contiguous()
-        return out
-    elif attention_mode == 'sageattn':
-        attn_mask = None
-
-        q = q.transpose(1, 2)#.to(dtype)
-        k = k.transpose(1, 2)#.to(dtype)
-        v = v.transpose(1, 2)#.to(dtype)
-
-        out = sageattn_func(
-            q, k, v, attn_mask=attn_mask, is_causal=causal, dropout_p=dropout_p)
-
-        out = out.transpose(1, 2).contiguous()
-        return out
+    kwargs = dict(q_lens=q_lens, k_lens=k_lens, dropout_p=dropout_p, softmax_scale=softmax_scale, q_scale=q_scale, causal=causal,
+                  window_size=window_size, deterministic=deterministic, dtype=dtype, chunk_size=chunk_size)
+    if attention_mode == 'auto':
+        backend = auto_backend(q, k, v, kwargs)
+    elif attention_mode in ATTENTION_BACKENDS:
+        backend = ATTENTION_BACKENDS[attention_mode]
+    else:
+        raise ValueError(f"Unknown attention mode {attention_mode}, available: auto, {', '.join(ATTENTION_BACKENDS)}")
+    return backend(q, k, v, **kwargs)
+
+
+@functools.lru_cache(maxsize=16)
+def local_attention_indices(f, h, w, temporal_radius, tile_h, tile_w, device):
+    """
+    Token indices of local self attention on a (F, H, W) token grid. Queries are split into tiles of one
+    frame by tile_h x tile_w tokens, each tile attends to the frames within temporal_radius and to its
+    spatial tile grown by half a tile on every side. Returns the zero padded query and key indices of
+    the tiles [T, L], their lengths and the mask of the real query indices.
+    """
+    ids = torch.arange(f * h * w).view(f, h, w)
+    queries, keys = [], []
+    for t in range(f):
+        for y in range(0, h, tile_h):
+            for x in range(0, w, tile_w):
+                queries.append(ids[t, y:y + tile_h, x:x + tile_w].flatten())
+                keys.append(ids[max(t - temporal_radius, 0):t + temporal_radius + 1,
+                                max(y - tile_h // 2, 0):y + tile_h + tile_h // 2,
+                                max(x - tile_w // 2, 0):x + tile_w + tile_w // 2].flatten())
+    q_lens = torch.tensor([len(u) for u in queries], dtype=torch.long)
+    k_lens = torch.tensor([len(u) for u in keys], dtype=torch.long)
+    q_idx = torch.nn.utils.rnn.pad_sequence(queries, batch_first=True)
+    k_idx = torch.nn.utils.rnn.pad_sequence(keys, batch_first=True)
+    q_valid = torch.arange(q_idx.size(1))[None] < q_lens[:, None]
+    return q_idx.to(device), q_lens, k_idx.to(device), k_lens, q_valid.to(device)
+
+
+def local_attention(q, k, v, grid_sizes, window, **kwargs):
+    """
+    Attention of every token of a [B, L, N, C] video sequence to its local window only, see
+    local_attention_indices. The tiles of each frame run as one attention() batch with their query and
+    key lengths, so only one frame's gathered keys and values exist at a time. Padding tokens get zeros.
+    kwargs go to attention().
+    """
+    out = None
+    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
+        q_idx, q_lens, k_idx, k_lens, q_valid = local_attention_indices(f, h, w, *window, q.device)
+        tiles = q_idx.size(0) // f
+        for t in range(0, q_idx.size(0), tiles):
+            tile_q, tile_k, valid = q_idx[t:t + tiles], k_idx[t:t + tiles], q_valid[t:t + tiles]
+            x = attention(q[i][tile_q], k[i][tile_k], v[i][tile_k], q_lens=q_lens[t:t + tiles], k_lens=k_lens[t:t + tiles], **kwargs)
+            if out is None:
+                out = x.new_zeros(*q.shape[:3], v.size(-1))
+            out[i, tile_q[valid]] = x[valid]
+    return out
+
+
+def _benchmark_run(attention_mode, shape, dtype, device, chunk_size, repeats, grid=None, local_window=None):
+    """Seconds per call and peak memory in bytes of one attention mode, run in a fresh process on CPU"""
+    import resource
+    b, l, n, d = shape
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if device != "cpu":
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    q, k, v = (torch.randn(b, l, n, d, dtype=getattr(torch, dtype), device=device) for _ in range(3))
+
+    def run():
+        if local_window is not None:
+            return local_attention(q, k, v, torch.tensor([grid] * b), local_window, attention_mode=attention_mode, chunk_size=chunk_size)
+        return attention(q, k, v, attention_mode=attention_mode, chunk_size=chunk_size)
+
+    with torch.no_grad():
+        run()
+        if device != "cpu":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            run()
+        if device != "cpu":
+            torch.cuda.synchronize(device)
+        seconds = (time.perf_counter() - start) / repeats
+    if device != "cpu":
+        return seconds, torch.cuda.max_memory_allocated(device) - baseline
+    return seconds, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024
+
+
+def benchmark_attention(seq_lens=(4096, 16384), heads=12, head_dim=128, modes=("sdpa", "sdpa_chunked"), chunk_size=SDPA_CHUNK_SIZE, dtype="float32", device="cpu", repeats=2,
+                        grid=None, local_window=None):
+    """
+    Compares speed and peak memory (inputs included) of attention modes on the given sequence lengths.
+    With a (F, H, W) token grid the sequence is the grid, and with a local_window every mode also runs
+    as local attention over it. On CPU each run gets its own process, as the peak resident memory of a
+    process can't be reset.
+    """
+    import concurrent.futures
+    import multiprocessing
+    if grid is not None:
+        seq_lens = [grid[0] * grid[1] * grid[2]]
+    runs = [(mode, None) for mode in modes]
+    if local_window is not None:
+        runs += [(mode, tuple(local_window)) for mode in modes]
+    results = []
+    for l in seq_lens:
+        for mode, window in runs:
+            args = (mode, (1, l, heads, head_dim), dtype, device, chunk_size, repeats, tuple(grid) if grid is not None else None, window)
+            if device == "cpu":
+                with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                    seconds, peak = pool.submit(_benchmark_run, *args).result()
+            else:
+                seconds, peak = _benchmark_run(*args)
+            name = mode if window is None else f"{mode} local {window}"
+            results.append({"seq_len": l, "attention_mode": name, "seconds": seconds, "peak_mb": peak / 1024**2})
+            print(f"seq_len {l:>6} {name:>13}: {seconds * 1000:9.1f} ms, peak {peak / 1024**2:9.1f} MB")
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Attention speed and peak memory benchmark")
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[4096, 16384])
+    parser.add_argument("--heads", type=int, default=12)
+    parser.add_argument("--head_dim", type=int, default=128)
+    parser.add_argument("--modes", nargs="+", default=["sdpa", "sdpa_chunked"])
+    parser.add_argument("--chunk_size", type=int, default=SDPA_CHUNK_SIZE)
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--grid", type=int, nargs=3, default=None, help="F H W token grid, replaces --seq_lens")
+    parser.add_argument("--local_window", type=int, nargs=3, default=None, help="temporal radius, tile height and width of local attention, needs --grid")
+    args = parser.parse_args()
+    benchmark_attention(args.seq_lens, args.heads, args.head_dim, args.modes, args.chunk_size, args.dtype, args.device, args.repeats, args.grid, args.local_window)
@@ -1,5 +1,6 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import math
+import functools
 
 import torch
 import torch.nn as nn
@@ -9,7 +10,7 @@ from einops import repeat, rearrange
 from ...enhance_a_video.enhance import get_feta_scores
 from ...enhance_a_video.globals import is_enhance_enabled
 
-from .attention import attention
+from .attention import attention, local_attention
 import numpy as np
 __all__ = ['WanModel']
 
@@ -88,15 +89,27 @@ def rope_params(max_seq_len, dim, theta=10000, L_test=25, k=0):
     freqs = torch.polar(torch.ones_like(freqs), freqs)
     return freqs
 
+def rope_grid(freqs, f, h, w, c):
+    """Expand the 1D rope_params table into the per-token frequency grid for a (F, H, W) latent."""
+    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+    seq_len = f * h * w
+    return torch.cat([
+        freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
+        freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
+        freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
+    ],
+                     dim=-1).reshape(seq_len, 1, -1)
+
 from comfy.model_management import get_torch_device, get_autocast_device
 @torch.autocast(device_type=get_autocast_device(get_torch_device()), enabled=False)
 @torch.compiler.disable()
 def rope_apply(x, grid_sizes, freqs):
+    """
+    freqs can either be the rope_params table, or a list of per-sample grids
+    from rope_grid (as cached by WanModel) to skip rebuilding them on every call.
+    """
     n, c = x.size(2), x.size(3) // 2
 
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
-
     # loop over samples
     output = []
     for i, (f, h, w) in enumerate(grid_sizes.tolist()):
@@ -105,12 +118,10 @@ def rope_apply(x, grid_sizes, freqs):
         # precompute multipliers
         x_i = torch.view_as_complex(x[i, :seq_len].to(torch.float64).reshape(
             seq_len, n, -1, 2))
-        freqs_i = torch.cat([
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-                            dim=-1).reshape(seq_len, 1, -1)
+        if isinstance(freqs, list):
+            freqs_i = freqs[i]
+        else:
+            freqs_i = rope_grid(freqs, f, h, w, c)
 
         # apply rotary embedding
         x_i = torch.view_as_real(x_i * freqs_i).flatten(2)
@@ -121,6 +132,73 @@ def rope_apply(x, grid_sizes, freqs):
     return torch.stack(output).float()
 
 
+@functools.lru_cache(maxsize=16)
+def token_merge_ids(f, h, w, device):
+    """
+    Merge candidates on a (F, H, W) token grid, as source token ids and the ids of the tokens they can
+    merge into. Within even frames the three other tokens of every 2x2 cell can merge into the cell's
+    first token [3 * F/2 * H/2 * W/2]. Tokens of odd frames can merge into the token at the same position
+    of the previous or next frame [F/2 * H * W, 2], the previous one again where there's no next frame.
+    """
+    ids = torch.arange(f * h * w, device=device).view(f, h, w)
+    cells = ids[0::2, :h // 2 * 2, :w // 2 * 2]
+    spatial_src = torch.stack([cells[:, 0::2, 1::2], cells[:, 1::2, 0::2], cells[:, 1::2, 1::2]]).flatten()
+    spatial_dst = cells[:, 0::2, 0::2].unsqueeze(0).expand(3, -1, -1, -1).flatten()
+    odd = torch.arange(1, f, 2, device=device)
+    temporal_src = ids[odd].flatten()
+    temporal_dst = torch.stack([ids[odd - 1], ids[torch.where(odd + 1 < f, odd + 1, odd - 1)]], dim=-1).view(-1, 2)
+    return spatial_src, spatial_dst, temporal_src, temporal_dst
+
+@torch.compiler.disable()
+def plan_token_merge(x, f, h, w, ratio):
+    """
+    ToMe style bipartite merge plan for a [B, L, C] video sequence, see token_merge_ids for the pairs
+    considered. The ratio * L most similar (cosine) pairs are merged. Returns assign [B, L], the row of
+    the merged sequence each token goes to, and rep [B, L'], the token each row keeps the position of
+    for RoPE.
+    """
+    b, l, c = x.shape
+    spatial_src, spatial_dst, temporal_src, temporal_dst = token_merge_ids(f, h, w, x.device)
+    r = min(int(ratio * l), spatial_src.numel() + temporal_src.numel())
+    if r <= 0:
+        return None
+
+    x = x.view(b, f, h, w, c).float()
+    inv_norm = x.norm(dim=-1).clamp(min=1e-6).reciprocal()
+    h2, w2 = h // 2 * 2, w // 2 * 2
+    # within even frames, the other tokens of each 2x2 cell against its first one
+    dst, dst_inv_norm = x[:, 0::2, 0:h2:2, 0:w2:2], inv_norm[:, 0::2, 0:h2:2, 0:w2:2]
+    spatial_scores = torch.stack([
+        (x[:, 0::2, dy:h2:2, dx:w2:2] * dst).sum(-1) * inv_norm[:, 0::2, dy:h2:2, dx:w2:2] * dst_inv_norm
+        for dy, dx in [(0, 1), (1, 0), (1, 1)]
+    ], dim=1).flatten(1)
+    # odd frames against the same position in the previous and next frames
+    odd, odd_inv_norm = x[:, 1::2], inv_norm[:, 1::2]
+    previous = (odd * x[:, 0:odd.shape[1] * 2:2]).sum(-1) * odd_inv_norm * inv_norm[:, 0:odd.shape[1] * 2:2]
+    following = torch.full_like(previous, float("-inf"))
+    n = x[:, 2::2].shape[1]
+    following[:, :n] = (odd[:, :n] * x[:, 2::2]).sum(-1) * odd_inv_norm[:, :n] * inv_norm[:, 2::2]
+    temporal_scores, temporal_choice = torch.stack([previous, following], dim=-1).flatten(1, 3).max(dim=-1)
+
+    merged = torch.cat([spatial_scores, temporal_scores], dim=1).topk(r, dim=1).indices
+    src_tokens = torch.cat([spatial_src, temporal_src])[merged]
+    targets = torch.cat([spatial_dst.expand(b, -1), temporal_dst.expand(b, -1, -1).gather(2, temporal_choice.unsqueeze(-1)).squeeze(-1)], dim=1)
+    rep = torch.arange(l, device=x.device).expand(b, l).scatter(1, src_tokens, targets.gather(1, merged))
+    # odd frame tokens can merge into even frame tokens that are merged themselves, follow them to their row
+    rep = rep.gather(1, rep)
+    keep = torch.ones(b, l, dtype=torch.bool, device=x.device).scatter_(1, src_tokens, False)
+    assign = (keep.cumsum(1) - 1).gather(1, rep)
+    return assign, keep.nonzero()[:, 1].view(b, l - r)
+
+def merge_tokens(x, assign, rows):
+    """Averages the tokens assigned to each row of the merged sequence"""
+    index = assign.unsqueeze(-1).expand(-1, -1, x.shape[-1])
+    return x.new_zeros(x.shape[0], rows, x.shape[-1]).scatter_reduce_(1, index, x, "mean", include_self=False)
+
+def unmerge_tokens(x, assign):
+    return torch.gather(x, 1, assign.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+
+
 class WanRMSNorm(nn.Module):
 
     def __init__(self, dim, eps=1e-5):
@@ -154,6 +232,10 @@ class WanLayerNorm(nn.LayerNorm):
 
 
 class WanSelfAttention(nn.Module):
+    # query/key chunk size of the sdpa_chunked attention mode, set by the model loader
+    attention_chunk_size = None
+    # (temporal radius, tile height, tile width) when this block uses local attention, set by WanModel.forward_blocks
+    local_window = None
 
     def __init__(self,
                  dim,
@@ -208,21 +290,58 @@ class WanSelfAttention(nn.Module):
         if is_enhance_enabled():
             feta_scores = get_feta_scores(q, k)
 
+        if self.local_window is not None:
+            x = local_attention(q, k, v, grid_sizes, self.local_window, attention_mode=self.attention_mode, chunk_size=self.attention_chunk_size)
+        else:
+            x = attention(
+                q=q,
+                k=k,
+                v=v,
+                k_lens=seq_lens,
+                window_size=self.window_size,
+                attention_mode=self.attention_mode, chunk_size=self.attention_chunk_size)
+
+        # output
+        x = x.flatten(2)
+        x = self.o(x)
+
+        if is_enhance_enabled():
+            x *= feta_scores
+
+        return x
+
+    def forward_tokens(self, x, token_idx, seq_lens, grid_sizes, freqs, rope_func = "default"):
+        r"""
+        Attention output of only the tokens in token_idx, against the keys and values of all tokens.
+
+        Args:
+            x(Tensor): Shape [B, L, C]
+            token_idx(Tensor): Shape [B, K], indices of the tokens to compute
+        """
+        b, s, n, d = *x.shape[:2], self.num_heads, self.head_dim
+
+        q = self.norm_q(self.q(x)).view(b, s, n, d)
+        k = self.norm_k(self.k(x)).view(b, s, n, d)
+        v = self.v(x).view(b, s, n, d)
+
+        # rope needs the full grid, the queries are gathered afterwards
+        if rope_func == "comfy":
+            q, k = apply_rope_comfy(q, k, freqs)
+        else:
+            q=rope_apply(q, grid_sizes, freqs)
+            k=rope_apply(k, grid_sizes, freqs)
+        q = torch.gather(q, 1, token_idx[:, :, None, None].expand(-1, -1, n, d))
+
         x = attention(
             q=q,
             k=k,
             v=v,
             k_lens=seq_lens,
             window_size=self.window_size,
-            attention_mode=self.attention_mode)
+            attention_mode=self.attention_mode, chunk_size=self.attention_chunk_size)
 
-        # output
         x = x.flatten(2)
         x = self.o(x)
-
-        if is_enhance_enabled():
-            x *= feta_scores
-
         return x
     
     def forward_split(self, x, seq_lens, grid_sizes, freqs, seq_chunks=1,current_step=0, video_attention_split_steps = [], rope_func = "default"):
@@ -292,9 +411,9 @@ class WanSelfAttention(nn.Module):
                     q=chunk_q,
                     k=chunk_k,
                     v=chunk_v,
-                    k_lens=seq_lens,
+                    k_lens=(seq_lens - start_idx).clamp(0, end_idx - start_idx),
                     window_size=self.window_size,
-                    attention_mode=self.attention_mode)
+                    attention_mode=self.attention_mode, chunk_size=self.attention_chunk_size)
                 
                 outputs.append(chunk_out)
             
@@ -308,7 +427,7 @@ class WanSelfAttention(nn.Module):
                 v=v,
                 k_lens=seq_lens,
                 window_size=self.window_size,
-                attention_mode=self.attention_mode)
+                attention_mode=self.attention_mode, chunk_size=self.attention_chunk_size)
 
         # output
         x = x.flatten(2)
@@ -322,22 +441,46 @@ class WanSelfAttention(nn.Module):
 
 class WanT2VCrossAttention(WanSelfAttention):
 
-    def forward(self, x, context, context_lens, clip_embed=None):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # projected text/clip K/V, keyed by the conditioning they were computed from
+        self.kv_cache = {}
+
+    @torch.compiler.disable()
+    def cached_kv(self, kv_cache_key, name, kv_fn):
+        if kv_cache_key is None:
+            return kv_fn()
+        key = (kv_cache_key, name)
+        if key not in self.kv_cache:
+            self.kv_cache[key] = kv_fn()
+        return self.kv_cache[key]
+
+    def forward(self, x, context, context_lens, clip_embed=None, kv_cache_key=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
             context_lens(Tensor): Shape [B]
+            kv_cache_key: When set, the context K/V are computed once and reused for the same key
         """
+        return self.attend(x, self.context_kv(context, clip_embed, kv_cache_key), context_lens)
+
+    def context_kv(self, context, clip_embed=None, kv_cache_key=None):
+        """Projected K/V of the context, can be shared by several attend calls over chunks of the queries"""
+        b, n, d = context.size(0), self.num_heads, self.head_dim
+        return self.cached_kv(kv_cache_key, "txt", lambda: (
+            self.norm_k(self.k(context)).view(b, -1, n, d),
+            self.v(context).view(b, -1, n, d)))
+
+    def attend(self, x, kv, context_lens):
         b, n, d = x.size(0), self.num_heads, self.head_dim
+        k, v = kv
 
-        # compute query, key, value
+        # compute query
         q = self.norm_q(self.q(x)).view(b, -1, n, d)
-        k = self.norm_k(self.k(context)).view(b, -1, n, d)
-        v = self.v(context).view(b, -1, n, d)
 
         # compute attention
-        x = attention(q, k, v, k_lens=context_lens, attention_mode=self.attention_mode)
+        x = attention(q, k, v, k_lens=context_lens, attention_mode=self.attention_mode, chunk_size=self.attention_chunk_size)
 
         # output
         x = x.flatten(2)
@@ -345,7 +488,7 @@ class WanT2VCrossAttention(WanSelfAttention):
         return x
 
 
-class WanI2VCrossAttention(WanSelfAttention):
+class WanI2VCrossAttention(WanT2VCrossAttention):
 
     def __init__(self,
                  dim,
@@ -362,31 +505,43 @@ class WanI2VCrossAttention(WanSelfAttention):
         self.norm_k_img = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
         self.attention_mode = attention_mode
 
-    def forward(self, x, context, context_lens, clip_embed):
+    def forward(self, x, context, context_lens, clip_embed, kv_cache_key=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
             context_lens(Tensor): Shape [B]
+            kv_cache_key: When set, the context and clip K/V are computed once and reused for the same key
         """
         #context_img = context[:, :clip_embed.shape[1]]
         #context = context[:, clip_embed.shape[1]:]
+        return self.attend(x, self.context_kv(context, clip_embed, kv_cache_key), context_lens)
+
+    def context_kv(self, context, clip_embed=None, kv_cache_key=None):
+        """Projected K/V of the context and the clip embeds, None for the latter without clip_embed"""
+        k, v = super().context_kv(context, kv_cache_key=kv_cache_key)
+        if clip_embed is None:
+            return k, v, None, None
+        b, n, d = clip_embed.size(0), self.num_heads, self.head_dim
+        k_img, v_img = self.cached_kv(kv_cache_key, "img", lambda: (
+            self.norm_k_img(self.k_img(clip_embed)).view(b, -1, n, d),
+            self.v_img(clip_embed).view(b, -1, n, d)))
+        return k, v, k_img, v_img
+
+    def attend(self, x, kv, context_lens):
         b, n, d = x.size(0), self.num_heads, self.head_dim
+        k, v, k_img, v_img = kv
 
-        # compute query, key, value
+        # compute query
         q = self.norm_q(self.q(x)).view(b, -1, n, d)
-        k = self.norm_k(self.k(context)).view(b, -1, n, d)
-        v = self.v(context).view(b, -1, n, d)
-        if clip_embed is not None:
-            k_img = self.norm_k_img(self.k_img(clip_embed)).view(b, -1, n, d)
-            v_img = self.v_img(clip_embed).view(b, -1, n, d)
-            img_x = attention(q, k_img, v_img, k_lens=None, attention_mode=self.attention_mode)
+        if k_img is not None:
+            img_x = attention(q, k_img, v_img, k_lens=None, attention_mode=self.attention_mode, chunk_size=self.attention_chunk_size)
         # compute attention
-        x = attention(q, k, v, k_lens=context_lens, attention_mode=self.attention_mode)
+        x = attention(q, k, v, k_lens=context_lens, attention_mode=self.attention_mode, chunk_size=self.attention_chunk_size)
 
         # output
         x = x.flatten(2)
-        if clip_embed is not None:
+        if k_img is not None:
             img_x = img_x.flatten(2)
             x = x + img_x
         x = self.o(x)
@@ -400,6 +555,12 @@ WAN_CROSSATTENTION_CLASSES = {
 
 
 class WanAttentionBlock(nn.Module):
+    # share of tokens merged before self attention and the FFN, set by WanModel.forward_blocks
+    token_merge_ratio = 0.0
+    # tokens per chunk of the cross attention and FFN, None runs the whole sequence at once
+    ffn_chunk_size = None
+    # dtype of the residual stream x and the modulation, set by WanModel.forward_blocks
+    residual_stream_dtype = torch.float32
 
     def __init__(self,
                  cross_attn_type,
@@ -455,7 +616,7 @@ class WanAttentionBlock(nn.Module):
         video_attention_split_steps=[],
         rope_func = "default",
         clip_embed=None,
-        
+        kv_cache_key=None,
     ):
         r"""
         Args:
@@ -465,7 +626,22 @@ class WanAttentionBlock(nn.Module):
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
             freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
         """
-        e = (self.modulation.to(e.device) + e).chunk(6, dim=1)
+        e = (self.modulation.to(e.device, e.dtype) + e).chunk(6, dim=1)
+
+        # token merging, the blocks run on the merged sequence and every token gets the output - input of its row
+        merge = None
+        if self.token_merge_ratio > 0:
+            merge = self.plan_token_merge(x, seq_lens, grid_sizes, context, clip_embed)
+        if merge is not None:
+            assign, rep = merge
+            x_full = x
+            x = x_merged = merge_tokens(x, assign, rep.shape[1])
+            if rope_func == "comfy":
+                freqs = freqs[0][rep]
+            else:
+                freqs = [u[r] for u, r in zip(freqs, rep)]
+            grid_sizes = torch.tensor([[rep.shape[1], 1, 1]] * x.shape[0], dtype=torch.long)
+            seq_lens = torch.full((x.shape[0],), rep.shape[1], dtype=torch.long)
 
         # self-attention
         if (context.shape[0] > 1 or (clip_embed is not None and clip_embed.shape[0] > 1)) and x.shape[0] == 1:
@@ -484,24 +660,98 @@ class WanAttentionBlock(nn.Module):
             freqs, rope_func=rope_func
             )
         
-        x = x.to(torch.float32) + (y.to(torch.float32) * e[2].to(torch.float32))
+        x = self.add_residual(x, y, e[2])
 
         # cross-attention & ffn function
         if (context.shape[0] > 1 or (clip_embed is not None and clip_embed.shape[0] > 1)) and x.shape[0] == 1:
-            x = self.split_cross_attn_ffn(x, context, context_lens, e, clip_embed=clip_embed, grid_sizes=grid_sizes)
+            x = self.split_cross_attn_ffn(x, context, context_lens, e, clip_embed=clip_embed, grid_sizes=grid_sizes, kv_cache_key=kv_cache_key)
         else:
-            x = self.cross_attn_ffn(x, context, context_lens, e, clip_embed=clip_embed, grid_sizes=grid_sizes)
+            x = self.cross_attn_ffn(x, context, context_lens, e, clip_embed=clip_embed, grid_sizes=grid_sizes, kv_cache_key=kv_cache_key)
 
+        if merge is not None:
+            x = x_full.to(self.residual_stream_dtype) + unmerge_tokens(x - x_merged.to(self.residual_stream_dtype), assign)
         return x
+
+    def plan_token_merge(self, x, seq_lens, grid_sizes, context, clip_embed):
+        """Merge plan of the block input, None where merging doesn't apply: multi prompt splits, FETA, local attention or mixed sizes"""
+        if ((context.shape[0] > 1 or (clip_embed is not None and clip_embed.shape[0] > 1)) and x.shape[0] == 1) or \
+            is_enhance_enabled() or self.self_attn.local_window is not None:
+            return None
+        grids = grid_sizes.tolist()
+        f, h, w = grids[0]
+        if any(grid != grids[0] for grid in grids) or x.shape[1] != f * h * w or h < 2 or w < 2:
+            return None
+        return plan_token_merge(x, f, h, w, self.token_merge_ratio)
+
+    def forward_token_cache(self, x, token_idx, delta, e, seq_lens, grid_sizes, freqs, context, context_lens, current_step,
+                            video_attention_split_steps=[], rope_func="default", clip_embed=None, kv_cache_key=None, **kwargs):
+        r"""
+        Token cached forward, only the tokens in token_idx go through attention and the FFN, the others
+        get the block delta from the last time they were computed. Keys and values still cover all tokens.
+
+        Args:
+            token_idx(Tensor): Shape [B, K], indices of the tokens to compute
+            delta(Tensor): Shape [B, L, C], cached output - input of this block, updated in place
+        """
+        block_kwargs = dict(e=e, seq_lens=seq_lens, grid_sizes=grid_sizes, freqs=freqs, context=context, context_lens=context_lens,
+                            current_step=current_step, video_attention_split_steps=video_attention_split_steps, rope_func=rope_func,
+                            clip_embed=clip_embed, kv_cache_key=kv_cache_key, **kwargs)
+        # multi prompt splits, FETA and VACE hints work on all tokens
+        if (context.shape[0] > 1 or (clip_embed is not None and clip_embed.shape[0] > 1)) or is_enhance_enabled() or \
+            (kwargs.get("vace_hints") is not None and getattr(self, "block_id", None) is not None):
+            out = self(x, **block_kwargs)
+            delta.copy_(out - x)
+            return out
+
+        e = (self.modulation.to(e.device, e.dtype) + e).chunk(6, dim=1)
+        gather_idx = token_idx.unsqueeze(-1).expand(-1, -1, x.shape[-1])
+        x_in = torch.gather(x, 1, gather_idx).to(self.residual_stream_dtype)
+
+        y = self.self_attn.forward_tokens(self.norm1(x) * (1 + e[1]) + e[0], token_idx, seq_lens, grid_sizes, freqs, rope_func=rope_func)
+        x_tokens = self.add_residual(x_in, y, e[2])
+        x_tokens = self.cross_attn_ffn(x_tokens, context, context_lens, e, clip_embed=clip_embed, grid_sizes=grid_sizes, kv_cache_key=kv_cache_key)
+
+        delta.scatter_(1, gather_idx, (x_tokens - x_in).to(delta.dtype))
+        out = x.to(self.residual_stream_dtype) + delta.to(self.residual_stream_dtype)
+        return out.scatter_(1, gather_idx, x_tokens)
     
-    def cross_attn_ffn(self, x, context, context_lens, e, clip_embed=None, grid_sizes=None):
-            x = x + self.cross_attn(self.norm3(x), context, context_lens, clip_embed=clip_embed)
-            y = self.ffn(self.norm2(x).float() * (1 + e[4]) + e[3])
-            x = x.to(torch.float32) + (y.to(torch.float32) * e[5])
-            return x
+    def cross_attn_ffn(self, x, context, context_lens, e, clip_embed=None, grid_sizes=None, kv_cache_key=None):
+            # the context K/V are projected once, sequence chunks only run the queries, attention, output and FFN
+            kv = self.cross_attn.context_kv(context, clip_embed, kv_cache_key)
+            return self.token_chunked(x, lambda x: self.ffn_residual(x + self.cross_attn.attend(self.norm3(x), kv, context_lens), e))
+
+    def ffn_residual(self, x, e):
+        """FFN and its residual, x has to be a temporary of this block as it's updated in place with reduced precision"""
+        y = self.ffn(self.norm2(x).to(self.residual_stream_dtype) * (1 + e[4]) + e[3])
+        return self.add_residual(x, y, e[5], in_place=True)
+
+    def add_residual(self, x, y, gate, in_place=False):
+        """
+        x + y * gate in the residual stream dtype. float32 upcasts both like the original model, bfloat16
+        and float16 use one fused addcmul, in place on x when it's a temporary of this block.
+        """
+        dtype = self.residual_stream_dtype
+        if dtype == torch.float32:
+            return x.to(torch.float32) + (y.to(torch.float32) * gate.to(torch.float32))
+        if in_place and x.dtype == dtype:
+            return x.addcmul_(y.to(dtype), gate)
+        return torch.addcmul(x.to(dtype), y.to(dtype), gate)
+
+    def token_chunked(self, x, fn):
+        """
+        Runs fn, which has to work on each token independently, over ffn_chunk_size tokens of x at a time
+        into a preallocated output in the residual stream dtype. The largest activation is then the [B, chunk, ffn_dim] FFN
+        hidden state instead of [B, L, ffn_dim], with the same result.
+        """
+        if self.ffn_chunk_size is None or x.shape[1] <= self.ffn_chunk_size:
+            return fn(x)
+        out = torch.empty(x.shape, dtype=self.residual_stream_dtype, device=x.device)
+        for start in range(0, x.shape[1], self.ffn_chunk_size):
+            out[:, start:start + self.ffn_chunk_size] = fn(x[:, start:start + self.ffn_chunk_size])
+        return out
     
     @torch.compiler.disable()
-    def split_cross_attn_ffn(self, x, context, context_lens, e, clip_embed=None, grid_sizes=None):
+    def split_cross_attn_ffn(self, x, context, context_lens, e, clip_embed=None, grid_sizes=None, kv_cache_key=None):
         # Get number of prompts
         num_prompts = context.shape[0]
         num_clip_embeds = 0 if clip_embed is None else clip_embed.shape[0]
@@ -540,11 +790,15 @@ class WanAttentionBlock(nn.Module):
                 clip_idx = i % num_clip_embeds
                 segment_clip_embed = clip_embed[clip_idx:clip_idx+1]
             
+            segment_kv_cache_key = None
+            if kv_cache_key is not None:
+                segment_kv_cache_key = (kv_cache_key, prompt_idx, clip_idx if clip_embed is not None else None)
+
             # Get tensor segment
             x_segment = x[:, segment_indices, :]
             
             # Process segment with its prompt and clip embedding
-            processed_segment = self.cross_attn(self.norm3(x_segment), segment_context, segment_context_lens, clip_embed=segment_clip_embed)
+            processed_segment = self.cross_attn(self.norm3(x_segment), segment_context, segment_context_lens, clip_embed=segment_clip_embed, kv_cache_key=segment_kv_cache_key)
             processed_segment = processed_segment.to(x.dtype)
             
             # Add to combined result
@@ -552,9 +806,7 @@ class WanAttentionBlock(nn.Module):
         
         # Continue with FFN
         x = x + x_combined
-        y = self.ffn(self.norm2(x).float() * (1 + e[4]) + e[3])
-        x = x.to(torch.float32) + (y.to(torch.float32) * e[5].to(torch.float32))
-        return x            
+        return self.token_chunked(x, lambda x: self.ffn_residual(x, e))
 
 class VaceWanAttentionBlock(WanAttentionBlock):
     def __init__(
@@ -773,6 +1025,32 @@ class WanModel(ModelMixin, ConfigMixin):
         self.teacache_coefficients = teacache_coefficients
         self.teacache_use_coefficients = False
         self.teacache_mode = 'e'
+        self.teacache_calibration = None # TeaCacheCalibration recording this run
+        self.block_cache_first_blocks = 0 # block level TeaCache when > 0, see forward_block_cache
+        self.block_cache_refresh_groups = 0
+        self.token_cache_ratio = 0.0 # token level cache when > 0, see forward_token_cache
+        self.token_cache_refresh_every = 3
+        self.model_hash = None
+
+        # local self attention in local_attn_blocks between the start and end steps, see local_attention_indices
+        self.local_attn_window = None # (temporal radius, tile height, tile width) in latent tokens
+        self.local_attn_blocks = range(0)
+        self.local_attn_start_step = 0
+        self.local_attn_end_step = -1
+
+        # dtype of the residual stream between and inside the blocks, float32 or bfloat16/float16 to save the upcasts
+        self.residual_stream_dtype = torch.float32
+
+        # ToMe style token merging in token_merge_blocks between the start and end steps, see plan_token_merge
+        self.token_merge_ratio = 0.0
+        self.token_merge_blocks = range(0)
+        self.token_merge_start_step = 0
+        self.token_merge_end_step = -1
+
+        # time embeddings of the whole schedule, see precompute_time_embeddings
+        self.time_embeddings = None
+        self.time_embeddings_cpu = None
+        self.time_embeddings_timesteps = None
 
         self.slg_blocks = None
         self.slg_start_percent = 0.0
@@ -782,6 +1060,20 @@ class WanModel(ModelMixin, ConfigMixin):
 
         self.video_attention_split_steps = []
 
+        # pad the text context only to the longest prompt in the batch instead of text_len
+        self.trim_text_context = False
+
+        # RoPE frequency grids, built once per sampling run and shared by all blocks/steps/windows
+        self.rope_cache = {}
+
+        # patch embedding of the constant conditioning channels (image_cond, mask, control latents)
+        self.enable_cond_embedding_cache = False
+        self.cond_embedding_cache = {}
+
+        # text/clip embeddings and cross-attention K/V, reused across steps for the same conditioning
+        self.enable_cross_attn_cache = False
+        self.cross_attn_cache = {}
+
         # embeddings
         self.patch_embedding = nn.Conv3d(
             in_dim, dim, kernel_size=patch_size, stride=patch_size)
@@ -898,6 +1190,220 @@ class WanModel(ModelMixin, ConfigMixin):
         log.info(f"Non-blocking memory transfer: {self.use_non_blocking}")
         log.info("----------------------")
 
+    def embed_timesteps(self, t):
+        with torch.autocast(device_type='cuda', dtype=torch.float32):
+            e = self.time_embedding(
+                sinusoidal_embedding_1d(self.freq_dim, t).float())
+            e0 = self.time_projection(e).unflatten(1, (6, self.dim))
+            assert e.dtype == torch.float32 and e0.dtype == torch.float32
+        return e, e0
+
+    def precompute_time_embeddings(self, timesteps):
+        """
+        Embeds the whole timestep schedule in one batched call, forward then looks up
+        the row for current_step instead of running the time embedding every call.
+        A host copy is kept for the TeaCache distances so they don't need device syncs.
+        """
+        e, e0 = self.embed_timesteps(timesteps.to(self.main_device))
+        self.time_embeddings = (e, e0)
+        self.time_embeddings_cpu = (e.cpu(), e0.cpu())
+        self.time_embeddings_timesteps = timesteps.cpu()
+
+    def clear_time_embeddings(self):
+        self.time_embeddings = None
+        self.time_embeddings_cpu = None
+        self.time_embeddings_timesteps = None
+
+    def time_table_matches(self, t, current_step):
+        """Whether t is the timestep of current_step in the precomputed table, other timesteps are embedded directly"""
+        timesteps = self.time_embeddings_timesteps
+        return current_step < len(timesteps) and bool((t.cpu().to(timesteps.dtype) == timesteps[current_step]).all())
+
+    def teacache_time_distance(self, previous_step, current_step):
+        """TeaCache relative L1 distance between the time embeddings of two steps, from the host table"""
+        e, e0 = self.time_embeddings_cpu
+        temb = e if (self.teacache_use_coefficients and self.teacache_mode == 'e') else e0
+        previous, current = temb[previous_step], temb[current_step]
+        distance = ((current - previous).abs().mean() / previous.abs().mean()).item()
+        if self.teacache_use_coefficients:
+            distance = np.poly1d(self.teacache_coefficients[self.teacache_mode])(distance)
+        return float(distance)
+
+    def teacache_rescale(self, distance):
+        """TeaCache rescale polynomial evaluated on the device of distance (Horner), so it needs no host sync"""
+        result = torch.zeros_like(distance)
+        for coefficient in self.teacache_coefficients[self.teacache_mode]:
+            result = result * distance + coefficient
+        return result
+
+    def clear_cross_attn_cache(self):
+        """Drop cached text/clip embeddings and K/V, needed whenever the weights change (LoRA patch/unpatch)"""
+        self.cross_attn_cache.clear()
+        for module in self.modules():
+            if isinstance(module, WanT2VCrossAttention):
+                module.kv_cache.clear()
+
+    def embed_with_cached_cond(self, patch_embedding, x, y, y_cache_key):
+        """
+        The patch embedding is a linear non-overlapping Conv3d, so embedding cat([x, y]) equals
+        embedding x and y separately with the matching weight slices and summing. The y part
+        (plus bias) is constant over the run and only computed once per y_cache_key.
+        """
+        in_x = x[0].shape[0]
+        weight, stride = patch_embedding.weight, patch_embedding.stride
+        if y_cache_key not in self.cond_embedding_cache:
+            self.cond_embedding_cache[y_cache_key] = [
+                torch.nn.functional.conv3d(v.unsqueeze(0), weight[:, in_x:], patch_embedding.bias, stride=stride)
+                for v in y
+            ]
+        y_embeds = self.cond_embedding_cache[y_cache_key]
+        out = []
+        for u, v in zip(x, y_embeds):
+            u = torch.nn.functional.conv3d(u.unsqueeze(0), weight[:, :in_x], None, stride=stride)
+            out.append((u.float() + v.float()).to(u.dtype))
+        return out
+
+    def get_rope_freqs(self, freqs, grid_sizes, device):
+        """Per-sample rope_apply frequency grids, cached for the whole sampling run"""
+        d = self.dim // self.num_heads
+        out = []
+        for f, h, w in grid_sizes.tolist():
+            key = ("default", f, h, w, d, self.rope_embedder.k, self.rope_embedder.num_frames, device)
+            if key not in self.rope_cache:
+                self.rope_cache[key] = rope_grid(freqs.to(device), f, h, w, d // 2)
+            out.append(self.rope_cache[key])
+        return out
+
+    def get_rope_freqs_comfy(self, F, H, W, device, dtype):
+        """Comfy RoPE (RIFLEx) frequencies for the latent size, cached for the whole sampling run"""
+        f_len = ((F + (self.patch_size[0] // 2)) // self.patch_size[0])
+        h_len = ((H + (self.patch_size[1] // 2)) // self.patch_size[1])
+        w_len = ((W + (self.patch_size[2] // 2)) // self.patch_size[2])
+        key = ("comfy", f_len, h_len, w_len, self.dim // self.num_heads, self.rope_embedder.k, self.rope_embedder.num_frames, device, dtype)
+        if key not in self.rope_cache:
+            img_ids = torch.zeros((f_len, h_len, w_len, 3), device=device, dtype=dtype)
+            img_ids[:, :, :, 0] = img_ids[:, :, :, 0] + torch.linspace(0, f_len - 1, steps=f_len, device=device, dtype=dtype).reshape(-1, 1, 1)
+            img_ids[:, :, :, 1] = img_ids[:, :, :, 1] + torch.linspace(0, h_len - 1, steps=h_len, device=device, dtype=dtype).reshape(1, -1, 1)
+            img_ids[:, :, :, 2] = img_ids[:, :, :, 2] + torch.linspace(0, w_len - 1, steps=w_len, device=device, dtype=dtype).reshape(1, 1, -1)
+            img_ids = repeat(img_ids, "t h w c -> b (t h w) c", b=1)
+            self.rope_cache[key] = self.rope_embedder(img_ids).movedim(1, 2)
+        return self.rope_cache[key]
+
+    def forward_blocks(self, x, block_indices, kwargs, is_uncond, current_step_percentage, block_fn=None):
+        current_step = kwargs["current_step"]
+        local_window = self.local_attn_window
+        if current_step < self.local_attn_start_step or (self.local_attn_end_step != -1 and current_step > self.local_attn_end_step):
+            local_window = None
+        token_merge_ratio = self.token_merge_ratio
+        if current_step < self.token_merge_start_step or (self.token_merge_end_step != -1 and current_step > self.token_merge_end_step):
+            token_merge_ratio = 0.0
+        for b in block_indices:
+            block = self.blocks[b]
+            block.self_attn.local_window = local_window if b in self.local_attn_blocks else None
+            block.token_merge_ratio = token_merge_ratio if b in self.token_merge_blocks else 0.0
+            block.residual_stream_dtype = self.residual_stream_dtype
+            if self.slg_blocks is not None:
+                if b in self.slg_blocks and is_uncond:
+                    if self.slg_start_percent <= current_step_percentage <= self.slg_end_percent:
+                        continue
+            if b <= self.blocks_to_swap and self.blocks_to_swap >= 0:
+                block.to(self.main_device)
+            x = x.to(self.residual_stream_dtype)
+            x = block(x, **kwargs) if block_fn is None else block_fn(b, block, x)
+            if b <= self.blocks_to_swap and self.blocks_to_swap >= 0:
+                block.to(self.offload_device, non_blocking=self.use_non_blocking)
+        return x
+
+    def forward_token_cache(self, x, pred_ids, kwargs, current_step, is_uncond, current_step_percentage):
+        """
+        Token level cache: every token_cache_refresh_every steps all tokens are computed and each block's
+        delta (output - input) is cached. In between only the token_cache_ratio of tokens whose input embedding
+        changed the most since they were last computed go through the blocks, the others reuse their cached
+        deltas. The cache is kept per batch of predictions in bf16 on the main device, one delta per block.
+        """
+        cache = self.teacache_state.token_cache(tuple(pred_ids))
+        full = (cache["input"] is None or cache["input"].shape != x.shape or
+                current_step - cache["full_step"] >= self.token_cache_refresh_every)
+        if full:
+            cache["input"] = x.to(torch.bfloat16)
+            cache["deltas"] = [None] * len(self.blocks)
+            cache["full_step"] = current_step
+            def block_fn(b, block, x):
+                out = block(x, **kwargs)
+                cache["deltas"][b] = (out - x).to(torch.bfloat16)
+                return out
+            tokens = x.shape[1]
+        else:
+            previous = cache["input"].to(torch.float32)
+            change = (x.to(torch.float32) - previous).norm(dim=-1) / previous.norm(dim=-1).clamp(min=1e-6)
+            tokens = max(1, math.ceil(self.token_cache_ratio * x.shape[1]))
+            token_idx = change.topk(tokens, dim=1).indices.sort(dim=1).values
+            gather_idx = token_idx.unsqueeze(-1).expand(-1, -1, x.shape[-1])
+            cache["input"].scatter_(1, gather_idx, torch.gather(x, 1, gather_idx).to(torch.bfloat16))
+            def block_fn(b, block, x):
+                if cache["deltas"][b] is None: # skipped by SLG on the full step
+                    cache["deltas"][b] = torch.zeros_like(x, dtype=torch.bfloat16)
+                return block.forward_token_cache(x, token_idx, cache["deltas"][b], **kwargs)
+
+        x = self.forward_blocks(x, range(len(self.blocks)), kwargs, is_uncond, current_step_percentage, block_fn=block_fn)
+        cache["computed_tokens"] += tokens * x.shape[0]
+        cache["total_tokens"] += x.shape[1] * x.shape[0]
+        return x
+
+    def forward_block_cache(self, x, pred_ids, kwargs, current_step, is_uncond, current_step_percentage):
+        """
+        Block level TeaCache: the first blocks always run and their residual is compared to the one of the last
+        computed step. If every prediction in the batch changed less than rel_l1_thresh, the cached residuals
+        of the remaining blocks are added instead of running them. The remaining blocks are split into
+        block_cache_refresh_groups groups with a cached residual each, on cached steps one group in turn is
+        still computed to keep its residual fresh.
+        """
+        first_blocks = min(self.block_cache_first_blocks, len(self.blocks))
+        groups = max(1, min(self.block_cache_refresh_groups, len(self.blocks) - first_blocks))
+        bounds = [first_blocks + round(i * (len(self.blocks) - first_blocks) / groups) for i in range(groups + 1)]
+
+        x_input = x
+        x = self.forward_blocks(x, range(first_blocks), kwargs, is_uncond, current_step_percentage)
+        first_residuals = (x - x_input).chunk(len(pred_ids))
+
+        states = [self.teacache_state.get(p_id) for p_id in pred_ids]
+        use_cache = all(state.previous_first_residual is not None and state.previous_residual is not None and
+                        state.previous_first_residual.shape == first_residual.shape for state, first_residual in zip(states, first_residuals))
+        if use_cache:
+            # one sync for the whole batch
+            distances = torch.stack([relative_l1_distance(state.previous_first_residual.float(), first_residual) for state, first_residual in zip(states, first_residuals)])
+            use_cache = bool((distances < self.rel_l1_thresh).all())
+
+        if not use_cache:
+            for state, first_residual in zip(states, first_residuals):
+                # compared in bf16 to halve the memory, it's only a change estimate
+                if state.previous_first_residual is not None and state.previous_first_residual.shape == first_residual.shape:
+                    state.previous_first_residual.copy_(first_residual)
+                else:
+                    state.previous_first_residual = first_residual.to(torch.bfloat16)
+            for p_id, first_residual in zip(pred_ids, first_residuals):
+                self.teacache_state.residual_buffer(p_id, (groups, *first_residual.shape))
+        refresh_group = current_step % groups if use_cache and groups > 1 else None
+
+        for g in range(groups):
+            if use_cache and g != refresh_group:
+                x = x.to(self.residual_stream_dtype)
+                for p_id, x_chunk in zip(pred_ids, x.chunk(len(pred_ids))):
+                    x_chunk.add_(self.teacache_state.load_residual(p_id, x.device, non_blocking=self.use_non_blocking, index=g))
+                continue
+            group_input = x
+            x = self.forward_blocks(x, range(bounds[g], bounds[g + 1]), kwargs, is_uncond, current_step_percentage)
+            for p_id, x_chunk, input_chunk in zip(pred_ids, x.chunk(len(pred_ids)), group_input.chunk(len(pred_ids))):
+                if self.teacache_state.get(p_id).previous_residual is not None:
+                    self.teacache_state.store_residual(p_id, x_chunk - input_chunk, non_blocking=self.use_non_blocking, index=g)
+
+        if use_cache:
+            skipped_blocks = bounds[-1] - bounds[0] - (bounds[refresh_group + 1] - bounds[refresh_group] if refresh_group is not None else 0)
+            for state in states:
+                state.skipped_steps.append(current_step)
+                state.skipped_blocks.append((current_step, skipped_blocks))
+        return x
+
     def forward_vace(
         self,
         x,
@@ -918,6 +1424,7 @@ class WanModel(ModelMixin, ConfigMixin):
         
         c_list = [c]
         for b, block in enumerate(self.vace_blocks):
+            block.residual_stream_dtype = self.residual_stream_dtype
             if b <= self.vace_blocks_to_swap and self.vace_blocks_to_swap >= 0:
                 block.to(self.main_device)
             c_list = block(
@@ -948,6 +1455,8 @@ class WanModel(ModelMixin, ConfigMixin):
         pred_id=None,
         control_lora_enabled=False,
         vace_data = None,
+        y_cache_key=None,
+        context_cache_key=None,
     ):
         r"""
         Forward pass through the diffusion model
@@ -965,6 +1474,12 @@ class WanModel(ModelMixin, ConfigMixin):
                 CLIP image features for image-to-video mode
             y (List[Tensor], *optional*):
                 Conditional video inputs for image-to-video mode, same shape as x
+            y_cache_key (*optional*):
+                Identifies y, its patch embedding is computed once and reused for the same key,
+                y can be None once the key is cached
+            context_cache_key (*optional*):
+                Identifies context and clip_fea, with the cross attention cache enabled their embeddings
+                and cross attention K/V are computed once and reused for the same key
 
         Returns:
             List[Tensor]:
@@ -972,25 +1487,24 @@ class WanModel(ModelMixin, ConfigMixin):
         """        
         # params
         device = self.patch_embedding.weight.device
-        if freqs is not None and freqs.device != device:
-           freqs = freqs.to(device)
 
         _, F, H, W = x[0].shape
-            
-        if y is not None:
-            x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
 
         # embeddings
         if control_lora_enabled:
             self.expanded_patch_embedding.to(device)
-            x = [
-            self.expanded_patch_embedding(u.unsqueeze(0))
-            for u in x
-            ]
+            patch_embedding = self.expanded_patch_embedding
         else:
             self.original_patch_embedding.to(self.main_device)
+            patch_embedding = self.original_patch_embedding
+
+        if y_cache_key is not None:
+            x = self.embed_with_cached_cond(patch_embedding, x, y, y_cache_key)
+        else:
+            if y is not None:
+                x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
             x = [
-            self.original_patch_embedding(u.unsqueeze(0))
+            patch_embedding(u.unsqueeze(0))
             for u in x
             ]
 
@@ -999,103 +1513,144 @@ class WanModel(ModelMixin, ConfigMixin):
         x = [u.flatten(2).transpose(1, 2) for u in x]
         seq_lens = torch.tensor([u.size(1) for u in x], dtype=torch.long)
         assert seq_lens.max() <= seq_len
+        # only padded to the longest sequence of the batch, attention skips the padding through seq_lens
+        max_len = int(seq_lens.max())
         x = torch.cat([
-            torch.cat([u, u.new_zeros(1, seq_len - u.size(1), u.size(2))],
+            torch.cat([u, u.new_zeros(1, max_len - u.size(1), u.size(2))],
                       dim=1) for u in x
         ])
 
         if freqs is None: #comfy rope
             rope_func = "comfy"
-            f_len = ((F + (self.patch_size[0] // 2)) // self.patch_size[0])
-            h_len = ((H + (self.patch_size[1] // 2)) // self.patch_size[1])
-            w_len = ((W + (self.patch_size[2] // 2)) // self.patch_size[2])
-            img_ids = torch.zeros((f_len, h_len, w_len, 3), device=x.device, dtype=x.dtype)
-            img_ids[:, :, :, 0] = img_ids[:, :, :, 0] + torch.linspace(0, f_len - 1, steps=f_len, device=x.device, dtype=x.dtype).reshape(-1, 1, 1)
-            img_ids[:, :, :, 1] = img_ids[:, :, :, 1] + torch.linspace(0, h_len - 1, steps=h_len, device=x.device, dtype=x.dtype).reshape(1, -1, 1)
-            img_ids[:, :, :, 2] = img_ids[:, :, :, 2] + torch.linspace(0, w_len - 1, steps=w_len, device=x.device, dtype=x.dtype).reshape(1, 1, -1)
-            img_ids = repeat(img_ids, "t h w c -> b (t h w) c", b=1)
-
-            freqs = self.rope_embedder(img_ids).movedim(1, 2)
+            freqs = self.get_rope_freqs_comfy(F, H, W, device=x.device, dtype=x.dtype)
         else:
             rope_func = "default"
+            freqs = self.get_rope_freqs(freqs, grid_sizes, device=device)
 
         # time embeddings
-        with torch.autocast(device_type='cuda', dtype=torch.float32):
-            e = self.time_embedding(
-                sinusoidal_embedding_1d(self.freq_dim, t).float())
-            e0 = self.time_projection(e).unflatten(1, (6, self.dim))
-            assert e.dtype == torch.float32 and e0.dtype == torch.float32
+        use_time_table = self.time_embeddings is not None and self.time_table_matches(t, current_step)
+        if use_time_table:
+            e, e0 = self.time_embeddings[0][current_step:current_step + 1], self.time_embeddings[1][current_step:current_step + 1]
+        else:
+            e, e0 = self.embed_timesteps(t)
+
+        kv_cache_key = context_cache_key if self.enable_cross_attn_cache else None
 
         # context
         context_lens = None
-        if self.offload_txt_emb:
-            self.text_embedding.to(self.main_device)
-        context = self.text_embedding(
-            torch.stack([
-                torch.cat(
-                    [u, u.new_zeros(self.text_len - u.size(0), u.size(1))])
-                for u in context
-            ]))
-        if self.offload_txt_emb:
-            self.text_embedding.to(self.offload_device, non_blocking=self.use_non_blocking)
+        text_len = self.text_len
+        if self.trim_text_context:
+            text_len = max(u.size(0) for u in context)
+            lens = [u.size(0) for u in context]
+            if min(lens) < text_len:
+                context_lens = torch.tensor(lens, dtype=torch.long)
+        if kv_cache_key is not None and ("context", kv_cache_key) in self.cross_attn_cache:
+            context = self.cross_attn_cache[("context", kv_cache_key)]
+        else:
+            if self.offload_txt_emb:
+                self.text_embedding.to(self.main_device)
+            context = self.text_embedding(
+                torch.stack([
+                    torch.cat(
+                        [u, u.new_zeros(text_len - u.size(0), u.size(1))])
+                    for u in context
+                ]))
+            if self.offload_txt_emb:
+                self.text_embedding.to(self.offload_device, non_blocking=self.use_non_blocking)
+            if kv_cache_key is not None:
+                self.cross_attn_cache[("context", kv_cache_key)] = context
 
         clip_embed = None
         if clip_fea is not None:
-            clip_fea = clip_fea.to(self.main_device)
-            if self.offload_img_emb:
-                self.img_emb.to(self.main_device)
-            clip_embed = self.img_emb(clip_fea)  # bs x 257 x dim
-            #context = torch.concat([context_clip, context], dim=1)
-            if self.offload_img_emb:
-                self.img_emb.to(self.offload_device, non_blocking=self.use_non_blocking)
+            if kv_cache_key is not None and ("clip", kv_cache_key) in self.cross_attn_cache:
+                clip_embed = self.cross_attn_cache[("clip", kv_cache_key)]
+            else:
+                clip_fea = clip_fea.to(self.main_device)
+                if self.offload_img_emb:
+                    self.img_emb.to(self.main_device)
+                clip_embed = self.img_emb(clip_fea)  # bs x 257 x dim
+                #context = torch.concat([context_clip, context], dim=1)
+                if self.offload_img_emb:
+                    self.img_emb.to(self.offload_device, non_blocking=self.use_non_blocking)
+                if kv_cache_key is not None:
+                    self.cross_attn_cache[("clip", kv_cache_key)] = clip_embed
+
+        # pred_id can be a list of TeaCache states, each covering an equal chunk of the batch (batched context windows)
+        pred_id_list = isinstance(pred_id, list)
+        pred_ids = list(pred_id) if pred_id_list else [pred_id]
 
         should_calc = True
-        accumulated_rel_l1_distance = torch.tensor(0.0, dtype=torch.float32, device=device)
-        if self.enable_teacache and self.teacache_start_step <= current_step <= self.teacache_end_step:
-            if pred_id is None:
-                pred_id = self.teacache_state.new_prediction(cache_device=self.teacache_cache_device)
-                #log.info(current_step)
-                #log.info(f"TeaCache: Initializing TeaCache variables for model pred: {pred_id}")
-                should_calc = True                
-            else:
-                previous_modulated_input = self.teacache_state.get(pred_id)['previous_modulated_input']
-                previous_modulated_input = previous_modulated_input.to(device)
-                previous_residual = self.teacache_state.get(pred_id)['previous_residual']
-                accumulated_rel_l1_distance = self.teacache_state.get(pred_id)['accumulated_rel_l1_distance']
-
-                if self.teacache_use_coefficients:
-                    rescale_func = np.poly1d(self.teacache_coefficients[self.teacache_mode])
-                    temb = e if self.teacache_mode == 'e' else e0
-                    accumulated_rel_l1_distance += rescale_func(((temb-previous_modulated_input).abs().mean() / previous_modulated_input.abs().mean()).cpu().item())
+        accumulated_rel_l1_distances = [0.0 if use_time_table else torch.zeros((), dtype=torch.float32, device=device) for _ in pred_ids]
+        if self.enable_teacache and not use_time_table:
+            modulated_input = e if (self.teacache_use_coefficients and self.teacache_mode == 'e') else e0
+        teacache_in_range = self.enable_teacache and self.teacache_start_step <= current_step <= self.teacache_end_step
+        use_block_cache = teacache_in_range and self.block_cache_first_blocks > 0
+        use_token_cache = teacache_in_range and self.token_cache_ratio > 0
+        if use_block_cache or use_token_cache:
+            # the cache decisions are made while running the blocks, see forward_block_cache and forward_token_cache
+            pred_ids = [self.teacache_state.new_prediction(cache_device=self.teacache_cache_device) if p_id is None else p_id for p_id in pred_ids]
+        elif teacache_in_range:
+            calc_decisions = []
+            for i, p_id in enumerate(pred_ids):
+                if p_id is None:
+                    pred_ids[i] = self.teacache_state.new_prediction(cache_device=self.teacache_cache_device)
+                    #log.info(current_step)
+                    #log.info(f"TeaCache: Initializing TeaCache variables for model pred: {pred_id}")
+                    calc_decisions.append(True)
+                    continue
+                state = self.teacache_state.get(p_id)
+                if state.previous_residual is None: # evicted to stay within the memory budget
+                    calc_decisions.append(True)
+                    continue
+
+                if use_time_table:
+                    accumulated_rel_l1_distance = state.accumulated_rel_l1_distance + self.teacache_time_distance(state.previous_step, current_step)
+                    calc_decisions.append(not accumulated_rel_l1_distance < self.rel_l1_thresh)
                 else:
-                    temb_relative_l1 = relative_l1_distance(previous_modulated_input, e0)
-                    accumulated_rel_l1_distance = accumulated_rel_l1_distance.to(e0.device) + temb_relative_l1
+                    # kept on device, the decisions of the whole batch are synced once below
+                    prev_modulated_input = state.previous_modulated_input
+                    if self.teacache_use_coefficients:
+                        rel_l1 = (modulated_input - prev_modulated_input).abs().mean() / prev_modulated_input.abs().mean()
+                        accumulated_rel_l1_distance = state.accumulated_rel_l1_distance + self.teacache_rescale(rel_l1.to(torch.float32))
+                    else:
+                        accumulated_rel_l1_distance = state.accumulated_rel_l1_distance + relative_l1_distance(prev_modulated_input, e0)
+                    calc_decisions.append(accumulated_rel_l1_distance >= self.rel_l1_thresh)
 
                 #print("accumulated_rel_l1_distance", accumulated_rel_l1_distance)
-
-                if accumulated_rel_l1_distance < self.rel_l1_thresh:
-                    should_calc = False
-                else:
-                    should_calc = True
-                    accumulated_rel_l1_distance = torch.tensor(0.0, dtype=torch.float32, device=device)
-
-            previous_modulated_input = e.clone() if (self.teacache_use_coefficients and self.teacache_mode == 'e') else e0.clone()
-            if not should_calc:
-                x = x.to(previous_residual.dtype) + previous_residual.to(x.device)
+                accumulated_rel_l1_distances[i] = accumulated_rel_l1_distance
+
+            # a batch can only skip when every state in it can
+            device_decisions = [d for d in calc_decisions if isinstance(d, torch.Tensor)]
+            should_calc = any(d for d in calc_decisions if not isinstance(d, torch.Tensor))
+            if not should_calc and device_decisions:
+                should_calc = bool(torch.stack(device_decisions).any())
+            if should_calc:
+                accumulated_rel_l1_distances = [0.0 if use_time_table else torch.zeros((), dtype=torch.float32, device=device) for _ in pred_ids]
+            else:
+                x = x.to(self.residual_stream_dtype)
+                for p_id, x_chunk, accumulated_rel_l1_distance in zip(pred_ids, x.chunk(len(pred_ids)), accumulated_rel_l1_distances):
+                    state = self.teacache_state.get(p_id)
+                    x_chunk.add_(self.teacache_state.load_residual(p_id, x.device, non_blocking=self.use_non_blocking))
+                    state.accumulated_rel_l1_distance = accumulated_rel_l1_distance
+                    state.skipped_steps.append(current_step)
                 #log.info(f"TeaCache: Skipping uncond step {current_step+1}")
-                self.teacache_state.update(
-                    pred_id,
-                    accumulated_rel_l1_distance=accumulated_rel_l1_distance,
-                )
-                self.teacache_state.get(pred_id)['skipped_steps'].append(current_step)
 
         if not self.enable_teacache or (self.enable_teacache and should_calc):
-            if self.enable_teacache:
-                original_x = x.clone().to(self.teacache_cache_device, non_blocking=self.use_non_blocking)
+            residual_buffers = None
+            if self.enable_teacache and not (use_block_cache or use_token_cache) and all(p_id is not None for p_id in pred_ids):
+                # float32 residuals are computed in place in their preallocated buffers, compressed or pinned
+                # ones on the main device in a reused input buffer and then stored
+                residual_buffers = [self.teacache_state.residual_buffer(p_id, x_chunk.shape) for p_id, x_chunk in zip(pred_ids, x.chunk(len(pred_ids)))]
+                if self.teacache_state.in_place:
+                    for buffer, x_chunk in zip(residual_buffers, x.chunk(len(pred_ids))):
+                        if buffer is not None:
+                            buffer.copy_(x_chunk, non_blocking=self.use_non_blocking)
+                else:
+                    block_input = self.teacache_state.input_buffer(x)
 
-            # arguments
+            # arguments, the modulation is cast to the residual stream dtype once for all blocks
             kwargs = dict(
-                e=e0,
+                e=e0.to(self.residual_stream_dtype),
                 seq_lens=seq_lens,
                 grid_sizes=grid_sizes,
                 freqs=freqs,
@@ -1104,7 +1659,8 @@ class WanModel(ModelMixin, ConfigMixin):
                 clip_embed=clip_embed,
                 rope_func=rope_func,
                 current_step=current_step,
-                video_attention_split_steps=self.video_attention_split_steps
+                video_attention_split_steps=self.video_attention_split_steps,
+                kv_cache_key=kv_cache_key,
                 )
             
             if vace_data is not None:
@@ -1115,39 +1671,50 @@ class WanModel(ModelMixin, ConfigMixin):
                         if (data["start"] <= current_step_percentage <= data["end"]) or \
                             (data["end"] > 0 and current_step == 0 and current_step_percentage >= data["start"]):
 
-                            vace_hints = self.forward_vace(x.to(torch.float32), data["context"], data["seq_len"], kwargs)
+                            vace_hints = self.forward_vace(x.to(self.residual_stream_dtype), data["context"], data["seq_len"], kwargs)
                             vace_hint_list.append(vace_hints)
                             vace_scale_list.append(data["scale"])
                 else:
-                    vace_hints = self.forward_vace(x.to(torch.float32), vace_data, seq_len, kwargs)
+                    vace_hints = self.forward_vace(x.to(self.residual_stream_dtype), vace_data, seq_len, kwargs)
                     vace_hint_list.append(vace_hints)
                     vace_scale_list.append(1.0)
                 
                 kwargs['vace_hints'] = vace_hint_list
                 kwargs['vace_context_scale'] = vace_scale_list
 
-            for b, block in enumerate(self.blocks):
-                if self.slg_blocks is not None:
-                    if b in self.slg_blocks and is_uncond:
-                        if self.slg_start_percent <= current_step_percentage <= self.slg_end_percent:
-                            continue
-                if b <= self.blocks_to_swap and self.blocks_to_swap >= 0:
-                    block.to(self.main_device)
-                x = block(x.to(torch.float32), **kwargs)
-                if b <= self.blocks_to_swap and self.blocks_to_swap >= 0:
-                    block.to(self.offload_device, non_blocking=self.use_non_blocking)
-
-            if self.enable_teacache and pred_id is not None:
-                self.teacache_state.update(
-                    pred_id,
-                    previous_residual=(x.to(original_x.device) - original_x),
-                    accumulated_rel_l1_distance=accumulated_rel_l1_distance.to(self.teacache_cache_device, non_blocking=self.use_non_blocking),
-                    previous_modulated_input=previous_modulated_input.to(self.teacache_cache_device, non_blocking=self.use_non_blocking)
-                )
+            if use_block_cache:
+                x = self.forward_block_cache(x, pred_ids, kwargs, current_step, is_uncond, current_step_percentage)
+            elif use_token_cache:
+                x = self.forward_token_cache(x, pred_ids, kwargs, current_step, is_uncond, current_step_percentage)
+            else:
+                x = self.forward_blocks(x, range(len(self.blocks)), kwargs, is_uncond, current_step_percentage)
+
+            if residual_buffers is not None:
+                if not self.teacache_state.in_place:
+                    residuals = torch.sub(x, block_input, out=block_input).chunk(len(pred_ids))
+                for i, (p_id, x_chunk, buffer, accumulated_rel_l1_distance) in enumerate(zip(pred_ids, x.chunk(len(pred_ids)), residual_buffers, accumulated_rel_l1_distances)):
+                    state = self.teacache_state.get(p_id)
+                    if buffer is not None:
+                        if self.teacache_state.in_place:
+                            # blocking copy, a non_blocking one to the host could be read before it has landed
+                            torch.sub(x_chunk.to(buffer.device, torch.float32), buffer, out=buffer)
+                        else:
+                            self.teacache_state.store_residual(p_id, residuals[i], non_blocking=self.use_non_blocking)
+                        if self.teacache_calibration is not None:
+                            self.teacache_calibration.record(p_id, e, e0, buffer if self.teacache_state.in_place else residuals[i])
+                    state.accumulated_rel_l1_distance = accumulated_rel_l1_distance
+                    if use_time_table:
+                        state.previous_step = current_step
+                    elif state.previous_modulated_input is not None and state.previous_modulated_input.shape == modulated_input.shape:
+                        state.previous_modulated_input.copy_(modulated_input)
+                    else:
+                        state.previous_modulated_input = modulated_input.clone()
         x = self.head(x, e)
         x = self.unpatchify(x, grid_sizes) # type: ignore[arg-type]
         x = [u.float() for u in x]
-        return (x, pred_id) if pred_id is not None else (x, None)
+        if pred_id_list:
+            return x, pred_ids
+        return (x, pred_ids[0]) if pred_ids[0] is not None else (x, None)
 
     def unpatchify(self, x, grid_sizes):
         r"""
@@ -1174,24 +1741,53 @@ class WanModel(ModelMixin, ConfigMixin):
             out.append(u)
         return out
 
+class TeaCachePrediction:
+    """TeaCache state of a single model prediction, the residual buffer is reused between steps"""
+    __slots__ = ('previous_residual', 'residual_scale', 'accumulated_rel_l1_distance', 'previous_modulated_input', 'previous_step', 'skipped_steps', 'last_used',
+                 'previous_first_residual', 'skipped_blocks')
+
+    def __init__(self):
+        self.previous_residual = None
+        self.residual_scale = None # per token scales of int8 residuals
+        self.accumulated_rel_l1_distance = 0
+        self.previous_modulated_input = None
+        self.previous_step = None
+        self.skipped_steps = []
+        self.last_used = 0
+        # block cache
+        self.previous_first_residual = None
+        self.skipped_blocks = [] # (step, skipped block count)
+
 class TeaCacheState:
-    def __init__(self, cache_device='cpu'):
+    def __init__(self, cache_device='cpu', memory_budget=0, storage_dtype=torch.float32, pin_memory=False):
         self.cache_device = cache_device
+        self.memory_budget = memory_budget # bytes for all residual buffers, 0 for no limit
+        self.storage_dtype = storage_dtype # float32, bfloat16, float16 or int8 with per token scales
+        self.pin_memory = pin_memory
         log.info(f"TeaCache: Using cache device: {self.cache_device}")
         self.states = {}
         self._next_pred_id = 0
+        self._use_count = 0
+        self._input_buffer = None
+        self._error_sum = None
+        self._error_count = 0
+        self.token_caches = {}
     
+    @property
+    def pinned(self):
+        return self.pin_memory and torch.device(self.cache_device).type == 'cpu' and torch.cuda.is_available()
+
+    @property
+    def in_place(self):
+        """float32 residuals are computed directly in their buffers, others are encoded on the main device first"""
+        return self.storage_dtype == torch.float32 and not self.pinned
+
     def new_prediction(self, cache_device='cpu'):
         """Create new prediction state and return its ID"""
         self.cache_device = cache_device
         pred_id = self._next_pred_id
         self._next_pred_id += 1
-        self.states[pred_id] = {
-            'previous_residual': None,
-            'accumulated_rel_l1_distance': 0,
-            'previous_modulated_input': None,
-            'skipped_steps': [],
-        }
+        self.states[pred_id] = TeaCachePrediction()
         return pred_id
     
     def update(self, pred_id, **kwargs):
@@ -1199,14 +1795,120 @@ class TeaCacheState:
         if pred_id not in self.states:
             return None
         for key, value in kwargs.items():
-            self.states[pred_id][key] = value
+            setattr(self.states[pred_id], key, value)
     
     def get(self, pred_id):
-        return self.states.get(pred_id, {})
+        return self.states.get(pred_id)
+
+    def residual_bytes(self):
+        return sum(tensor.nbytes for state in self.states.values() for tensor in (state.previous_residual, state.residual_scale) if tensor is not None)
+
+    def residual_buffer(self, pred_id, shape):
+        """
+        Returns the residual buffer of the prediction, allocated on the cache device on first use. When over
+        the memory budget the least recently used buffers of other predictions are dropped, those predictions
+        then compute their next step. Returns None if the buffer doesn't fit the budget at all.
+        """
+        state = self.states[pred_id]
+        self._use_count += 1
+        state.last_used = self._use_count
+        if state.previous_residual is not None and state.previous_residual.shape == shape and state.previous_residual.dtype == self.storage_dtype:
+            return state.previous_residual
+        state.previous_residual = state.residual_scale = None
+
+        scale_shape = (*shape[:-1], 1) if self.storage_dtype == torch.int8 else None
+        size = math.prod(shape) * self.storage_dtype.itemsize + (math.prod(scale_shape) * 4 if scale_shape else 0)
+        if self.memory_budget > 0:
+            while self.residual_bytes() + size > self.memory_budget:
+                cached = [s for s in self.states.values() if s.previous_residual is not None]
+                if not cached:
+                    return None
+                lru = min(cached, key=lambda s: s.last_used)
+                lru.previous_residual = lru.residual_scale = None
+        state.previous_residual = torch.empty(shape, dtype=self.storage_dtype, device=self.cache_device, pin_memory=self.pinned)
+        if scale_shape:
+            state.residual_scale = torch.empty(scale_shape, dtype=torch.float32, device=self.cache_device, pin_memory=self.pinned)
+        return state.previous_residual
+
+    def input_buffer(self, x):
+        """Copy of the block input on its device, reused between steps"""
+        if self._input_buffer is None or self._input_buffer.shape != x.shape or self._input_buffer.device != x.device:
+            self._input_buffer = torch.empty(x.shape, dtype=torch.float32, device=x.device)
+        return self._input_buffer.copy_(x)
+
+    def encode_residual(self, residual):
+        if self.storage_dtype == torch.int8:
+            scale = residual.abs().amax(dim=-1, keepdim=True).clamp_(min=1e-12) / 127
+            return torch.round(residual / scale).clamp_(-127, 127).to(torch.int8), scale
+        return residual.to(self.storage_dtype), None
+
+    def store_residual(self, pred_id, residual, non_blocking=False, index=None):
+        """Encodes a float32 residual on its device and copies it into the prediction's buffers, or into their index slice"""
+        state = self.states[pred_id]
+        data, scale = self.encode_residual(residual)
+        if self.storage_dtype != torch.float32:
+            decoded = data.to(torch.float32) * scale if scale is not None else data.to(torch.float32)
+            error = (decoded - residual).norm() / residual.norm().clamp(min=1e-12)
+            self._error_sum = error if self._error_sum is None else self._error_sum + error
+            self._error_count += 1
+        residual_buffer, scale_buffer = state.previous_residual, state.residual_scale
+        if index is not None:
+            residual_buffer, scale_buffer = residual_buffer[index], scale_buffer[index] if scale_buffer is not None else None
+        residual_buffer.copy_(data, non_blocking=non_blocking)
+        if scale is not None:
+            scale_buffer.copy_(scale, non_blocking=non_blocking)
+
+    def load_residual(self, pred_id, device, non_blocking=False, index=None):
+        state = self.states[pred_id]
+        residual_buffer, scale_buffer = state.previous_residual, state.residual_scale
+        if index is not None:
+            residual_buffer, scale_buffer = residual_buffer[index], scale_buffer[index] if scale_buffer is not None else None
+        residual = residual_buffer.to(device, non_blocking=non_blocking)
+        if scale_buffer is not None:
+            return residual.to(torch.float32) * scale_buffer.to(device, non_blocking=non_blocking)
+        return residual
+
+    def token_cache(self, pred_ids):
+        """Token cache of a batch of predictions"""
+        if pred_ids not in self.token_caches:
+            self.token_caches[pred_ids] = {"input": None, "deltas": None, "full_step": None, "computed_tokens": 0, "total_tokens": 0}
+        return self.token_caches[pred_ids]
+
+    def token_cache_report(self):
+        computed = sum(cache["computed_tokens"] for cache in self.token_caches.values())
+        total = sum(cache["total_tokens"] for cache in self.token_caches.values())
+        return f"Token cache: recomputed {computed / max(total, 1):.1%} of {total} tokens"
+
+    def state_dict(self):
+        if self.pinned: # pending copies into pinned buffers
+            torch.cuda.synchronize()
+        return {
+            "states": {pred_id: {key: getattr(state, key) for key in TeaCachePrediction.__slots__} for pred_id, state in self.states.items()},
+            "next_pred_id": self._next_pred_id,
+        }
+
+    def load_state_dict(self, state_dict):
+        self.clear_all()
+        for pred_id, values in state_dict["states"].items():
+            self.states[pred_id] = TeaCachePrediction()
+            self.update(pred_id, **values)
+        self._next_pred_id = state_dict["next_pred_id"]
+        self._use_count = max((state.last_used for state in self.states.values()), default=0)
 
     def report(self):
-        for pred_id in self.states:
-            log.info(f"Prediction {pred_id}: {self.states[pred_id]}")
+        for pred_id, state in self.states.items():
+            log.info(f"Prediction {pred_id}: skipped steps {state.skipped_steps}")
+
+    def storage_report(self):
+        """Residual memory footprint and the mean relative error of the compressed residuals"""
+        stored = self.residual_bytes()
+        full = sum(state.previous_residual.numel() * 4 for state in self.states.values() if state.previous_residual is not None)
+        report = f"TeaCache residuals: {stored / 1024**2:.2f} MB as {str(self.storage_dtype).split('.')[-1]}{' (pinned)' if self.pinned else ''}"
+        if self.storage_dtype != torch.float32:
+            report += f", {full / 1024**2:.2f} MB as float32"
+            if self._error_count:
+                report += f", mean relative reconstruction error: {(self._error_sum / self._error_count).item():.5f}"
+        return report
     
     def clear_prediction(self, pred_id):
         if pred_id in self.states:
@@ -1215,9 +1917,99 @@ class TeaCacheState:
     def clear_all(self):
         self.states.clear()
         self._next_pred_id = 0
+        self._use_count = 0
+        self._input_buffer = None
+        self._error_sum = None
+        self._error_count = 0
+        self.token_caches.clear()
 
 def relative_l1_distance(last_tensor, current_tensor):
     l1_distance = torch.abs(last_tensor.to(current_tensor.device) - current_tensor).mean()
     norm = torch.abs(last_tensor).mean()
     relative_l1_distance = l1_distance / norm
     return relative_l1_distance.to(torch.float32).to(current_tensor.device)
+
+def _benchmark_block_run(dim, ffn_dim, num_heads, grid, chunk_size, residual_stream_dtype, dtype, device, repeats, full_block=False, context_len=512):
+    """
+    Seconds per call and peak memory in bytes above the weights and inputs of one block, the whole forward
+    or only its cross attention and FFN
+    """
+    import time
+    import resource
+    torch.manual_seed(0)
+    block = WanAttentionBlock("t2v_cross_attn", dim, ffn_dim, num_heads).to(device).eval()
+    block.ffn_chunk_size = chunk_size
+    block.residual_stream_dtype = getattr(torch, residual_stream_dtype)
+    d = dim // num_heads
+    freqs = torch.cat([rope_params(1024, d - 4 * (d // 6)), rope_params(1024, 2 * (d // 6)), rope_params(1024, 2 * (d // 6))], dim=1)
+    grid_sizes = torch.tensor([grid])
+    freqs = [rope_grid(freqs.to(device), *grid, d // 2)]
+    seq_len = math.prod(grid)
+    x = torch.randn(1, seq_len, dim, device=device, dtype=block.residual_stream_dtype)
+    context = torch.randn(1, context_len, dim, device=device)
+    e0 = torch.randn(1, 6, dim, device=device, dtype=block.residual_stream_dtype)
+    e = (block.modulation.to(e0.dtype) + e0).chunk(6, dim=1)
+
+    def run():
+        if full_block:
+            return block(x, e0, torch.tensor([seq_len]), grid_sizes, freqs, context, None, current_step=0)
+        return block.cross_attn_ffn(x, context, None, e)
+
+    if device != "cpu":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    else:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with torch.no_grad(), torch.autocast(device_type=torch.device(device).type, dtype=getattr(torch, dtype), enabled=dtype != "float32"):
+        run()
+        if device != "cpu":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            run()
+        if device != "cpu":
+            torch.cuda.synchronize(device)
+        seconds = (time.perf_counter() - start) / repeats
+    if device != "cpu":
+        return seconds, torch.cuda.max_memory_allocated(device) - baseline
+    return seconds, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024
+
+def _benchmark_blocks(runs, device):
+    """Runs _benchmark_block_run for each argument tuple, on CPU each in its own process as the peak resident memory of a process can't be reset"""
+    import concurrent.futures
+    import multiprocessing
+    for args in runs:
+        if device == "cpu":
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                yield pool.submit(_benchmark_block_run, *args).result()
+        else:
+            yield _benchmark_block_run(*args)
+
+def benchmark_ffn_chunks(seq_lens=(16384, 75600), chunk_sizes=(None, 16384, 4096), dim=5120, ffn_dim=13824, num_heads=40, dtype="bfloat16", device="cuda", repeats=2):
+    """
+    Speed and peak activation memory of WanAttentionBlock.cross_attn_ffn per ffn_chunk_size, defaults are
+    the 14B model at 480p and 720p 81 frame sequence lengths. Peak memory is the output and activations,
+    the weights and inputs excluded.
+    """
+    runs = [(l, chunk_size) for l in seq_lens for chunk_size in chunk_sizes]
+    results = []
+    for (l, chunk_size), (seconds, peak) in zip(runs, _benchmark_blocks([
+            (dim, ffn_dim, num_heads, (l, 1, 1), chunk_size, "float32", dtype, device, repeats) for l, chunk_size in runs], device)):
+        results.append({"seq_len": l, "ffn_chunk_size": chunk_size, "seconds": seconds, "peak_mb": peak / 1024**2})
+        log.info(f"seq_len {l:>6} ffn_chunk_size {str(chunk_size):>6}: {seconds * 1000:9.1f} ms, peak {peak / 1024**2:9.1f} MB")
+    return results
+
+def benchmark_residual_precision(grid=(21, 60, 104), residual_stream_dtypes=("float32", "bfloat16", "float16"), dim=5120, ffn_dim=13824, num_heads=40, dtype="bfloat16", device="cuda", repeats=2):
+    """
+    Latency and peak memory of one whole WanAttentionBlock forward per residual stream dtype, defaults
+    are the 14B model at 480p 81 frames. Peak memory is the output and activations, the weights and inputs
+    excluded.
+    """
+    results = []
+    for residual_stream_dtype, (seconds, peak) in zip(residual_stream_dtypes, _benchmark_blocks([
+            (dim, ffn_dim, num_heads, tuple(grid), None, residual_stream_dtype, dtype, device, repeats, True) for residual_stream_dtype in residual_stream_dtypes], device)):
+        results.append({"residual_stream_dtype": residual_stream_dtype, "seconds": seconds, "peak_mb": peak / 1024**2})
+        log.info(f"residual stream {residual_stream_dtype:>8}: {seconds * 1000:9.1f} ms per block, peak {peak / 1024**2:9.1f} MB")
+    return results